@@ -138,6 +138,7 @@ routes = [
     ('/', views.index, ['GET', 'POST']),
     ('/signupinternal/<int:course_id>', views.signupinternal, ['GET', 'POST']),
     ('/signupexternal/<int:course_id>', views.signupexternal, ['GET', 'POST']),
+    ('/waiting/<int:course_id>', views.waiting_room, ['GET']),
     ('/licenses', views.licenses, ['GET']),
     ('/vacancies', views.vacancies, ['GET']),
     ('/signoff', views.signoff, ['GET', 'POST']),
@@ -164,6 +165,7 @@ routes = [
     ('/internal/export/<string:type>/<int:id>/<string:format>', views.export, ['GET', 'POST']),
 
     ('/internal/notifications', views.notifications, ['GET', 'POST']),
+    ('/internal/notifications/<string:task_id>', views.notifications_progress, ['GET']),
 
     ('/internal/lists', views.lists, ['GET']),
     ('/internal/add_course', views.add_course, ['GET', 'POST']),
@@ -242,3 +244,9 @@ for errno, handler in handlers:
 
 # activate logging
 from spz import log  # NOQA
+
+# maintain the attendance counters of courses
+from spz import counters  # NOQA
+
+# versions of cached template fragments
+from spz import fragments  # NOQA
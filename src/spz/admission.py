@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Admission control for the signup endpoints at signup opening.
+
+   Languages listed in `ADMISSION_RATES` get a queue for some time after each opening. Applicants draw a ticket
+   number from Redis and carry it in a signed cookie. `ADMISSION_BURST` tickets are admitted right at the opening,
+   further ones at the configured rate. Until then the applicants see a waiting page that does not touch the
+   database. On top of that, every worker process handles at most `ADMISSION_CONCURRENCY` signup submissions at once.
+"""
+
+import math
+import threading
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import request, redirect, url_for
+from flask_babel import gettext as _
+from flask_login import current_user
+from redis import RedisError
+from sqlalchemy.orm import contains_eager
+
+from spz import app, cache, models, store, token
+from spz.errorhandlers import render_error
+
+
+COOKIE = 'spz_admission_{}'
+
+slots = threading.BoundedSemaphore(app.config['ADMISSION_CONCURRENCY'])
+
+
+@cache.cached(key_prefix='admission_openings')
+def openings():
+    """Language and signup openings of every course, as dict of course ID to `(language_id, name, openings)`."""
+    return {
+        course.id: (
+            course.language.id,
+            course.language.name,
+            (course.language.signup_begin, course.language.signup_fcfs_begin)
+        )
+        for course in models.Course.query.join(models.Course.language).options(contains_eager(models.Course.language))
+    }
+
+
+class Queue:
+    """Admission queue of one language for one opening.
+
+       :param language_id: ID of the queued language
+       :param rate: tickets admitted per second after the burst
+       :param burst: tickets admitted right at the opening
+       :param opening: time of the opening, in UTC
+    """
+
+    def __init__(self, language_id, rate, burst, opening):
+        self.language_id = language_id
+        self.rate = rate
+        self.burst = burst
+        self.opening = opening
+
+    @property
+    def key(self):
+        return 'spz:admission:{}:{:%Y%m%d%H%M%S}'.format(self.language_id, self.opening)
+
+    def admitted(self, time):
+        """Highest ticket number admitted at the given time."""
+        return self.burst + self.rate * max(0, (time - self.opening).total_seconds())
+
+    def admits(self, number, time):
+        return number is not None and number <= self.admitted(time)
+
+    def position(self, number, time):
+        """Number of tickets that are admitted before the given one."""
+        return max(0, math.ceil(number - self.admitted(time)))
+
+    def wait(self, number, time):
+        """Estimated seconds until the given ticket is admitted."""
+        return self.position(number, time) / self.rate
+
+    def issue(self):
+        """Draw the next ticket number, every ticket is admitted if Redis is unavailable."""
+        try:
+            client = store.redis_client()
+            number = client.incr(self.key)
+            client.expire(self.key, int(app.config['ADMISSION_WINDOW'].total_seconds()))
+            return number
+        except RedisError:
+            return 0
+
+    def ticket(self):
+        """Ticket number of the running request, None if it has none for this queue."""
+        payload = token.validate_multi(
+            request.cookies.get(COOKIE.format(self.language_id)),
+            namespace='admission',
+            max_age=app.config['ADMISSION_WINDOW'].total_seconds()
+        )
+        if not isinstance(payload, dict) or payload.get('queue') != self.key:
+            return None
+        return payload.get('number')
+
+    def set_ticket(self, response, number):
+        response.set_cookie(
+            COOKIE.format(self.language_id),
+            token.generate(dict(queue=self.key, number=number), namespace='admission'),
+            max_age=int(app.config['ADMISSION_WINDOW'].total_seconds()),
+            httponly=True
+        )
+        return response
+
+
+def current_queue(course_id, time=None):
+    """Queue the signups for this course go through right now, None if they are not queued."""
+    time = time or datetime.now(timezone.utc).replace(tzinfo=None)
+    language_id, name, language_openings = openings().get(course_id, (None, None, ()))
+    rate = app.config['ADMISSION_RATES'].get(name)
+    if not rate:
+        return None
+
+    for opening in sorted((opening for opening in language_openings if opening is not None), reverse=True):
+        if opening <= time < opening + app.config['ADMISSION_WINDOW']:
+            return Queue(language_id, rate, app.config['ADMISSION_BURST'], opening)
+    return None
+
+
+def guarded(f):
+    """Send applicants without an admitted ticket to the waiting room and limit concurrent submissions.
+
+       Logged in users skip the queue.
+    """
+    @wraps(f)
+    def decorated_function(course_id, *args, **kwargs):
+        time = datetime.now(timezone.utc).replace(tzinfo=None)
+        queue = current_queue(course_id, time)
+        if queue is not None and not current_user.is_authenticated and not queue.admits(queue.ticket(), time):
+            return redirect(url_for(
+                'waiting_room',
+                course_id=course_id,
+                internal=int(request.endpoint == 'signupinternal'),
+                token=request.args.get('token', None)
+            ))
+
+        if request.method != 'POST':
+            return f(course_id, *args, **kwargs)
+        if not slots.acquire(timeout=app.config['ADMISSION_TIMEOUT']):
+            return render_error(503, _('Zu viele gleichzeitige Anmeldungen, bitte versuchen Sie es gleich noch einmal'))
+        try:
+            return f(course_id, *args, **kwargs)
+        finally:
+            slots.release()
+    return decorated_function
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+"""In-memory allocation engine for the populate procedures.
+
+   The waiting list is loaded once into flat arrays. Courses and applicants are mapped to dense indices, so that
+   vacancy and parallel course checks during the selection are plain list lookups and bit operations instead of
+   walks over the ORM object graph. The result is written back with bulk statements.
+"""
+
+from datetime import datetime, timezone
+
+from sqlalchemy import and_, bindparam
+
+from spz import app, counters, db, models
+from spz.log import booking_msg
+
+
+def parallel_levels(course, other):
+    """Check if two courses of the same language collide, see :py:func:`Applicant.active_in_parallel_course`."""
+    return course.language_id == other.language_id and (
+        course.level == other.level or
+        course.level in other.collision or
+        other.level in course.collision
+    )
+
+
+def discount_for(is_student, discounted, active_count):
+    """Discount for the next course being entered, see :py:func:`Applicant.current_discount`."""
+    if is_student and active_count == 0:
+        return models.Attendance.MAX_DISCOUNT  # one free course for students
+    else:
+        return models.Attendance.MAX_DISCOUNT / 2 if discounted else 0  # discounted applicants get 50% off
+
+
+class Snapshot(object):
+    """Compact state of all courses and all waiting applicants.
+
+       :param course_ids: list of course IDs, the position is the course index
+       :param remaining: remaining seats per course index
+       :param parallel: bitset of colliding course indices per course index
+       :param applicant_ids: list of applicant IDs, the position is the applicant index
+       :param active: bitset of active course indices per applicant index
+       :param active_count: number of active attendances per applicant index
+       :param is_student: student flag per applicant index
+       :param discounted: discount flag per applicant index
+    """
+
+    def __init__(self, course_ids, remaining, parallel, applicant_ids, active, active_count, is_student, discounted):
+        self.course_ids = course_ids
+        self.remaining = remaining
+        self.parallel = parallel
+        self.applicant_ids = applicant_ids
+        self.active = active
+        self.active_count = active_count
+        self.is_student = is_student
+        self.discounted = discounted
+
+        self.course_idx = {course_id: idx for idx, course_id in enumerate(course_ids)}
+        self.applicant_idx = {applicant_id: idx for idx, applicant_id in enumerate(applicant_ids)}
+
+    @staticmethod
+    def build_parallel(courses):
+        """Precompute the collision bitset of every course, excluding the course itself."""
+        by_language = {}
+        for idx, course in enumerate(courses):
+            by_language.setdefault(course.language_id, []).append(idx)
+
+        parallel = [0] * len(courses)
+        for indices in by_language.values():
+            for i in indices:
+                for j in indices:
+                    if i != j and parallel_levels(courses[i], courses[j]):
+                        parallel[i] |= 1 << j
+        return parallel
+
+    def discount(self, applicant):
+        return discount_for(self.is_student[applicant], self.discounted[applicant], self.active_count[applicant])
+
+    def to_dict(self):
+        return dict(
+            course_ids=self.course_ids,
+            remaining=self.remaining,
+            parallel=self.parallel,
+            applicant_ids=self.applicant_ids,
+            active=self.active,
+            active_count=self.active_count,
+            is_student=self.is_student,
+            discounted=self.discounted
+        )
+
+    @staticmethod
+    def from_dict(data):
+        return Snapshot(**data)
+
+    def copy(self):
+        return Snapshot.from_dict({key: list(value) for key, value in self.to_dict().items()})
+
+
+class Candidates(object):
+    """Waiting attendances as parallel arrays, ordered by registration time.
+
+       :param applicant: applicant index per candidate
+       :param course: course index per candidate
+       :param informed: `informed_about_rejection` flag per candidate
+    """
+
+    def __init__(self, applicant=None, course=None, informed=None):
+        self.applicant = applicant if applicant is not None else []
+        self.course = course if course is not None else []
+        self.informed = informed if informed is not None else []
+
+    def __len__(self):
+        return len(self.applicant)
+
+    def append(self, applicant, course, informed):
+        self.applicant.append(applicant)
+        self.course.append(course)
+        self.informed.append(informed)
+
+    def to_dict(self):
+        return dict(applicant=self.applicant, course=self.course, informed=self.informed)
+
+    @staticmethod
+    def from_dict(data):
+        return Candidates(**data)
+
+
+class Allocation(object):
+    """Decisions of one populate round.
+
+       :param accepted: list of `(candidate, discount)` that enter their course
+       :param rejected: candidates that stay on the waiting list and get informed for the first time
+       :param parallel: candidates that are already active in a parallel course
+       :param handled: candidates that get a mail, in the order they were decided on
+       :param deferred: candidates skipped because their applicant already got a course in this round
+    """
+
+    def __init__(self):
+        self.accepted = []
+        self.rejected = []
+        self.parallel = []
+        self.handled = []
+        self.deferred = []
+
+
+def allocate(snapshot, candidates, order):
+    """Run one populate round on the snapshot.
+
+       :param snapshot: :py:class:`Snapshot` of the current state, gets updated in place
+       :param candidates: :py:class:`Candidates` that should be considered
+       :param order: iterable of candidate indices in the order they should be tried
+       :return: :py:class:`Allocation` holding the decisions
+
+       Every applicant gets at most one course per round.
+    """
+    result = Allocation()
+    accepted_applicants = bytearray(len(snapshot.applicant_ids))
+
+    for idx in order:
+        applicant = candidates.applicant[idx]
+        course = candidates.course[idx]
+
+        # Only assign one course per applicant per round
+        if accepted_applicants[applicant]:
+            result.deferred.append(idx)
+            continue
+
+        if snapshot.active[applicant] & snapshot.parallel[course]:
+            # XXX: how can this happen? should we send a message to someone?
+            result.parallel.append(idx)
+            continue
+
+        # keep default waiting status
+        if snapshot.remaining[course] <= 0:
+            if not candidates.informed[idx]:
+                result.rejected.append(idx)
+                result.handled.append(idx)
+            continue
+
+        result.accepted.append((idx, snapshot.discount(applicant)))
+        result.handled.append(idx)
+        snapshot.remaining[course] -= 1
+        snapshot.active[applicant] |= 1 << course
+        snapshot.active_count[applicant] += 1
+        accepted_applicants[applicant] = 1
+
+    return result
+
+
+def summarize(snapshot, candidates, allocation):
+    """Plain, JSON serializable description of the decisions, keyed by applicant and course IDs.
+
+       :return: dict with the accepted `(applicant_id, course_id, discount)`, the rejected, parallel and deferred
+                `(applicant_id, course_id)`, the `(applicant_id, course_id, restock)` mails that get sent and the
+                `course_id -> (accepted, remaining)` fill per course
+    """
+    def ids(idx):
+        return [snapshot.applicant_ids[candidates.applicant[idx]], snapshot.course_ids[candidates.course[idx]]]
+
+    fill = {}
+    for idx, _ in allocation.accepted:
+        course = candidates.course[idx]
+        fill[course] = fill.get(course, 0) + 1
+
+    return dict(
+        accepted=[ids(idx) + [discount] for idx, discount in allocation.accepted],
+        rejected=[ids(idx) for idx in allocation.rejected],
+        parallel=[ids(idx) for idx in allocation.parallel],
+        deferred=[ids(idx) for idx in allocation.deferred],
+        mails=[ids(idx) + [bool(candidates.informed[idx])] for idx in allocation.handled],
+        fill={str(snapshot.course_ids[course]): [n, snapshot.remaining[course]] for course, n in fill.items()}
+    )
+
+
+def load(time, attendance_filter, course_ids=None):
+    """Load the snapshot and all waiting attendances that are up for allocation.
+
+       :param time: current UTC time
+       :param attendance_filter: function that accepts the registration time and the :py:class:`Language` of a
+                                 waiting attendance and must return True if it should be considered.
+       :param course_ids: only consider the waiting lists of these courses, all if None
+       :return: tuple of :py:class:`Snapshot` and :py:class:`Candidates`
+
+       Courses whose language is still in manual assignment mode are skipped.
+    """
+    courses = models.Course.query.order_by(models.Course.id).all()
+    remaining = [course.vacancies for course in courses]
+
+    waiting_applicants = db.session.query(models.Attendance.applicant_id) \
+        .filter(models.Attendance.waiting == True)  # NOQA
+    if course_ids is not None:
+        waiting_applicants = waiting_applicants.filter(models.Attendance.course_id.in_(course_ids))
+    applicants = db.session.query(models.Applicant.id, models.Applicant.is_student, models.Applicant.discounted) \
+        .filter(models.Applicant.id.in_(waiting_applicants.subquery())) \
+        .order_by(models.Applicant.id) \
+        .all()
+
+    snapshot = Snapshot(
+        course_ids=[course.id for course in courses],
+        remaining=remaining,
+        parallel=Snapshot.build_parallel(courses),
+        applicant_ids=[applicant_id for applicant_id, _, _ in applicants],
+        active=[0] * len(applicants),
+        active_count=[0] * len(applicants),
+        is_student=[bool(is_student) for _, is_student, _ in applicants],
+        discounted=[bool(discounted) for _, _, discounted in applicants]
+    )
+
+    active = db.session.query(models.Attendance.applicant_id, models.Attendance.course_id) \
+        .filter(models.Attendance.waiting.isnot(True)) \
+        .filter(models.Attendance.applicant_id.in_(waiting_applicants.subquery()))
+    for applicant_id, course_id in active:
+        applicant = snapshot.applicant_idx[applicant_id]
+        snapshot.active[applicant] |= 1 << snapshot.course_idx[course_id]
+        snapshot.active_count[applicant] += 1
+
+    # only non-manual-mode courses
+    open_courses = {
+        idx
+        for idx, course in enumerate(courses)
+        if not course.language.is_in_manual_mode(time)
+    }
+
+    waiting = db.session.query(
+        models.Attendance.applicant_id,
+        models.Attendance.course_id,
+        models.Attendance.registered,
+        models.Attendance.informed_about_rejection
+    ) \
+        .order_by(models.Attendance.registered) \
+        .filter(models.Attendance.waiting == True)  # NOQA
+    if course_ids is not None:
+        waiting = waiting.filter(models.Attendance.course_id.in_(course_ids))
+
+    candidates = Candidates()
+    for applicant_id, course_id, registered, informed in waiting:
+        course = snapshot.course_idx[course_id]
+        if course in open_courses and attendance_filter(registered, courses[course].language):
+            candidates.append(snapshot.applicant_idx[applicant_id], course, informed)
+
+    return snapshot, candidates
+
+
+def enrollment_times():
+    """Current UTC time and the matching signoff window, see :py:func:`Attendance.set_waiting_status`."""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    signoff_window = (now + app.config['SELF_SIGNOFF_PERIOD']).replace(microsecond=0, second=0, minute=0)
+    return now, signoff_window
+
+
+def store(snapshot, candidates, allocation):
+    """Write the decisions back to the database with bulk statements.
+
+       This bypasses the ORM, so the booking log entries are written here, too. The caller is responsible for
+       the commit.
+
+       :return: list of `(applicant_id, course_id, informed_before_now)` for every handled attendance
+    """
+    def keys(idx):
+        return dict(
+            b_applicant_id=snapshot.applicant_ids[candidates.applicant[idx]],
+            b_course_id=snapshot.course_ids[candidates.course[idx]]
+        )
+
+    table = models.Attendance.__table__
+    where = and_(table.c.applicant_id == bindparam('b_applicant_id'), table.c.course_id == bindparam('b_course_id'))
+
+    now, signoff_window = enrollment_times()
+
+    if allocation.accepted:
+        db.session.execute(
+            table.update().where(where).values(
+                waiting=False,
+                enrolled_at=now,
+                signoff_window=signoff_window,
+                discount=bindparam('b_discount'),
+                informed_about_rejection=True
+            ),
+            [dict(keys(idx), b_discount=discount) for idx, discount in allocation.accepted]
+        )
+        counters.count_bookings(now)
+
+    # parallel candidates are only marked, they do not get a mail
+    informed = [idx for idx in allocation.parallel if not candidates.informed[idx]] + allocation.rejected
+    if informed:
+        db.session.execute(
+            table.update().where(where).values(informed_about_rejection=True),
+            [keys(idx) for idx in informed]
+        )
+
+    log_bookings([(snapshot.applicant_ids[candidates.applicant[idx]], snapshot.course_ids[candidates.course[idx]])
+                  for idx, _ in allocation.accepted], now)
+
+    return [
+        (
+            snapshot.applicant_ids[candidates.applicant[idx]],
+            snapshot.course_ids[candidates.course[idx]],
+            candidates.informed[idx]
+        )
+        for idx in allocation.handled
+    ]
+
+
+def log_bookings(booked, timestamp):
+    """Bulk insert the log entries the `Attendance.waiting` event handler would have written.
+
+       :param booked: list of `(applicant_id, course_id)` that got booked
+       :param timestamp: time of the booking
+    """
+    if not booked:
+        return
+
+    names = {
+        applicant_id: ('{} {}'.format(first_name, last_name), mail)
+        for applicant_id, first_name, last_name, mail
+        in db.session.query(
+            models.Applicant.id,
+            models.Applicant.first_name,
+            models.Applicant.last_name,
+            models.Applicant.mail
+        ).filter(models.Applicant.id.in_({applicant_id for applicant_id, _ in booked}))
+    }
+    courses = {
+        course.id: course
+        for course
+        in models.Course.query.filter(models.Course.id.in_({course_id for _, course_id in booked}))
+    }
+
+    entries = []
+    for applicant_id, course_id in booked:
+        full_name, mail = names[applicant_id]
+        course = courses[course_id]
+        entries.append(dict(timestamp=timestamp, msg=booking_msg(full_name, mail, course), course_id=course.id))
+    db.session.bulk_insert_mappings(models.LogEntry, entries)
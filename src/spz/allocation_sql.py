@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""Set-based FCFS allocation that runs entirely inside PostgreSQL.
+
+   Nothing but the IDs of changed attendances is loaded into Python, so memory stays flat regardless of the size
+   of the semester. Select it with `POPULATE_BACKEND = 'sql'`.
+
+   Every statement ranks the waiting attendances per course by registration time and accepts as many of them as
+   there are vacancies, at most one per applicant. This is repeated until nobody is accepted anymore, so seats that
+   were ranked for an applicant who got an earlier course go to the next in line.
+
+   .. note::
+      This differs from the sequential in-memory engine in one corner case: an applicant who waits for multiple
+      courses may end up in a course they registered for later, if a seat in an earlier one only becomes reachable
+      in a later iteration of the same round.
+"""
+
+from sqlalchemy import text
+
+from spz import counters, db, models
+from spz.allocation import enrollment_times, log_bookings
+
+
+# waiting attendances of courses that are not in manual assignment mode anymore, see `Language.is_in_manual_mode`
+OPEN_WAITING = '''
+    open_waiting AS (
+        SELECT a.applicant_id, a.course_id, a.registered, a.informed_about_rejection,
+               c.language_id, c.level, c.collision
+        FROM attendance a
+        JOIN course c ON c.id = a.course_id
+        JOIN language l ON l.id = c.language_id
+        WHERE a.waiting = true
+          AND l.signup_manual_end <= :time
+          AND l.signup_auto_end >= :time
+          AND (:all_courses OR a.course_id = ANY(:course_ids))
+    ),
+    active AS (
+        SELECT course_id, count(*) AS n
+        FROM attendance
+        WHERE waiting = false
+        GROUP BY course_id
+    )
+'''
+
+# anti-join condition for applicants that are active in a parallel course, see `Applicant.active_in_parallel_course`
+ACTIVE_IN_PARALLEL_COURSE = '''
+    EXISTS (
+        SELECT 1
+        FROM attendance p
+        JOIN course pc ON pc.id = p.course_id
+        WHERE p.applicant_id = w.applicant_id
+          AND p.course_id <> w.course_id
+          AND p.waiting IS NOT true
+          AND pc.language_id = w.language_id
+          AND (pc.level = w.level OR pc.level = ANY(w.collision) OR w.level = ANY(pc.collision))
+    )
+'''
+
+# only one course per applicant per round; everyone accepted in this round shares the same `enrolled_at`
+ACCEPTED_IN_THIS_ROUND = '''
+    EXISTS (
+        SELECT 1
+        FROM attendance r
+        WHERE r.applicant_id = w.applicant_id
+          AND r.waiting = false
+          AND r.enrolled_at = :now
+    )
+'''
+
+ACCEPT = text('''
+    WITH {open_waiting},
+    ranked AS (
+        SELECT w.applicant_id, w.course_id, w.registered, w.informed_about_rejection,
+               c."limit" - coalesce(active.n, 0) AS vacancies,
+               row_number() OVER (PARTITION BY w.course_id ORDER BY w.registered) AS course_rank
+        FROM open_waiting w
+        JOIN course c ON c.id = w.course_id
+        LEFT JOIN active ON active.course_id = w.course_id
+        WHERE NOT {parallel}
+          AND NOT {accepted}
+    ),
+    selected AS (
+        SELECT r.applicant_id, r.course_id, r.informed_about_rejection,
+               row_number() OVER (PARTITION BY r.applicant_id ORDER BY r.registered) AS applicant_rank,
+               CASE
+                   WHEN ap.is_student AND NOT EXISTS (
+                       SELECT 1 FROM attendance x WHERE x.applicant_id = r.applicant_id AND x.waiting IS NOT true
+                   ) THEN :free
+                   WHEN ap.discounted THEN :reduced
+                   ELSE 0
+               END AS discount
+        FROM ranked r
+        JOIN applicant ap ON ap.id = r.applicant_id
+        WHERE r.course_rank <= r.vacancies
+    )
+    UPDATE attendance
+    SET waiting = false,
+        enrolled_at = :now,
+        signoff_window = :signoff_window,
+        discount = selected.discount,
+        informed_about_rejection = true
+    FROM selected
+    WHERE selected.applicant_rank = 1
+      AND attendance.applicant_id = selected.applicant_id
+      AND attendance.course_id = selected.course_id
+    RETURNING attendance.applicant_id, attendance.course_id, attendance.discount, selected.informed_about_rejection
+'''.format(open_waiting=OPEN_WAITING, parallel=ACTIVE_IN_PARALLEL_COURSE, accepted=ACCEPTED_IN_THIS_ROUND))
+
+# parallel candidates are only marked, they do not get a mail
+MARK_PARALLEL = text('''
+    WITH {open_waiting}
+    UPDATE attendance
+    SET informed_about_rejection = true
+    FROM open_waiting w
+    WHERE attendance.applicant_id = w.applicant_id
+      AND attendance.course_id = w.course_id
+      AND NOT w.informed_about_rejection
+      AND {parallel}
+      AND NOT {accepted}
+    RETURNING attendance.applicant_id, attendance.course_id
+'''.format(open_waiting=OPEN_WAITING, parallel=ACTIVE_IN_PARALLEL_COURSE, accepted=ACCEPTED_IN_THIS_ROUND))
+
+REJECT = text('''
+    WITH {open_waiting}
+    UPDATE attendance
+    SET informed_about_rejection = true
+    FROM open_waiting w
+    JOIN course c ON c.id = w.course_id
+    LEFT JOIN active ON active.course_id = w.course_id
+    WHERE attendance.applicant_id = w.applicant_id
+      AND attendance.course_id = w.course_id
+      AND NOT w.informed_about_rejection
+      AND c."limit" - coalesce(active.n, 0) <= 0
+      AND NOT {parallel}
+      AND NOT {accepted}
+    RETURNING attendance.applicant_id, attendance.course_id
+'''.format(open_waiting=OPEN_WAITING, parallel=ACTIVE_IN_PARALLEL_COURSE, accepted=ACCEPTED_IN_THIS_ROUND))
+
+DEFERRED = text('''
+    WITH {open_waiting}
+    SELECT w.applicant_id, w.course_id
+    FROM open_waiting w
+    WHERE {accepted}
+'''.format(open_waiting=OPEN_WAITING, accepted=ACCEPTED_IN_THIS_ROUND))
+
+REMAINING = text('''
+    SELECT c.id, c."limit" - count(a.applicant_id)
+    FROM course c
+    LEFT JOIN attendance a ON a.course_id = c.id AND a.waiting = false
+    WHERE c.id = ANY(:course_ids)
+    GROUP BY c.id
+''')
+
+
+def fcfs(time, course_ids=None):
+    """Run one FCFS round. The caller is responsible for the commit.
+
+       :param time: current UTC time
+       :param course_ids: only consider the waiting lists of these courses, all if None
+       :return: tuple of the summary of the decisions, see :py:func:`spz.allocation.summarize`, and the list of
+                `(applicant_id, course_id, informed_before_now)` for every handled attendance
+    """
+    now, signoff_window = enrollment_times()
+    params = dict(
+        time=time,
+        now=now,
+        signoff_window=signoff_window,
+        free=models.Attendance.MAX_DISCOUNT,
+        reduced=models.Attendance.MAX_DISCOUNT / 2,
+        all_courses=course_ids is None,
+        course_ids=list(course_ids or [])
+    )
+
+    accepted = []
+    while True:
+        rows = db.session.execute(ACCEPT, params).fetchall()
+        if not rows:
+            break
+        accepted.extend(rows)
+    if accepted:
+        counters.count_bookings(now)
+
+    parallel = db.session.execute(MARK_PARALLEL, params).fetchall()
+    rejected = db.session.execute(REJECT, params).fetchall()
+    deferred = db.session.execute(DEFERRED, params).fetchall()
+
+    log_bookings([(applicant_id, course_id) for applicant_id, course_id, _, _ in accepted], now)
+
+    fill = {}
+    for _, course_id, _, _ in accepted:
+        fill[course_id] = fill.get(course_id, 0) + 1
+    remaining = dict(db.session.execute(REMAINING, dict(course_ids=list(fill))).fetchall()) if fill else {}
+
+    summary = dict(
+        accepted=[[applicant_id, course_id, float(discount)] for applicant_id, course_id, discount, _ in accepted],
+        rejected=[[applicant_id, course_id] for applicant_id, course_id in rejected],
+        parallel=[[applicant_id, course_id] for applicant_id, course_id in parallel],
+        deferred=[[applicant_id, course_id] for applicant_id, course_id in deferred],
+        mails=[[applicant_id, course_id, informed] for applicant_id, course_id, _, informed in accepted] +
+              [[applicant_id, course_id, False] for applicant_id, course_id in rejected],
+        fill={str(course_id): [n, remaining[course_id]] for course_id, n in fill.items()}
+    )
+    handled = [(applicant_id, course_id, informed) for applicant_id, course_id, informed in summary['mails']]
+
+    return summary, handled
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""Bulk import of sticky approvals from uploaded files.
+
+   Files are either Ilias exports or self-made lists of `tag;percent`. They are parsed while streaming into one
+   column of tags and one of percentages. Every distinct tag is hashed once, on a pool of `APPROVAL_IMPORT_PROCESSES`
+   processes for large files, and the approvals are inserted with bulk statements instead of ORM objects.
+"""
+
+import csv
+from array import array
+
+from spz import app, db, models
+from spz.taghash import hash_all, normalize
+
+
+# header lines of the Ilias exports, in German and English
+HEADERS = ('"Name";"Benutzername";"Matrikelnummer"', '"Name";"Login";"Matriculation number"')
+
+INSERT_BATCH_SIZE = 5000
+
+
+def read_lines(fp):
+    """Stream the non-empty lines of an uploaded file, without header lines."""
+    for line in fp:
+        line = line.decode('utf-8', 'ignore').strip()
+        if line and not line.startswith(HEADERS):
+            yield line
+
+
+def parse(fp, ilias_export):
+    """Parse an uploaded file column-wise.
+
+       :param fp: binary file object
+       :param ilias_export: whether the file is an Ilias export, a self-made list of `tag;percent` otherwise
+       :return: tuple of the list of normalized tags and the array of their percentages
+       :raises ValueError: if a number cannot be parsed
+       :raises IndexError: if a line has too few columns
+       :raises OverflowError: if a percentage is out of range
+    """
+    tags = []
+    percents = array('B')
+    for row in csv.reader(read_lines(fp), delimiter=';'):  # XXX: hardcoded?
+        if ilias_export:
+            # test if all params are existent, if not skip entry
+            if row[1] == '' or row[3] == '' or row[4] == '':
+                continue
+            percent = max(0, min(int(100 * int(row[3]) / int(row[4])), 100))
+            # set tag depending if an immatriculation number is existing. If not set tag to account name
+            tag = row[2] or row[1]
+        else:
+            percent = int(row[1])
+            tag = row[0]
+        tags.append(normalize(tag))
+        percents.append(percent)
+    return tags, percents
+
+
+def insert(tags, percents, priority, delete_old=False):
+    """Insert sticky approvals, the caller is responsible for the commit.
+
+       :param tags: normalized tags, as returned by :py:func:`parse`
+       :param percents: percentages of the tags
+       :param priority: whether the approvals are priority entries
+       :param delete_old: delete the sticky approvals of the same priority first
+       :return: tuple of the numbers of deleted and added approvals
+    """
+    # hash before touching the table, to keep the transaction short
+    salted = hash_all(models.hash_secret_weak, set(tags), app.config['APPROVAL_IMPORT_PROCESSES'])
+
+    deleted = 0
+    if delete_old:
+        # only remove sticky entries because background jobs manage the others
+        deleted = models.Approval.query.filter(
+            models.Approval.sticky == True,  # NOQA
+            models.Approval.priority == priority
+        ).delete(synchronize_session=False)
+
+    table = models.Approval.__table__
+    for i in range(0, len(tags), INSERT_BATCH_SIZE):
+        db.session.execute(table.insert(), [
+            dict(tag_salted=salted[tag], percent=percent, sticky=True, priority=priority)
+            for tag, percent in zip(tags[i:i + INSERT_BATCH_SIZE], percents[i:i + INSERT_BATCH_SIZE])
+        ])
+
+    # the bulk statements bypassed the per-flush refresh of the summary
+    models.ApprovalSummary.refresh(None if deleted else salted.values())
+    return deleted, len(tags)
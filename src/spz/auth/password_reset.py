@@ -1,26 +1,22 @@
 from datetime import datetime, timedelta, timezone
 from spz import app, tasks
 from flask import render_template, url_for, flash
-from flask_mail import Message
 
 import jwt
 
 
 def send_password_reset_to_user(user):
-    message = Message(
-        sender=app.config['PRIMARY_MAIL'],
-        recipients=[user.email],
-        subject='[Sprachenzentrum] Passwort festlegen',
-        body=render_template(
+    tasks.plain_mail.delay(
+        app.config['PRIMARY_MAIL'],
+        [user.email],
+        '[Sprachenzentrum] Passwort festlegen',
+        render_template(
             'mails/auth/passwordresetmail.html',
             password_reset_link=app.config['SPZ_URL'] + url_for('reset_password',
                                                                 reset_token=get_password_reset_token_for_user(user))
-        ),
-        charset='utf-8'
+        )
     )
 
-    tasks.send_quick.delay(message)
-
 
 def get_password_reset_token_for_user(user):
     return jwt.encode({'reset_password': user.id, 'exp': datetime.now(timezone.utc) + timedelta(days=3)},
@@ -6,6 +6,8 @@
 """
 
 import json
+import os
+import tempfile
 from datetime import timedelta
 
 from kombu import Queue
@@ -35,11 +37,17 @@ class BaseConfig(object):
     SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 5}
     SQLALCHEMY_TRACK_MODIFICATIONS = True
 
+    # 'memory' runs the populate procedures on an in-memory snapshot, 'sql' runs FCFS set-based inside PostgreSQL
+    POPULATE_BACKEND = 'memory'
+    # recorded lottery rounds are kept this long for replays, see `spz.models.PopulateRun`
+    POPULATE_RUN_TTL = timedelta(days=365)
+
     CELERY_BROKER_URL = 'redis://redis:6379'
     CELERY_RESULT_BACKEND = 'redis://redis:6379'
-    CELERY_ACCEPT_CONTENT = ['pickle']
-    CELERY_TASK_SERIALIZER = 'pickle'
-    CELERY_RESULT_SERIALIZER = 'pickle'
+    # pickle is only accepted for `send_slow` and `send_quick`, which still take whole `flask_mail.Message` objects
+    CELERY_ACCEPT_CONTENT = ['json', 'pickle']
+    CELERY_TASK_SERIALIZER = 'json'
+    CELERY_RESULT_SERIALIZER = 'json'
     CELERY_DEFAULT_QUEUE = 'default'
     CELERY_QUEUES = (
         Queue('default', routing_key='default'),
@@ -50,6 +58,22 @@ class BaseConfig(object):
             'queue': 'slow_mails',
             'routing_key': 'slow_mails'
         },
+        'spz.tasks.send_status_mails': {
+            'queue': 'slow_mails',
+            'routing_key': 'slow_mails'
+        },
+        'spz.tasks.status_mail': {
+            'queue': 'slow_mails',
+            'routing_key': 'slow_mails'
+        },
+        'spz.tasks.notification_mails': {
+            'queue': 'slow_mails',
+            'routing_key': 'slow_mails'
+        },
+        'spz.tasks.plain_mail': {
+            'queue': 'default',
+            'routing_key': 'default'
+        },
         'spz.tasks.send_quick': {
             'queue': 'default',
             'routing_key': 'default'
@@ -62,6 +86,34 @@ class BaseConfig(object):
             'queue': 'default',
             'routing_key': 'default'
         },
+        'spz.tasks.ingest_signups': {
+            'queue': 'default',
+            'routing_key': 'default'
+        },
+        'spz.tasks.purge_oauth_tokens': {
+            'queue': 'default',
+            'routing_key': 'default'
+        },
+        'spz.tasks.purge_populate_runs': {
+            'queue': 'default',
+            'routing_key': 'default'
+        },
+        'spz.tasks.warm_mail_domains': {
+            'queue': 'default',
+            'routing_key': 'default'
+        },
+        'spz.tasks.import_registrations': {
+            'queue': 'default',
+            'routing_key': 'default'
+        },
+        'spz.tasks.hash_registrations': {
+            'queue': 'default',
+            'routing_key': 'default'
+        },
+        'spz.tasks.apply_registrations': {
+            'queue': 'default',
+            'routing_key': 'default'
+        },
     }
     CELERY_TIMEZONE = 'UTC'  # like everything else
     CELERYBEAT_SCHEDULE = {
@@ -69,10 +121,31 @@ class BaseConfig(object):
             'task': 'spz.tasks.populate',
             'schedule': timedelta(minutes=5)
         },
+        'populate_full': {
+            'task': 'spz.tasks.populate',
+            'schedule': timedelta(hours=1),
+            'kwargs': {'full': True}  # safety net for the incremental runs above
+        },
         'sync_ilias': {
             'task': 'spz.tasks.sync_ilias',
             'schedule': timedelta(minutes=15)
         },
+        'ingest_signups': {
+            'task': 'spz.tasks.ingest_signups',
+            'schedule': timedelta(seconds=10)
+        },
+        'purge_oauth_tokens': {
+            'task': 'spz.tasks.purge_oauth_tokens',
+            'schedule': timedelta(minutes=15)
+        },
+        'purge_populate_runs': {
+            'task': 'spz.tasks.purge_populate_runs',
+            'schedule': timedelta(days=1)
+        },
+        'warm_mail_domains': {
+            'task': 'spz.tasks.warm_mail_domains',
+            'schedule': timedelta(hours=12)  # well within MAIL_DOMAIN_TTL
+        },
     }
 
     BABEL_DEFAULT_LOCALE = 'de'
@@ -87,10 +160,18 @@ class BaseConfig(object):
     MAIL_PASSWORD = None
     MAIL_DEFAULT_SENDER = "spz-signup"
     MAIL_MAX_EMAILS = 10
+    MAIL_BATCH_SIZE = 50  # status mails per task after populate runs
+    MAIL_BCC_BATCH_SIZE = 50  # recipients per notification mail
     MAIL_SUPPRESS_SEND = False
     MAIL_MAX_ATTACHMENT_SIZE = 1024 * 1024 * 8  # 8MB
 
+    # deliverability of mail domains, see `spz.maildomains`
+    MAIL_DOMAIN_TTL = 60 * 60 * 24  # seconds
+    MAIL_DOMAIN_NEGATIVE_TTL = 60 * 10  # seconds; short, a typo in a new domain may get fixed
+    MAIL_DOMAIN_WARM_LIMIT = 500  # most frequent applicant domains kept warm
+
     CACHE_CONFIG = {'CACHE_TYPE': 'simple', 'CACHE_DEFAULT_TIMEOUT': 30}
+    FRAGMENT_CACHE_TIMEOUT = 60 * 5  # seconds; versioned keys make changes show up right away, see `spz.fragments`
 
     PRIMARY_MAIL = 'no-reply@spz.kit.edu'
 
@@ -124,17 +205,49 @@ class BaseConfig(object):
     # maximum amount of vacancies, a course with 'little vacancies' may have
     LITTLE_VACANCIES = 5
 
+    # admission queue at the signup openings of busy languages, see `spz.admission`
+    ADMISSION_RATES = {}  # language name -> signups admitted per second, e.g. {'Englisch': 5}; others are not queued
+    ADMISSION_BURST = 50  # signups admitted right at the opening
+    ADMISSION_WINDOW = timedelta(hours=2)  # how long after an opening the queue stays active
+    ADMISSION_CONCURRENCY = 4  # signup submissions processed at once per worker process
+    ADMISSION_TIMEOUT = 10  # seconds a submission waits for a free slot
+
+    # write-behind signups in the random window, see `spz.ingest`
+    SIGNUP_INGEST = False
+    SIGNUP_INGEST_BATCH_SIZE = 500  # signups inserted per transaction
+    SIGNUP_INGEST_LOCK_TIMEOUT = 60  # seconds until a crashed ingest run no longer blocks the next one
+
+    # process-wide memo of tag hashes, see `spz.taghash`; entries expire to not keep cleartext tags around forever
+    TAG_HASH_CACHE_SIZE = 10000
+    TAG_HASH_CACHE_TTL = 60 * 60  # seconds
+
+    # processes that hash the tags of large approval imports, see `spz.approval_import`
+    APPROVAL_IMPORT_PROCESSES = min(4, os.cpu_count() or 1)
+
+    # background import of the registration numbers, see `spz.registration_import`
+    REGISTRATION_IMPORT_CHUNK_SIZE = 2000  # registration numbers hashed per task
+    REGISTRATION_IMPORT_TTL = 60 * 60  # seconds until a stuck import no longer blocks the next one
+
     # data for ilias sync
     ILIAS_URL = 'https://scc-ilias-plugins.scc.kit.edu/'
     ILIAS_USERNAME = 'soap_spz'
     ILIAS_PASSWORD = 'mysecretpassword'
     ILIAS_REFID = '123'
+    ILIAS_TIMEOUT = (10, 60)  # seconds to connect and between two reads of a response
+    ILIAS_RETRIES = 3  # retries of failed connections and gateway errors per request
+    ILIAS_SYNC_FINGERPRINT_TTL = 60 * 60 * 24  # seconds until an unchanged export gets applied again
 
     # config for Open ID Connect authentication
     SPZ_URL = 'https://anmeldung.spz.kit.edu'
     CLIENT_ID = 'anmeldung-spz-kit-edu'
     # !!! Never upload secret to gitHub !!! set to 'myclientsecret'
     CLIENT_SECRET = 'myclientsecret'
+    # the discovery document is fetched on first use and cached, see `spz.oidc.oid_handler.Discovery`
+    OIDC_DISCOVERY_TTL = 60 * 60 * 24  # seconds until a background refresh
+    OIDC_DISCOVERY_FILE = os.path.join(tempfile.gettempdir(), 'spz-oidc-discovery.json')
+    OIDC_TIMEOUT = 10  # seconds per request to the identity provider
+    OIDC_POOL_SIZE = 10  # connections kept open to the identity provider per process
+    OAUTH_TOKEN_TTL = timedelta(hours=2)  # time from the redirect to the KIT until the signup has to be submitted
 
 
 class Development(BaseConfig):
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""Maintains the denormalized attendance counters of :py:class:`spz.models.Course`.
+
+   Every flushed change of an attendance is turned into an increment of the counters of its course, so concurrent
+   transactions do not lose updates. Bulk statements that bypass the ORM have to call :py:func:`count_bookings` or
+   :py:func:`count_waiting`. :py:func:`rebuild` recomputes the counters from scratch, see :py:mod:`spz.setup.counters`.
+"""
+
+from sqlalchemy import case, event, inspect, text
+from sqlalchemy.orm import object_session
+from sqlalchemy.sql.expression import bindparam
+
+from spz import db, models
+
+
+COUNTERS = ['active_count', 'waiting_count', 'unpaid_count', 'free_count']
+
+_course = models.Course.__table__
+
+ADJUST = _course.update() \
+    .where(_course.c.id == bindparam('b_course_id')) \
+    .values(
+        active_count=_course.c.active_count + bindparam('b_active'),
+        waiting_count=_course.c.waiting_count + bindparam('b_waiting'),
+        free_count=_course.c.free_count + bindparam('b_free'),
+        # same as `Attendance.is_unpaid`, but the price is taken from the course row
+        unpaid_count=_course.c.unpaid_count + case(
+            [(
+                (1 - bindparam('b_discount', type_=db.Numeric) / models.Attendance.MAX_DISCOUNT) * _course.c.price -
+                bindparam('b_amountpaid', type_=db.Numeric) > 0,
+                bindparam('b_active')
+            )],
+            else_=0
+        )
+    )
+
+# the active part of `ACTUAL` for attendances that got booked by populate at `:now`
+BOOKED = text('''
+    UPDATE course
+    SET active_count = active_count + booked.active,
+        waiting_count = waiting_count - booked.active,
+        unpaid_count = unpaid_count + booked.unpaid,
+        free_count = free_count + booked.free
+    FROM (
+        SELECT a.course_id,
+               count(*) AS active,
+               count(*) FILTER (
+                   WHERE (1 - coalesce(a.discount, 0) / :max_discount) * c.price - a.amountpaid > 0
+               ) AS unpaid,
+               count(*) FILTER (WHERE a.discount = :max_discount) AS free
+        FROM attendance a
+        JOIN course c ON c.id = a.course_id
+        WHERE a.waiting = false
+          AND a.enrolled_at = :now
+        GROUP BY a.course_id
+    ) booked
+    WHERE course.id = booked.course_id
+''')
+
+ACTUAL = '''
+    SELECT c.id AS course_id,
+           count(a.applicant_id) FILTER (WHERE a.waiting = false) AS active_count,
+           count(a.applicant_id) FILTER (WHERE a.waiting = true) AS waiting_count,
+           count(a.applicant_id) FILTER (
+               WHERE a.waiting = false
+                 AND (1 - coalesce(a.discount, 0) / :max_discount) * c.price - a.amountpaid > 0
+           ) AS unpaid_count,
+           count(a.applicant_id) FILTER (WHERE a.waiting = false AND a.discount = :max_discount) AS free_count
+    FROM course c
+    LEFT JOIN attendance a ON a.course_id = c.id
+    WHERE :all_courses OR c.id = ANY(:course_ids)
+    GROUP BY c.id
+'''
+
+REBUILD = text('''
+    UPDATE course
+    SET active_count = actual.active_count,
+        waiting_count = actual.waiting_count,
+        unpaid_count = actual.unpaid_count,
+        free_count = actual.free_count
+    FROM ({actual}) actual
+    WHERE course.id = actual.course_id
+'''.format(actual=ACTUAL))
+
+CHECK = text('''
+    SELECT actual.course_id,
+           course.active_count, course.waiting_count, course.unpaid_count, course.free_count,
+           actual.active_count, actual.waiting_count, actual.unpaid_count, actual.free_count
+    FROM ({actual}) actual
+    JOIN course ON course.id = actual.course_id
+    WHERE (course.active_count, course.waiting_count, course.unpaid_count, course.free_count)
+       IS DISTINCT FROM (actual.active_count, actual.waiting_count, actual.unpaid_count, actual.free_count)
+    ORDER BY actual.course_id
+'''.format(actual=ACTUAL))
+
+
+def committed(target, key):
+    """Value of an attribute as it is in the database before the running flush."""
+    history = inspect(target).attrs[key].history
+    return history.deleted[0] if history.deleted else getattr(target, key)
+
+
+def adjust(connection, target, sign, waiting, discount, amountpaid):
+    """Add (`sign=1`) or remove (`sign=-1`) an attendance in the given state to the counters of its course."""
+    if waiting is None:
+        return  # counted neither as active nor as waiting, see `Course.filter_attendances`
+
+    active = sign if waiting is False else 0
+    connection.execute(
+        ADJUST,
+        b_course_id=target.course_id,
+        b_active=active,
+        b_waiting=sign if waiting is True else 0,
+        b_free=active if discount == models.Attendance.MAX_DISCOUNT else 0,
+        b_discount=discount or 0,
+        b_amountpaid=amountpaid or 0
+    )
+    object_session(target).info.setdefault('counted_courses', set()).add(target.course_id)
+
+
+def unflushed(session, course_id):
+    """Remember that attendances of a course changed, its counters are not up to date until the next flush."""
+    if session is not None and course_id is not None:
+        session.info.setdefault('unflushed_courses', set()).add(course_id)
+
+
+def count_bookings(now):
+    """Count attendances that got booked by a bulk statement, with `enrolled_at` set to `now`."""
+    db.session.execute(BOOKED, dict(now=now, max_discount=models.Attendance.MAX_DISCOUNT))
+
+
+def count_waiting(numbers):
+    """Count waiting attendances that got inserted by a bulk statement.
+
+       :param numbers: dict of course ID to the number of inserted attendances
+    """
+    if numbers:
+        db.session.execute(ADJUST, [
+            dict(b_course_id=course_id, b_active=0, b_waiting=number, b_free=0, b_discount=0, b_amountpaid=0)
+            for course_id, number in numbers.items()
+        ])
+
+
+def rebuild(course_ids=None):
+    """Recompute the counters, the caller is responsible for the commit.
+
+       :param course_ids: IDs of the courses to rebuild, all if None
+    """
+    db.session.execute(REBUILD, dict(
+        max_discount=models.Attendance.MAX_DISCOUNT,
+        all_courses=course_ids is None,
+        course_ids=list(course_ids or [])
+    ))
+
+
+def check():
+    """Compare the counters with the actual attendances.
+
+       :return: list of `(course_id, stored, actual)` for every course whose counters are off, where stored and
+                actual are tuples in the order of :py:data:`COUNTERS`
+    """
+    rows = db.session.execute(CHECK, dict(max_discount=models.Attendance.MAX_DISCOUNT, all_courses=True, course_ids=[]))
+    return [(row[0], tuple(row[1:5]), tuple(row[5:9])) for row in rows]
+
+
+@event.listens_for(models.Attendance, 'after_insert')
+def evt_insert_attendance(_mapper, connection, target):
+    adjust(connection, target, 1, target.waiting, target.discount, target.amountpaid)
+
+
+@event.listens_for(models.Attendance, 'after_delete')
+def evt_delete_attendance(_mapper, connection, target):
+    adjust(
+        connection, target, -1,
+        committed(target, 'waiting'), committed(target, 'discount'), committed(target, 'amountpaid')
+    )
+
+
+@event.listens_for(models.Attendance, 'after_update')
+def evt_update_attendance(_mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[key].history.has_changes() for key in ('waiting', 'discount', 'amountpaid')):
+        return
+    adjust(
+        connection, target, -1,
+        committed(target, 'waiting'), committed(target, 'discount'), committed(target, 'amountpaid')
+    )
+    adjust(connection, target, 1, target.waiting, target.discount, target.amountpaid)
+
+
+@event.listens_for(models.Attendance.course, 'set')
+def evt_set_attendance_course(_target, value, oldvalue, _initiator):
+    # the course of a new attendance, its `course_id` is only set by the flush
+    for course in (value, oldvalue):
+        if isinstance(course, models.Course):
+            unflushed(object_session(course), course.id)
+
+
+@event.listens_for(models.Attendance.course_id, 'set')
+def evt_set_attendance_course_id(target, value, _oldvalue, _initiator):
+    session = object_session(target)
+    unflushed(session, target.course_id)
+    unflushed(session, value)
+
+
+@event.listens_for(models.Attendance.waiting, 'set')
+@event.listens_for(models.Attendance.discount, 'set')
+@event.listens_for(models.Attendance.amountpaid, 'set')
+def evt_change_attendance(target, _value, _oldvalue, _initiator):
+    unflushed(object_session(target), target.course_id)
+
+
+@event.listens_for(models.Applicant.attendances, 'remove')
+def evt_remove_attendance(_target, value, _initiator):
+    # the orphan is only deleted by the flush
+    unflushed(object_session(value), value.course_id)
+
+
+@event.listens_for(db.session, 'transient_to_pending')
+def evt_add_attendance(session, instance):
+    if isinstance(instance, models.Attendance):
+        unflushed(session, instance.course_id)
+
+
+@event.listens_for(models.Course, 'after_update')
+def evt_update_course(_mapper, connection, target):
+    if inspect(target).attrs.price.history.has_changes():
+        # every unpaid flag may have changed, rare enough for a full recount of this course
+        connection.execute(REBUILD, max_discount=models.Attendance.MAX_DISCOUNT, all_courses=False,
+                           course_ids=[target.id])
+        object_session(target).info.setdefault('counted_courses', set()).add(target.id)
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def evt_expire_counters(session, _flush_context):
+    session.info.pop('unflushed_courses', None)
+    counted = session.info.pop('counted_courses', set())
+    for course_id in counted:
+        course = session.identity_map.get(inspect(models.Course).identity_key_from_primary_key([course_id]))
+        if course is not None:
+            session.expire(course, COUNTERS)
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def evt_forget_unflushed(session):
+    session.info.pop('unflushed_courses', None)
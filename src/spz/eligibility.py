@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""Signup eligibility of an applicant for a course.
+
+   Evaluates the rules of the signup views with a single prefetch query, instead of one or more queries per rule.
+   The views decide which rules may be overridden and how to word the violations.
+"""
+
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+from spz import app, db, models
+
+
+# everything about the applicant the rules need, evaluated against the committed state
+FACTS = text('''
+    SELECT
+        EXISTS (
+            SELECT 1 FROM attendance WHERE applicant_id = :applicant_id AND course_id = :course_id
+        ) AS in_course,
+        EXISTS (
+            SELECT 1
+            FROM attendance a
+            JOIN course c ON c.id = a.course_id
+            JOIN course t ON t.id = :course_id
+            WHERE a.applicant_id = :applicant_id
+              AND a.waiting = false
+              AND c.id != t.id
+              AND c.language_id = t.language_id
+              AND (c.level = t.level OR c.level = ANY(t.collision) OR t.level = ANY(c.collision))
+        ) AS active_in_parallel_course,
+        (
+            SELECT count(*)
+            FROM attendance a
+            JOIN course c ON c.id = a.course_id
+            JOIN language l ON l.id = c.language_id
+            WHERE a.applicant_id = :applicant_id
+              AND l.signup_end >= :now
+        ) AS running,
+        EXISTS (
+            SELECT 1 FROM applicant WHERE tag = :tag AND mail != :mail
+        ) AS has_doppelgangers,
+        (
+            SELECT coalesce(best_priority, best_normal) FROM approval_summary WHERE tag_salted = :tag_salted
+        ) AS best_rating
+''')
+
+
+class Verdict:
+    """Outcome of the signup rules, every attribute is True if its rule is satisfied.
+
+       :param tag_submitted: a tag was given if the course has rating restrictions
+       :param allowed: the best rating of the applicant is within the rating range of the course
+       :param not_attending: neither signed up for the course nor active in a parallel course
+       :param below_limit: the applicant has less running attendances than `MAX_ATTENDANCES`
+       :param no_doppelgangers: no other applicant uses the same tag
+       :param not_overbooked: the course is not overbooked
+    """
+
+    RULES = ['tag_submitted', 'allowed', 'not_attending', 'below_limit', 'no_doppelgangers', 'not_overbooked']
+
+    def __init__(self, tag_submitted, allowed, not_attending, below_limit, no_doppelgangers, not_overbooked):
+        self.tag_submitted = tag_submitted
+        self.allowed = allowed
+        self.not_attending = not_attending
+        self.below_limit = below_limit
+        self.no_doppelgangers = no_doppelgangers
+        self.not_overbooked = not_overbooked
+
+    def __repr__(self):
+        return '<Verdict {}>'.format(' '.join('{}={}'.format(rule, getattr(self, rule)) for rule in self.RULES))
+
+    @property
+    def violations(self):
+        return [rule for rule in self.RULES if not getattr(self, rule)]
+
+    @property
+    def passed(self):
+        return not self.violations
+
+
+def check(applicant, course, time=None):
+    """Evaluate all signup rules for an applicant and a course.
+
+       :param applicant: existing or new :py:class:`spz.models.Applicant`
+       :param course: the :py:class:`spz.models.Course` to sign up for
+       :param time: reference time for running attendances, defaults to now
+       :return: :py:class:`Verdict`
+    """
+    time = time or datetime.now(timezone.utc).replace(tzinfo=None)
+    tag_submitted = bool(applicant.has_submitted_tag())
+
+    facts = db.session.execute(FACTS, dict(
+        applicant_id=applicant.id,
+        course_id=course.id,
+        now=time,
+        tag=applicant.tag if tag_submitted else None,
+        mail=applicant.mail,
+        tag_salted=models.Approval.cleartext_to_salted(applicant.tag)
+    )).first()
+    best_rating = facts.best_rating or 0
+
+    return Verdict(
+        tag_submitted=not course.has_rating_restrictions() or tag_submitted,
+        allowed=course.rating_lowest <= best_rating <= course.rating_highest,
+        not_attending=not facts.in_course and not facts.active_in_parallel_course,
+        below_limit=facts.running < app.config['MAX_ATTENDANCES'],
+        no_doppelgangers=not facts.has_doppelgangers,
+        not_overbooked=not course.is_overbooked
+    )
@@ -3,8 +3,13 @@
 """Export module for course lists.
 """
 
+from itertools import groupby
+from operator import attrgetter
+
 from flask import make_response
-from spz import app
+from sqlalchemy import case, func, not_
+
+from spz import app, loading, models
 
 
 class TemplatedWriter:
@@ -62,18 +67,58 @@ course_formatters = {
 }
 
 
+ATTENDANCE_BATCH_SIZE = 500  # attendances loaded at once while exporting
+
+
 def init_formatter(lookup_table, format):
     return lookup_table.get(format.formatter)(format.template)
 
 
+def active_attendances(courses, passed=False):
+    """Active attendances of the courses, sorted like `Course.course_list`, streamed from one query.
+
+       :param courses: courses to export
+       :param passed: only attendances with a passing grade
+       :return: generator of `(course, attendances)` in the order of `courses`, the attendances of a course can only
+                be iterated until the next course is taken
+    """
+    positions = {}
+    for course in courses:
+        positions.setdefault(course.id, len(positions))
+    if not positions:
+        return
+
+    query = models.Attendance.query \
+        .join(models.Attendance.applicant) \
+        .options(*loading.EXPORT_ATTENDANCES) \
+        .filter(models.Attendance.course_id.in_(positions), not_(models.Attendance.waiting)) \
+        .order_by(
+            case(positions, value=models.Attendance.course_id),
+            # byte order like the comparison of Python strings, not the collation of the database
+            func.lower(models.Applicant.last_name).collate('C'),
+            func.lower(models.Applicant.first_name).collate('C'),
+            models.Applicant.id
+        )
+    if passed:
+        query = query.filter(models.Attendance.grade >= 50)
+
+    groups = groupby(query.yield_per(ATTENDANCE_BATCH_SIZE), key=attrgetter('course_id'))
+    course_id, attendances = next(groups, (None, ()))
+    for course in courses:
+        if course.id == course_id:
+            yield course, attendances
+            course_id, attendances = next(groups, (None, ()))
+        else:
+            yield course, ()
+
+
 def export_course_list(courses, format, filename='Kursliste'):
     formatter = init_formatter(course_formatters, format)
     filename = specify_export_name(courses)
-    for course in courses:
+    for course, attendances in active_attendances(courses):
         formatter.begin_section(course.full_name)
-        for applicant in course.course_list:
-            attendance = course.get_course_attendance(course.id, applicant.id)
-            formatter.write_element(dict(course=course, applicant=applicant, attendance=attendance))
+        for attendance in attendances:
+            formatter.write_element(dict(course=course, applicant=attendance.applicant, attendance=attendance))
         formatter.set_course_information(course)
         formatter.end_section(course.full_name)
 
@@ -83,17 +128,17 @@ def export_course_list(courses, format, filename='Kursliste'):
 
     return resp
 
+
 def export_overview_list(language, format, passed=False):
     semester = app.config['SEMESTER_NAME_SHORT']
     formatter = init_formatter(course_formatters, format)
     filename = f"Gesamtliste_{language.name}"
     formatter.begin_section(language.name)
-    for course in language.courses:
-        for applicant in course.course_list:
-            attendance = course.get_course_attendance(course.id, applicant.id)
-            if passed and (attendance.grade is None or attendance.grade < 50):
-                    continue
-            formatter.write_element(dict(course=course, applicant=applicant, attendance=attendance, semester=semester))
+    for course, attendances in active_attendances(language.courses, passed):
+        for attendance in attendances:
+            formatter.write_element(
+                dict(course=course, applicant=attendance.applicant, attendance=attendance, semester=semester)
+            )
     formatter.end_section(language.name)
 
     resp = make_response(formatter.get_data())
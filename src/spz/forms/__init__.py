@@ -21,7 +21,7 @@ from flask_ckeditor import CKEditorField
 
 from wtforms.validators import DataRequired
 
-from spz import app, models, token
+from spz import app, db, models, token, loading
 
 from . import cached, validators
 
@@ -456,23 +456,37 @@ class VacanciesForm(FlaskForm):
         self.language_filter.choices = cached.languages_to_choicelist()
         self.ger_filter.choices = cached.gers_to_choicelist()
 
-    def get_courses(self):
+    def get_languages(self):
+        now = datetime.now(timezone.utc)
+        return models.Language.query \
+            .filter(models.Language.signup_begin <= now, models.Language.signup_end >= now) \
+            .order_by(models.Language.name) \
+            .all()
+
+    def get_courses(self, language=None):
+        now = datetime.now(timezone.utc)
         courses = models.Course.query \
             .join(models.Language) \
             .order_by(models.Language.name) \
             .order_by(models.Course.ger) \
             .order_by(models.Course.vacancies) \
-            .filter(and_(
-            or_(
-                not_(models.Course.is_full),
-                and_(
-                    models.Course.is_full,
-                    models.Course.count_attendances(waiting=True) <= app.config['SHORT_WAITING_LIST'])
-            )),
-            and_(models.Language.signup_begin <= datetime.now(timezone.utc), models.Language.signup_end >= datetime.now(timezone.utc))
-        ) \
-            .all()
-        return itertools.groupby(courses, lambda course: (course.language, course.ger))
+            .filter(
+                or_(
+                    not_(models.Course.is_full),
+                    and_(
+                        models.Course.is_full,
+                        models.Course.count_attendances(waiting=True) <= app.config['SHORT_WAITING_LIST']
+                    )
+                ),
+                models.Language.signup_begin <= now,
+                models.Language.signup_end >= now
+            )
+        if language is not None:
+            courses = courses.filter(models.Course.language_id == language.id)
+        return [
+            (key, list(group))
+            for key, group in itertools.groupby(courses, lambda course: (course.language, course.ger))
+        ]
 
     def has_courses(self):
         return True
@@ -543,19 +557,21 @@ class NotificationForm(FlaskForm):
         return models.Course.query.filter(models.Course.id.in_(self.mail_courses.data))
 
     def get_recipients(self):
-        def flatten(x):
-            return sum(x, [])
-
+        """Mail addresses of all attendances that match the filters, resolved in the database."""
         waiting = self.waiting_filter.data
         unpaid = self.unpaid_filter.data
 
-        recipients = set()  # One mail per recipient, even if in multiple recipient courses
-
-        for course in self.get_courses():
-            for attendance in course.filter_attendances(waiting=waiting, is_unpaid=unpaid):
-                recipients.add(attendance.applicant.mail)
+        query = db.session.query(models.Applicant.mail) \
+            .join(models.Attendance, models.Attendance.applicant_id == models.Applicant.id) \
+            .join(models.Course, models.Attendance.course_id == models.Course.id) \
+            .filter(models.Attendance.course_id.in_(self.mail_courses.data))
+        if waiting is not None:
+            query = query.filter(models.Attendance.waiting == waiting)
+        if unpaid is not None:
+            query = query.filter(models.Attendance.is_unpaid == unpaid)
 
-        return list(recipients)
+        # One mail per recipient, even if in multiple recipient courses
+        return [mail for mail, in query.distinct().order_by(models.Applicant.mail).yield_per(1000)]
 
     def get_body(self):
         return self.mail_body.data
@@ -862,7 +878,12 @@ class ExportCourseForm(FlaskForm):
         return models.ExportFormat.query.get(self.format.data)
 
     def get_selected(self):
-        return [models.Course.query.get(id) for id in self.courses.data]
+        courses = models.Course.query \
+            .filter(models.Course.id.in_(self.courses.data)) \
+            .options(*loading.EXPORT_COURSES) \
+            .all()
+        by_id = {course.id: course for course in courses}
+        return [by_id[id] for id in self.courses.data if id in by_id]
 
     def __init__(self, languages=[], *args, **kwargs):
         super(ExportCourseForm, self).__init__(*args, **kwargs)
@@ -907,7 +928,7 @@ class ExportOverviewForm(FlaskForm):
     )
 
     def get_selected(self):
-        return models.Language.query.get(self.language.data)
+        return models.Language.query.options(*loading.EXPORT_LANGUAGE).get(self.language.data)
 
     def get_format(self):
         return models.ExportFormat.query.get(self.format.data)
@@ -10,6 +10,7 @@ from datetime import datetime, timezone
 from spz import models, cache, db
 
 from sqlalchemy import distinct
+from sqlalchemy.orm import contains_eager
 
 from flask_babel import gettext as _
 
@@ -135,7 +136,8 @@ def upcoming_courses_to_choicelist():
 @cache.cached(key_prefix='all_courses')
 def all_courses_to_choicelist():
     courses = models.Course.query \
-        .join(models.Language.courses) \
+        .join(models.Course.language) \
+        .options(contains_eager(models.Course.language)) \
         .order_by(models.Language.name, models.Course.level, models.Course.alternative)
 
     return [
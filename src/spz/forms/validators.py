@@ -2,7 +2,6 @@
 
 """Validators used for different forms."""
 
-import dns
 import email_validator
 import phonenumbers
 
@@ -10,22 +9,20 @@ from wtforms.validators import *  # NOQA
 from wtforms.validators import ValidationError
 
 from spz import models
+from spz.maildomains import domains
 from spz.util.Filetype import size_from_filepointer
 
 
-# set LRU cache for DNS caching
-# TODO: use flask cache instead (LRU + timeout)
-dns.resolver.get_default_resolver().cache = dns.resolver.LRUCache()
-
-
 class EmailPlusValidator(object):
-    """Validates mail addresses including DNS check."""
+    """Validates mail addresses including DNS check, the result of which is shared via :py:mod:`spz.maildomains`."""
 
     def __call__(self, form, field):
         try:
-            email_validator.validate_email(field.data)
+            address = email_validator.validate_email(field.data, check_deliverability=False)
         except email_validator.EmailNotValidError:
             raise ValidationError('Ungültige E-Mail Adresse')
+        if not domains.is_deliverable(address.ascii_domain, address.domain):
+            raise ValidationError('Ungültige E-Mail Adresse')
 
 
 class MultiFilesFileSizeValidator(object):
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""Versions for the cached template fragments of the public pages.
+
+   Fragments are cached with the `{% cache %}` tag of Flask-Caching for `FRAGMENT_CACHE_TIMEOUT` seconds. Their keys
+   contain the version of the data they show, so populate runs and attendance changes invalidate them right away,
+   without deleting anything. CSRF tokens and :py:func:`spz.rlrc_comment` stay outside of the fragments.
+"""
+
+import hashlib
+
+from flask import g
+from sqlalchemy import text
+
+from spz import app, db
+
+
+# everything the course status depends on, see `Course.status`
+VERSIONS = text('''
+    SELECT language_id,
+           md5(string_agg(
+               concat_ws(':', id, "limit", active_count, waiting_count, has_waiting_list, revision), ','
+               ORDER BY id
+           ))
+    FROM course
+    GROUP BY language_id
+''')
+
+
+@app.template_global()
+def course_versions():
+    """Version of the courses and their counters per language ID, queried once per request."""
+    if 'course_versions' not in g:
+        g.course_versions = dict(db.session.execute(VERSIONS).fetchall())
+    return g.course_versions
+
+
+@app.template_global()
+def choices_version(field):
+    """Version of the choices of a select field."""
+    return hashlib.md5(repr(field.choices).encode('utf-8')).hexdigest()
@@ -2,15 +2,37 @@
 
 """Module that harvests approval data from Ilias.
 
+The sync only touches the database when the export changed: runs whose export has the fingerprint of the last
+applied one are skipped. Otherwise only the approvals that differ get inserted, updated or deleted. Salted tags are
+kept in Redis under a keyed digest of their tag, so only new tags need to be hashed. Every run reports its numbers
+and timings, see :py:func:`read_report`.
+
 .. code-block:: python
 """
 import csv
+import hashlib
+import hmac
+import json
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
 import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import bindparam
+from urllib3.util.retry import Retry
+
 from spz import app, db, models
+from spz.store import redis_client
 from bs4 import BeautifulSoup
 from urllib import parse
 
 
+FINGERPRINT_KEY = 'spz:ilias:fingerprint'
+SALTED_KEY = 'spz:ilias:salted'
+REPORT_KEY = 'spz:ilias:report'
+
+
 # headers that will be used for all Ilias HTTPS requests
 headers = {
     'Accept-Language': 'en-US,en;q=0.8,de-DE;q=0.5,de;q=0.3',
@@ -25,144 +47,185 @@ def get_export_parameters(html):
     return dict(parse.parse_qsl(parse.urlsplit(url).query))
 
 
-def download_data():
-    """Download relevant CSV data from Ilias.
+class Client(object):
+    """HTTP client for the test evaluation of Ilias.
 
-    Returns line->byte iterator."""
+       One keep-alive session carries the cookies from the login to the logout. Every request has a timeout, failed
+       connections and gateway errors are retried. The duration of every stage is recorded in `timings`.
 
-    username = app.config['ILIAS_USERNAME']
-    password = app.config['ILIAS_PASSWORD']
-    ref_id = app.config['ILIAS_REFID']
-    url = app.config['ILIAS_URL']
+       :param url: base URL of Ilias, with trailing slash
+    """
 
-    # get inital cookies
-    url0 = '{}login.php'.format(url)
-    r0 = requests.get(
-        url0,
-        headers=headers
-    )
-    assert r0.status_code == 200
-    cookies = r0.cookies
-
-    # login
-    url1 = '{}ilias.php'.format(url)
-    r1 = requests.post(
-        url1,
-        params={
-            'baseClass': 'ilStartUpGUI',
-            'client_id': 'pilot',
-            'cmd': 'post',
-            'cmdClass': 'ilstartupgui',
-            'cmdNode': '10b',
-            'lang': 'de',
-            'rtoken': '',
-        },
-        data={
-            'cmd[doStandardAuthentication]': 'Anmelden',
-            'password': password,
-            'username': username,
-        },
-        cookies=cookies,
-        headers=headers
-    )
-    assert r1.status_code == 200
-    assert 'Sprachenzentrum' in r1.text
-    cookies = r1.history[0].cookies  # use cookies of first request
-
-    # get bunch of metadata
-    url2 = '{}ilias.php'.format(url)
-    r2 = requests.get(
-        url2,
-        params={
-            'baseClass': 'ilrepositorygui',
-            'cmd': 'outEvaluation',
-            'cmdClass': 'iltestevaluationgui',
-            'cmdNode': 'x2:rm:13i',
-            'ref_id': ref_id,
-        },
-        cookies=cookies,
-        headers=headers
-    )
-    assert r2.status_code == 200
-    text2 = r2.text
-    # these tokens occur multiple times but seem to be unique
-    export_parameters = get_export_parameters(text2)
-    rtoken = export_parameters['rtoken']
-    active_id = export_parameters['active_id']
-
-    # prepare form / virtual table so we get all the information we need
-    # without this step, the "Matrikelnummer" won't be present.
-    # WARNING: this change is stateful (i.e. Ilias keeps track of it, not the URI / cookie / session storage / ...)
-    url3 = '{}ilias.php'.format(url)
-    r3 = requests.post(
-        url3,
-        params={
-            'baseClass': 'ilrepositorygui',
-            'cmd': 'post',
-            'cmdClass': 'iltestevaluationgui',
-            'cmdNode': 'x2:rm:13i',
-            'fallbackCmd': 'outEvaluation',
-            'ref_id': ref_id,
-            'rtoken': rtoken,
-        },
-        data={
-            'cmd[outEvaluation]': 'Aktualisieren',
-            'course': '',
-            'group': '',
-            'name': '',
-            'tblfshtst_eval_all': '1',
-            'tblfstst_eval_all[]': 'matriculation',
-            'tst_eval_all_table_nav': 'name:asc:0',
-            'tst_eval_all_table_nav1': 'name:asc:0',
-            'tst_eval_all_table_nav2': 'name:asc:0',
-        },
-        cookies=cookies,
-        headers=headers
-    )
-    assert r3.status_code == 200
-
-    # download file
-    url4 = '{}ilias.php'.format(url)
-    r4 = requests.post(
-        url4,
-        params={
-            'active_id': active_id,
-            'baseClass': 'ilrepositorygui',
-            'cmd': 'post',
-            'cmdClass': 'iltestevaluationgui',
-            'cmdNode': 'x2:rm:13i',
-            'fallbackCmd': 'exportEvaluation',
-            'ref_id': ref_id,
-            'rtoken': rtoken,
-        },
-        data={
-            'cmd[exportEvaluation]': 'Export',
-            'export_type': 'csv',
-        },
-        cookies=cookies,
-        headers=headers
-    )
-    assert r4.status_code == 200
-    # don't use r2.text here, it's very very slow!
-    it = r4.iter_lines()
-
-    # logout
-    url5 = '{}logout.php'.format(url)
-    r5 = requests.post(
-        url5,
-        params={
-            'lang': 'de',
-        },
-        cookies=cookies,
-        headers=headers
-    )
-    assert r5.status_code == 200
+    def __init__(self, url, username, password, ref_id):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.ref_id = ref_id
+        self.timings = {}
 
-    return it
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        retries = Retry(
+            total=app.config['ILIAS_RETRIES'],
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=False  # the Ilias forms are posted, repeating them is harmless
+        )
+        adapter = HTTPAdapter(max_retries=retries)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def call(self, stage, method, path, **kwargs):
+        """Send a request and add its duration to the given stage."""
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url + path, timeout=app.config['ILIAS_TIMEOUT'], **kwargs)
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+        assert response.status_code == 200
+        return response
+
+    def login(self):
+        response = self.call('login', 'GET', 'login.php')
+        response = self.call(
+            'login',
+            'POST',
+            'ilias.php',
+            params={
+                'baseClass': 'ilStartUpGUI',
+                'client_id': 'pilot',
+                'cmd': 'post',
+                'cmdClass': 'ilstartupgui',
+                'cmdNode': '10b',
+                'lang': 'de',
+                'rtoken': '',
+            },
+            data={
+                'cmd[doStandardAuthentication]': 'Anmelden',
+                'password': self.password,
+                'username': self.username,
+            }
+        )
+        assert 'Sprachenzentrum' in response.text
+
+    def evaluation(self):
+        """Get the tokens of the evaluation form.
+
+           :return: tuple of `rtoken` and `active_id`
+        """
+        response = self.call(
+            'evaluation',
+            'GET',
+            'ilias.php',
+            params={
+                'baseClass': 'ilrepositorygui',
+                'cmd': 'outEvaluation',
+                'cmdClass': 'iltestevaluationgui',
+                'cmdNode': 'x2:rm:13i',
+                'ref_id': self.ref_id,
+            }
+        )
+        # these tokens occur multiple times but seem to be unique
+        export_parameters = get_export_parameters(response.text)
+        return export_parameters['rtoken'], export_parameters['active_id']
+
+    def prepare(self, rtoken):
+        """Prepare form / virtual table so we get all the information we need.
+
+           Without this step, the "Matrikelnummer" won't be present.
+           WARNING: this change is stateful (i.e. Ilias keeps track of it, not the URI / cookie / session storage / ...)
+        """
+        self.call(
+            'prepare',
+            'POST',
+            'ilias.php',
+            params={
+                'baseClass': 'ilrepositorygui',
+                'cmd': 'post',
+                'cmdClass': 'iltestevaluationgui',
+                'cmdNode': 'x2:rm:13i',
+                'fallbackCmd': 'outEvaluation',
+                'ref_id': self.ref_id,
+                'rtoken': rtoken,
+            },
+            data={
+                'cmd[outEvaluation]': 'Aktualisieren',
+                'course': '',
+                'group': '',
+                'name': '',
+                'tblfshtst_eval_all': '1',
+                'tblfstst_eval_all[]': 'matriculation',
+                'tst_eval_all_table_nav': 'name:asc:0',
+                'tst_eval_all_table_nav1': 'name:asc:0',
+                'tst_eval_all_table_nav2': 'name:asc:0',
+            }
+        )
 
+    def export(self, rtoken, active_id, consume):
+        """Stream the CSV export into `consume` while the connection is open.
+
+           :param consume: function that takes the line->byte iterator
+           :return: result of `consume`
+        """
+        start = time.perf_counter()
+        with self.call(
+            'export',
+            'POST',
+            'ilias.php',
+            params={
+                'active_id': active_id,
+                'baseClass': 'ilrepositorygui',
+                'cmd': 'post',
+                'cmdClass': 'iltestevaluationgui',
+                'cmdNode': 'x2:rm:13i',
+                'fallbackCmd': 'exportEvaluation',
+                'ref_id': self.ref_id,
+                'rtoken': rtoken,
+            },
+            data={
+                'cmd[exportEvaluation]': 'Export',
+                'export_type': 'csv',
+            },
+            stream=True
+        ) as response:
+            # don't use response.text here, it's very very slow!
+            # iter_lines yields an empty line when a chunk ends between '\r' and '\n', Ilias sends no empty lines
+            result = consume(line for line in response.iter_lines() if line)
+        self.timings['export'] = time.perf_counter() - start
+        return result
+
+    def logout(self):
+        self.call('logout', 'POST', 'logout.php', params={'lang': 'de'})
+
+    def close(self):
+        self.session.close()
+
+
+def download_data(consume=list):
+    """Download relevant CSV data from Ilias.
 
-def parse_data(it):
-    """Parse CSV string from Ilias into list of Approval objects."""
+       :param consume: function that takes the line->byte iterator, called while the download is still running
+       :return: tuple of the result of `consume` and the durations of the stages in seconds
+    """
+    client = Client(
+        app.config['ILIAS_URL'],
+        app.config['ILIAS_USERNAME'],
+        app.config['ILIAS_PASSWORD'],
+        app.config['ILIAS_REFID']
+    )
+    try:
+        client.login()
+        rtoken, active_id = client.evaluation()
+        client.prepare(rtoken)
+        result = client.export(rtoken, active_id, consume)
+        client.logout()
+    finally:
+        client.close()
+    return result, client.timings
+
+
+def parse_rows(it):
+    """Parse CSV string from Ilias into list of `(tag, percent)`, tags are normalized."""
     # do lazy string conversion for performance reasons
     # WARNING: Ilias emits invalid Unicode characters!
     fp = (line.decode('utf-8', 'replace') for line in it)
@@ -181,7 +244,7 @@ def parse_data(it):
     # don't care about the rest
 
     # parse file
-    approvals = []
+    rows = []
     for idx, row in enumerate(reader, 1):
         # for some reason, Ilias emits a new header before every line,
         # so we only parse every second line.
@@ -216,7 +279,7 @@ def parse_data(it):
             continue
 
         # ==========================
-        # == 3. create objects    ==
+        # == 3. compute rating    ==
         # ==========================
         # limit rating to [0, 100] because for some reason,
         # points_got might be bigger than points_max
@@ -228,35 +291,191 @@ def parse_data(it):
             )
         )
 
-        # finally add approval to output list
-        approvals.append(
-            models.Approval(
-                tag=tag,
-                percent=rating,
-                sticky=False,
-                priority=False
-            )
-        )
+        # finally add row to output list
+        rows.append((tag, rating))
+
+    return rows
+
 
-    return approvals
+def parse_data(it):
+    """Parse CSV string from Ilias into list of Approval objects."""
+    return [models.Approval(tag=tag, percent=percent, sticky=False, priority=False) for tag, percent in parse_rows(it)]
 
 
 def download_and_parse_data():
-    return parse_data(download_data())
+    return download_data(parse_data)[0]
+
+
+def fingerprinted(lines, digest):
+    """Pass the lines through, adding them to the given hash object."""
+    for line in lines:
+        digest.update(line)
+        digest.update(b'\n')
+        yield line
+
+
+def fingerprint(lines):
+    """Content hash of the downloaded export."""
+    digest = hashlib.sha256()
+    for _ in fingerprinted(lines, digest):
+        pass
+    return digest.hexdigest()
+
+
+def salt_tags(tags):
+    """Salted tags, only tags that were not seen by the last run get hashed.
+
+       The map replaces the one of the last run, so tags that left the export do not linger.
+
+       :param tags: set of normalized tags
+       :return: tuple of the dict of tag to salted tag and the number of hashed tags
+    """
+    secret = app.config['SECRET_KEY'].encode('utf-8')
+    keys = {tag: hmac.new(secret, tag.encode('utf-8'), hashlib.sha256).hexdigest() for tag in tags}
+    client = redis_client()
+    cached = client.hmget(SALTED_KEY, list(keys.values())) if keys else []
+
+    salted = {}
+    hashed = 0
+    for (tag, key), value in zip(keys.items(), cached):
+        if value is None:
+            value = models.hash_secret_weak(tag)
+            hashed += 1
+        salted[tag] = value
+
+    pipe = client.pipeline()
+    pipe.delete(SALTED_KEY)
+    if salted:
+        pipe.hset(SALTED_KEY, mapping={keys[tag]: value for tag, value in salted.items()})
+    pipe.execute()
+    return salted, hashed
+
+
+def diff(existing, rows):
+    """Changes that turn the existing non-sticky approvals into the downloaded ones.
+
+       A tag may have several approvals, one per test taken. Existing approvals are kept where the percentage matches
+       and reused for another percentage of the same tag otherwise.
+
+       :param existing: list of `(id, tag_salted, percent)` of the approvals in the database
+       :param rows: list of `(tag_salted, percent)` of the downloaded approvals
+       :return: tuple of `(tag_salted, percent)` to add, `(id, percent)` to change and IDs to remove
+    """
+    wanted = defaultdict(list)
+    for tag_salted, percent in rows:
+        wanted[tag_salted].append(percent)
+
+    unmatched = []
+    for id, tag_salted, percent in existing:
+        percents = wanted.get(tag_salted)
+        if percents and percent in percents:
+            percents.remove(percent)
+        else:
+            unmatched.append((id, tag_salted))
+
+    changed = []
+    removed = []
+    for id, tag_salted in unmatched:
+        percents = wanted.get(tag_salted)
+        if percents:
+            changed.append((id, percents.pop()))
+        else:
+            removed.append(id)
+
+    added = [(tag_salted, percent) for tag_salted, percents in wanted.items() for percent in percents]
+    return added, changed, removed
+
+
+def apply_diff(added, changed, removed):
+    """Write the changes of :py:func:`diff`, the caller is responsible for the commit.
+
+       :return: set of the salted tags whose approvals changed
+    """
+    table = models.Approval.__table__
+    touched = {tag_salted for tag_salted, _ in added}
+
+    if removed or changed:
+        ids = removed + [id for id, _ in changed]
+        touched.update(
+            bytes(row[0]) for row in db.session.query(models.Approval.tag_salted).filter(models.Approval.id.in_(ids))
+        )
+    if removed:
+        db.session.execute(table.delete().where(table.c.id.in_(removed)))
+    if changed:
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('approval_id')).values(percent=bindparam('new_percent')),
+            [dict(approval_id=id, new_percent=percent) for id, percent in changed]
+        )
+    if added:
+        db.session.execute(table.insert(), [
+            dict(tag_salted=tag_salted, percent=percent, sticky=False, priority=False)
+            for tag_salted, percent in added
+        ])
+    return touched
 
 
 def refresh():
-    # Overwrite approvals in DB with newest Ilias data.
-    approvals = download_and_parse_data()
+    """Apply the newest Ilias data to the non-sticky approvals.
+
+       :return: report of the run, see :py:func:`read_report`
+    """
+    report = dict(skipped=False, added=0, changed=0, removed=0, hashed=0)
+    started = time.perf_counter()
 
+    # the export is parsed while it streams in, parsing is cheap without hashing
+    digest = hashlib.sha256()
+    rows, report['stages'] = download_data(lambda lines: parse_rows(fingerprinted(lines, digest)))
+    digest = digest.hexdigest()
+    report['download'] = time.perf_counter() - started
+    client = redis_client()
+
+    if client.get(FINGERPRINT_KEY) == digest.encode():
+        report['skipped'] = True
+        return publish_report(report, started)
+
+    step = time.perf_counter()
+    salted, report['hashed'] = salt_tags({tag for tag, _ in rows})
+    report['hash'] = time.perf_counter() - step
+
+    step = time.perf_counter()
     # start transaction rollback area
     try:
-        # remove all non-sticky entries from DB
-        models.Approval.query.filter(models.Approval.sticky == False).delete()  # NOQA
+        existing = db.session.query(models.Approval.id, models.Approval.tag_salted, models.Approval.percent) \
+            .filter(models.Approval.sticky == False)  # NOQA
+        added, changed, removed = diff(
+            [(id, bytes(tag_salted), percent) for id, tag_salted, percent in existing],
+            [(salted[tag], percent) for tag, percent in rows]
+        )
+        touched = apply_diff(added, changed, removed)
 
-        # add all new approvals
-        db.session.add_all(approvals)
+        # the bulk statements bypassed the per-flush refresh of the summary
+        models.ApprovalSummary.refresh(touched)
         db.session.commit()
     except Exception:
         db.session.rollback()
         raise
+    report['apply'] = time.perf_counter() - step
+    report.update(added=len(added), changed=len(changed), removed=len(removed))
+
+    # forget the fingerprint after a while, so changes made outside of the sync get overwritten
+    client.set(FINGERPRINT_KEY, digest, ex=app.config['ILIAS_SYNC_FINGERPRINT_TTL'])
+    return publish_report(report, started)
+
+
+def publish_report(report, started):
+    report['total'] = time.perf_counter() - started
+    report['finished'] = str(datetime.now(timezone.utc).replace(tzinfo=None))
+    redis_client().set(REPORT_KEY, json.dumps(report))
+    app.logger.info('ilias sync: %s', report)
+    return report
+
+
+def read_report():
+    """Report of the last sync run.
+
+       :return: dict with `skipped`, the numbers of `added`, `changed`, `removed` and `hashed` rows, the `download`,
+                `hash`, `apply` and `total` duration in seconds, the durations of the download `stages` and the time
+                it `finished` in UTC, None if there was no run yet
+    """
+    value = redis_client().get(REPORT_KEY)
+    return json.loads(value) if value is not None else None
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+"""Write-behind ingestion of signups in the random window.
+
+   A signup in the RND window only adds a waiting attendance and :py:func:`spz.populate.populate_rnd` draws the
+   waiting attendances in random order anyway, so nothing forces a commit per request. With `SIGNUP_INGEST` enabled,
+   the signup views append validated signups to a Redis stream and answer with a receipt right away. The
+   `ingest_signups` task inserts them in batches and sends the confirmation mails.
+
+   The views check the signup rules against the committed rows only, so the rules that depend on other signups are
+   checked again on insert, against the database and the batch. Signups that break them are not inserted.
+
+   Entries are acknowledged only after their batch got committed. Replaying a batch after a crash is harmless,
+   applicants are deduplicated by mail and attendances that already exist are skipped. A batch that fails is
+   retried entry by entry; entries that fail on their own, and the rejected ones, are parked in the `DEAD_LETTERS`
+   stream, so they do not block the signups behind them.
+"""
+
+import json
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from redis import RedisError, ResponseError
+from sqlalchemy import func, text
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from spz import app, counters, db, models, store
+
+
+STREAM = 'spz:signups'
+GROUP = 'ingest'
+CONSUMER = 'ingest'
+LOCK = 'spz:signups:lock'
+DEAD_LETTERS = 'spz:signups:dead'
+
+NEXT_APPLICANT_IDS = text("SELECT nextval('applicant_id_seq') FROM generate_series(1, :number)")
+
+
+def applies(course, time, preterm):
+    """Whether a signup for this course can be ingested instead of committed right away."""
+    return app.config['SIGNUP_INGEST'] and not preterm and course.language.is_open_for_signup_rnd(time)
+
+
+def make_entry(applicant, course, graduation, time, state=None, override=False):
+    """Serializable signup as it goes through the stream.
+
+       :param applicant: new or existing applicant, as returned by the signup forms
+       :param course: course applied for
+       :param graduation: optional graduation aimed for
+       :param time: time of the signup, in UTC
+       :param state: OAuth state of an internal signup, the token gets deleted with the insert
+       :param override: the signup was made by a privileged user, who may override the signup rules
+    """
+    return dict(
+        mail=applicant.mail,
+        tag=applicant.tag,
+        first_name=applicant.first_name,
+        last_name=applicant.last_name,
+        phone=applicant.phone,
+        degree_id=applicant.degree.id if applicant.degree else None,
+        semester=applicant.semester,
+        origin_id=applicant.origin.id if applicant.origin else None,
+        is_student=bool(applicant.is_student),
+        signoff_id=applicant.signoff_id,
+        course_id=course.id,
+        graduation_id=graduation.id if graduation else None,
+        discount=int(applicant.current_discount()),
+        registered=time.isoformat(),
+        state=state,
+        override=override
+    )
+
+
+def submit(*args, **kwargs):
+    """Append a validated signup to the stream, takes the arguments of :py:func:`make_entry`.
+
+       The caller has to roll back the session afterwards, the applicant may be a modified persistent one.
+
+       :return: receipt ID of the signup, None if Redis is unavailable and the signup has to be committed directly
+    """
+    entry = make_entry(*args, **kwargs)
+    try:
+        return store.redis_client().xadd(STREAM, dict(entry=json.dumps(entry))).decode()
+    except RedisError:
+        return None
+
+
+def insert_applicants(entries):
+    """Insert the applicants of signups whose mail is unknown, the first signup per mail wins.
+
+       :return: dict of lowercase mail to applicant ID, for every signup
+    """
+    mails = {entry['mail'].lower() for entry in entries}
+    applicant_ids = dict(
+        db.session.query(func.lower(models.Applicant.mail), models.Applicant.id)
+        .filter(func.lower(models.Applicant.mail).in_(mails))
+    )
+
+    new = {}  # first signup of every unknown mail
+    for entry in entries:
+        if entry['mail'].lower() not in applicant_ids:
+            new.setdefault(entry['mail'].lower(), entry)
+    if new:
+        ids = [row[0] for row in db.session.execute(NEXT_APPLICANT_IDS, dict(number=len(new)))]
+        applicant_ids.update(zip(new, ids))
+        db.session.execute(models.Applicant.__table__.insert(), [
+            dict(
+                id=applicant_ids[mail],
+                mail=entry['mail'],
+                tag=entry['tag'],
+                first_name=entry['first_name'],
+                last_name=entry['last_name'],
+                phone=entry['phone'],
+                degree_id=entry['degree_id'],
+                semester=entry['semester'],
+                origin_id=entry['origin_id'],
+                discounted=False,
+                is_student=entry['is_student'],
+                hide_grade=False,
+                signoff_id=entry['signoff_id'],
+                registered=datetime.fromisoformat(entry['registered'])
+            )
+            for mail, entry in new.items()
+        ])
+
+    students = {applicant_ids[entry['mail'].lower()] for entry in entries if entry['is_student']}
+    if students:
+        models.Applicant.query \
+            .filter(models.Applicant.id.in_(students)) \
+            .update(dict(is_student=True), synchronize_session=False)
+
+    return applicant_ids
+
+
+def known_attendances(mails):
+    """Attendances of the known applicants with the course details the signup rules need.
+
+       :param mails: lowercase mail addresses
+       :return: tuple of the dict of lowercase mail to applicant ID and the dict of applicant ID to attendance rows
+    """
+    applicant_ids = dict(
+        db.session.query(func.lower(models.Applicant.mail), models.Applicant.id)
+        .filter(func.lower(models.Applicant.mail).in_(mails))
+    )
+    rows = db.session.query(
+        models.Attendance.applicant_id,
+        models.Attendance.course_id,
+        models.Attendance.waiting,
+        models.Course.language_id,
+        models.Course.level,
+        models.Course.collision,
+        models.Language.signup_end
+    ) \
+        .join(models.Course, models.Course.id == models.Attendance.course_id) \
+        .join(models.Language, models.Language.id == models.Course.language_id) \
+        .filter(models.Attendance.applicant_id.in_(set(applicant_ids.values())))
+
+    attendances = defaultdict(list)
+    for row in rows:
+        attendances[row.applicant_id].append(row)
+    return applicant_ids, attendances
+
+
+def parallel(row, course):
+    """Whether an attendance row is in the course or a parallel one, like `Applicant.active_in_parallel_course`."""
+    return row.language_id == course.language_id and (
+        row.level == course.level or row.level in course.collision or course.level in row.collision
+    )
+
+
+def screen(entries):
+    """Check the signup rules that depend on other signups again, against the database and the batch.
+
+       These are the parallel courses, the limit of running attendances and the doppelgangers, see
+       :py:mod:`spz.eligibility`. Signups of privileged users are not checked, like in the views.
+
+       :param entries: list of signups as built by :py:func:`submit`
+       :return: tuple of the admissible entries and the list of `(entry, rule)` of the rejected ones
+    """
+    applicant_ids, attendances = known_attendances({entry['mail'].lower() for entry in entries})
+    courses = {
+        course.id: course
+        for course in models.Course.query.filter(models.Course.id.in_({entry['course_id'] for entry in entries}))
+    }
+    tags = {entry['tag'] for entry in entries if entry['tag'] and entry['tag'] != 'Wird nachgereicht'}
+    tag_mails = defaultdict(set)
+    rows = db.session.query(models.Applicant.tag, models.Applicant.mail).filter(models.Applicant.tag.in_(tags))
+    for tag, mail in rows:
+        tag_mails[tag].add(mail)
+
+    admitted = defaultdict(set)  # lowercase mail -> IDs of the courses admitted from this batch
+    result = []
+    rejected = []
+    for entry in entries:
+        mail = entry['mail'].lower()
+        course = courses.get(entry['course_id'])
+        rows = attendances.get(applicant_ids.get(mail), [])
+        registered = datetime.fromisoformat(entry['registered'])
+        known = {row.course_id for row in rows} | admitted[mail]
+
+        rule = None
+        if entry.get('override') or course is None or course.id in known:
+            pass  # duplicates and vanished courses are skipped by `insert`
+        elif any(not row.waiting and row.course_id != course.id and parallel(row, course) for row in rows):
+            rule = 'not_attending'
+        elif sum(1 for row in rows if row.signup_end and row.signup_end >= registered) + len(admitted[mail]) \
+                >= app.config['MAX_ATTENDANCES']:
+            rule = 'below_limit'
+        elif entry['tag'] in tags and tag_mails[entry['tag']] - {entry['mail']}:
+            rule = 'no_doppelgangers'
+
+        if rule:
+            rejected.append((entry, rule))
+            continue
+        if course is not None:
+            admitted[mail].add(course.id)
+        if entry['tag'] in tags:
+            tag_mails[entry['tag']].add(entry['mail'])
+        result.append(entry)
+    return result, rejected
+
+
+def insert(entries):
+    """Insert signups with one statement per table, signups that break the rules are left out, see :py:func:`screen`.
+
+       The caller is responsible for the commit.
+
+       :param entries: list of signups as built by :py:func:`submit`
+       :return: tuple of the list of `(applicant_id, course_id, registered)` of the inserted attendances, with the
+                signup time in ISO format, and the list of `(entry, rule)` of the rejected signups
+    """
+    if not entries:
+        return [], []
+
+    states = {entry['state'] for entry in entries if entry['state']}
+    entries, rejected = screen(entries)
+    if not entries:
+        delete_tokens(states)
+        return [], rejected
+
+    applicant_ids = insert_applicants(entries)
+    existing = set(
+        db.session.query(models.Attendance.applicant_id, models.Attendance.course_id)
+        .filter(models.Attendance.applicant_id.in_(set(applicant_ids.values())))
+    )
+    ects_points = dict(
+        db.session.query(models.Course.id, models.Course.ects_points)
+        .filter(models.Course.id.in_({entry['course_id'] for entry in entries}))
+    )
+
+    rows = []
+    for entry in entries:
+        key = (applicant_ids[entry['mail'].lower()], entry['course_id'])
+        if key in existing or entry['course_id'] not in ects_points:
+            continue
+        existing.add(key)
+        registered = datetime.fromisoformat(entry['registered'])
+        rows.append(dict(
+            applicant_id=key[0],
+            course_id=key[1],
+            graduation_id=entry['graduation_id'],
+            ects_points=ects_points[key[1]],
+            hide_grade=False,
+            waiting=True,
+            discount=entry['discount'],
+            amountpaid=0,
+            paidbycash=False,
+            registered=registered,
+            signoff_window=registered,
+            informed_about_rejection=False,
+            ts_requested=False,
+            ts_received=False,
+            ps_received=False
+        ))
+    if rows:
+        db.session.execute(models.Attendance.__table__.insert(), rows)
+
+    numbers = Counter(row['course_id'] for row in rows)
+    counters.count_waiting(numbers)
+    if numbers:
+        models.Course.query \
+            .filter(models.Course.id.in_(numbers)) \
+            .update(dict(revision=models.Course.revision + 1), synchronize_session=False)
+
+    delete_tokens(states)
+    return [(row['applicant_id'], row['course_id'], row['registered'].isoformat()) for row in rows], rejected
+
+
+def delete_tokens(states):
+    """Delete the OAuth tokens of internal signups, their signup is done."""
+    if states:
+        models.OAuthToken.query \
+            .filter(models.OAuthToken.state.in_(states)) \
+            .delete(synchronize_session=False)
+
+
+def park(client, message_id, fields, reason):
+    """Move a signup that cannot be inserted to the `DEAD_LETTERS` stream."""
+    client.xadd(DEAD_LETTERS, dict(id=message_id, entry=fields[b'entry'], reason=reason))
+    app.logger.error('signup %s not inserted: %s', message_id.decode(), reason)
+
+
+def insert_batch(client, messages):
+    """Insert and commit the signups of a batch, entry by entry if the batch as a whole fails.
+
+       An entry that fails on its own is parked. Errors of the database connection are raised, the entries stay
+       pending and are read again by the next run.
+
+       :return: list of the inserted attendances, see :py:func:`insert`
+    """
+    try:
+        entries = [json.loads(fields[b'entry']) for _, fields in messages]
+        inserted, rejected = insert(entries)
+        db.session.commit()
+    except (OperationalError, InterfaceError):
+        db.session.rollback()
+        raise
+    except Exception as e:
+        db.session.rollback()
+        if len(messages) == 1:
+            park(client, *messages[0], repr(e))
+            return []
+        return [row for message in messages for row in insert_batch(client, [message])]
+
+    by_entry = {id(entry): message for message, entry in zip(messages, entries)}
+    for entry, rule in rejected:
+        park(client, *by_entry[id(entry)], 'rule {} broken'.format(rule))
+    return inserted
+
+
+def read(client, start):
+    """Batches of stream entries, pending ones from start `'0'`, new ones from `'>'`."""
+    while True:
+        response = client.xreadgroup(GROUP, CONSUMER, {STREAM: start}, count=app.config['SIGNUP_INGEST_BATCH_SIZE'])
+        messages = response[0][1] if response else []
+        if not messages:
+            return
+        yield messages
+        if start != '>':
+            start = messages[-1][0]  # continue after the pending entries that were read
+
+
+def drain():
+    """Insert all signups of the stream, `SIGNUP_INGEST_BATCH_SIZE` per transaction.
+
+       Only one process drains at a time. Signups that were read but not acknowledged by an earlier, failed run are
+       inserted first.
+
+       :return: generator of the `(applicant_id, course_id, registered)` lists of the inserted attendances, one per
+                committed batch
+    """
+    client = store.redis_client()
+    try:
+        client.xgroup_create(STREAM, GROUP, id='0', mkstream=True)
+    except ResponseError:
+        pass  # group exists
+
+    lock = client.lock(LOCK, timeout=app.config['SIGNUP_INGEST_LOCK_TIMEOUT'])
+    if not lock.acquire(blocking=False):
+        return
+
+    try:
+        for start in ('0', '>'):  # pending entries first, then new ones
+            for messages in read(client, start):
+                inserted = insert_batch(client, messages)
+
+                ids = [message_id for message_id, _ in messages]
+                client.xack(STREAM, GROUP, *ids)
+                client.xdel(STREAM, *ids)
+                lock.reacquire()
+                yield inserted
+    finally:
+        lock.release()
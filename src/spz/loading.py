@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""Loading profiles for the views.
+
+   Relationships of the models are loaded lazily by default. Every view that walks relationships declares the loader
+   options it needs here and applies them with `query.options(*profile)`, so one page is rendered with a constant
+   number of queries instead of one per course or attendance.
+"""
+
+from sqlalchemy.orm import configure_mappers, contains_eager, joinedload, selectinload
+
+from spz import models
+
+
+configure_mappers()  # backrefs like `Course.attendances` only exist once the mappers are configured
+
+_applicant_details = (
+    joinedload(models.Applicant.origin),
+    joinedload(models.Applicant.degree),
+)
+
+# course with its active and waiting attendants, as shown in course lists and PDFs
+_course_attendances = selectinload(models.Course.attendances).options(
+    joinedload(models.Attendance.applicant).options(*_applicant_details),
+    joinedload(models.Attendance.graduation),
+)
+
+# `lists`, `language`: the courses of languages; the attendance counts are read from the course counters
+LANGUAGE = (
+    selectinload(models.Language.courses),
+)
+
+# `course`, exports and PDFs of single courses
+COURSE = (
+    joinedload(models.Course.language),
+    _course_attendances,
+)
+
+# exports and PDFs of all courses of a language
+LANGUAGE_COURSES = (
+    selectinload(models.Language.courses).options(_course_attendances),
+)
+
+# course list exports, the attendances are streamed separately, see `spz.export.active_attendances`
+EXPORT_COURSES = (
+    joinedload(models.Course.language),
+)
+
+# overview exports of a language
+EXPORT_LANGUAGE = (
+    selectinload(models.Language.courses),
+)
+
+# attendances of course list exports, the query has to join `Attendance.applicant`
+EXPORT_ATTENDANCES = (
+    contains_eager(models.Attendance.applicant).options(*_applicant_details),
+    joinedload(models.Attendance.graduation),
+)
+
+# `applicant`: personal details and all attendances with the course names
+APPLICANT = _applicant_details + (
+    selectinload(models.Applicant.attendances).options(
+        joinedload(models.Attendance.course).joinedload(models.Course.language),
+        joinedload(models.Attendance.graduation),
+    ),
+)
+
+# `search_applicant`: the number of attendances per applicant
+APPLICANTS = (
+    selectinload(models.Applicant.attendances),
+)
+
+# bills and status pages of a single attendance
+ATTENDANCE = (
+    joinedload(models.Attendance.applicant),
+    joinedload(models.Attendance.course).joinedload(models.Course.language),
+)
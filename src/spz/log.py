@@ -25,16 +25,21 @@ def log(msg, course=None, timestamp=None):
     db.session.add(entry)
 
 
+def booking_msg(full_name, mail, course):
+    """Message for an applicant that got booked into a course."""
+    return _(
+        '%(fname)s (%(mail)s) wurde in %(cname)s gebucht.',
+        fname=full_name,
+        mail=mail,
+        cname=course.full_name
+    )
+
+
 @event.listens_for(models.Attendance.waiting, 'set')
 def evt_set_attendance_waiting(target, value, oldvalue, _initiator):
     if value is False and oldvalue is True:
         course = target.course
-        msg = _(
-            '%(fname)s (%(mail)s) wurde in %(cname)s gebucht.',
-            fname=target.applicant.full_name,
-            mail=target.applicant.mail,
-            cname=course.full_name
-        )
+        msg = booking_msg(target.applicant.full_name, target.applicant.mail, course)
         log(msg, course=course)
 
 
@@ -9,16 +9,98 @@ from flask import render_template
 from flask_mail import Message
 from flask_babel import gettext as _
 
+from sqlalchemy import orm
+
 from spz import app, models
+from spz.store import get_blob
+
+
+# kinds of status mails that can be sent in batches, see `generate_status_mails`
+STATUS = 'status'
+RESTOCK = 'restock'
 
 
 def generate_status_mail(applicant, course, time=None, restock=False):
     """Generate mail to notify applicants about their new attendance status."""
-    time = time or datetime.now(dt_timezone.utc).replace(tzinfo=None)
     attendance = models.Attendance.query \
         .filter(models.Attendance.applicant_id == applicant.id, models.Attendance.course_id == course.id) \
         .first()
 
+    return render_status_mail(applicant, course, attendance, time, restock)
+
+
+def generate_status_mails(entries, time=None):
+    """Generate status mails for many attendances with a constant number of queries.
+
+       :param entries: list of `(applicant_id, course_id, kind)` where kind is :py:data:`STATUS` or
+                       :py:data:`RESTOCK`, optionally followed by the time the mail is rendered for in ISO format
+       :param time: time the mails without their own time are rendered for, now by default
+       :return: list of `(entry, message)`; entries whose applicant or course does not exist anymore are left out
+    """
+    applicant_ids = {entry[0] for entry in entries}
+    course_ids = {entry[1] for entry in entries}
+
+    applicants = {
+        applicant.id: applicant
+        for applicant
+        in models.Applicant.query.options(orm.lazyload('*')).filter(models.Applicant.id.in_(applicant_ids))
+    }
+    courses = {course.id: course for course in models.Course.query.filter(models.Course.id.in_(course_ids))}
+    attendances = {
+        (attendance.applicant_id, attendance.course_id): attendance
+        for attendance
+        in models.Attendance.query
+        .options(orm.lazyload('*'))
+        .filter(models.Attendance.applicant_id.in_(applicant_ids), models.Attendance.course_id.in_(course_ids))
+    }
+
+    return [
+        (
+            entry,
+            render_status_mail(
+                applicants[entry[0]],
+                courses[entry[1]],
+                attendances.get((entry[0], entry[1])),
+                datetime.fromisoformat(entry[3]) if len(entry) > 3 else time,
+                restock=entry[2] == RESTOCK
+            )
+        )
+        for entry
+        in entries
+        if entry[0] in applicants and entry[1] in courses
+    ]
+
+
+def generate_notification_mail(sender, recipients, subject, html, cc=None, bcc=None, attachments=()):
+    """Generate a notification mail.
+
+       :param attachments: list of `(name, mime, digest)`, the data is loaded with :py:func:`spz.store.get_blob`
+    """
+    msg = Message(
+        sender=sender,
+        recipients=recipients,
+        subject=subject,
+        html=html,
+        cc=cc,
+        bcc=bcc,
+        charset='utf-8'
+    )
+    for name, mime, digest in attachments:
+        msg.attach(name, mime, get_blob(digest))
+    return msg
+
+
+def render_status_mail(applicant, course, attendance, time=None, restock=False):
+    """Render the status mail for an already loaded attendance.
+
+       :param attendance: attendance of the applicant in the course, None if there is none
+       :param time: time the mail is rendered for, now by default
+       :param restock: whether an accepted applicant got the seat by a restock
+       :return: message whose template depends on the attendance and the signup phase at `time`, the kickout mail
+                ("Platzverlust") if the applicant is not in the course
+    """
+    time = time or datetime.now(dt_timezone.utc).replace(tzinfo=None)
+
     if attendance:
         # applicant is (somehow) registered for this course
         if attendance.waiting:
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Shared cache of the deliverability of mail domains.
+
+   Checking a domain takes up to three DNS lookups, while most applicants share a few university domains. Results are
+   kept in Redis, so all web and worker processes share them: deliverable domains for `MAIL_DOMAIN_TTL`, undeliverable
+   ones for `MAIL_DOMAIN_NEGATIVE_TTL`. DNS timeouts are not cached and do not reject a mail address, neither does an
+   unavailable Redis. The cache is warmed with the domains of the known applicants, see the `warm_mail_domains` task.
+"""
+
+import email_validator
+from redis import RedisError
+from sqlalchemy import func
+
+from spz import app, db, models, store
+
+
+KEY = 'spz:mail_domain:{}'
+STATS_KEY = 'spz:mail_domain:stats'
+
+
+def check_deliverability(ascii_domain, domain):
+    """Look the domain up in DNS.
+
+       :return: True or False, None if DNS timed out
+    """
+    try:
+        result = email_validator.validate_email_deliverability(ascii_domain, domain)
+    except email_validator.EmailUndeliverableError:
+        return False
+    return None if 'unknown-deliverability' in result else True
+
+
+class DomainCache(object):
+    """Deliverability of mail domains, cached in Redis.
+
+       :param check: function like :py:func:`check_deliverability`
+       :param client: Redis client, the one of the process if None
+    """
+
+    def __init__(self, check=check_deliverability, client=None):
+        self.check = check
+        self.client = client
+
+    @property
+    def redis(self):
+        return self.client if self.client is not None else store.redis_client()
+
+    def lookup(self, ascii_domain, domain):
+        result = self.check(ascii_domain, domain)
+        if result is not None:
+            timeout = app.config['MAIL_DOMAIN_TTL'] if result else app.config['MAIL_DOMAIN_NEGATIVE_TTL']
+            try:
+                self.redis.set(KEY.format(ascii_domain), int(result), ex=timeout)
+            except RedisError:
+                pass
+        return result
+
+    def is_deliverable(self, ascii_domain, domain=None):
+        """Whether mail to the domain can be delivered, also if that could not be told in time."""
+        ascii_domain = ascii_domain.lower()
+        try:
+            cached = self.redis.get(KEY.format(ascii_domain))
+            self.redis.hincrby(STATS_KEY, 'misses' if cached is None else 'hits')
+        except RedisError:
+            cached = None
+        if cached is not None:
+            return cached == b'1'
+        return self.lookup(ascii_domain, domain or ascii_domain) is not False
+
+    def warm(self, domains):
+        """Look up the given domains again and cache the results.
+
+           :return: number of domains that were found deliverable
+        """
+        return sum(bool(self.lookup(domain.lower(), domain)) for domain in domains)
+
+    def stats(self):
+        """Hit and miss counters of all processes."""
+        counts = {key.decode(): int(value) for key, value in self.redis.hgetall(STATS_KEY).items()}
+        return dict(hits=counts.get('hits', 0), misses=counts.get('misses', 0))
+
+
+def known_domains(limit):
+    """The most frequent domains of the applicants' mail addresses."""
+    domain = func.lower(func.split_part(models.Applicant.mail, '@', 2))
+    return [
+        row[0] for row in db.session.query(domain)
+        .group_by(domain)
+        .order_by(func.count().desc())
+        .limit(limit)
+    ]
+
+
+domains = DomainCache()
@@ -4,6 +4,8 @@
 
    Manages the mapping between abstract entities and concrete database models.
 """
+import itertools
+import json
 import os
 from enum import Enum
 from binascii import hexlify
@@ -15,12 +17,14 @@ import string
 
 from argon2 import argon2_hash
 
-from sqlalchemy import and_, or_, between, func
+from sqlalchemy import and_, or_, between, event, exists, func, inspect
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
+from sqlalchemy.orm import object_session
 from sqlalchemy import select
 
 from spz import app, db, token
+from spz.taghash import TagHasher
 
 
 def hash_secret_strong(s):
@@ -72,6 +76,10 @@ def hash_secret_weak(s):
     )
 
 
+# all tag hashes go through this memo, so one request computes argon2 at most once per tag
+hash_tag = TagHasher(hash_secret_weak, app.config['TAG_HASH_CACHE_SIZE'], app.config['TAG_HASH_CACHE_TTL'])
+
+
 def verify_tag(tag):
     """Verifies, if a tag is already in the database.
     """
@@ -106,11 +114,12 @@ class Attendance(db.Model):
 
     applicant_id = db.Column(db.Integer, db.ForeignKey('applicant.id'), primary_key=True)
 
-    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), primary_key=True)
-    course = db.relationship("Course", backref="attendances", lazy="joined")
+    # indexed on its own, the primary key only serves lookups by applicant
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), primary_key=True, index=True)
+    course = db.relationship("Course", backref="attendances")
 
     graduation_id = db.Column(db.Integer, db.ForeignKey('graduation.id'))
-    graduation = db.relationship("Graduation", backref="attendances", lazy="joined")
+    graduation = db.relationship("Graduation", backref="attendances")
 
     ects_points = db.Column(db.Integer, nullable=False, default=0)
     # internal representation of the grade is in %
@@ -133,6 +142,8 @@ class Attendance(db.Model):
 
     informed_about_rejection = db.Column(db.Boolean, nullable=False, default=False)
 
+    # waiting lists in registration order, see `spz.populate`
+    waiting_index = db.Index('ix_attendance_waiting_registered', waiting, registered)
     amountpaid_constraint = db.CheckConstraint(amountpaid >= 0)
     MAX_DISCOUNT = 100  # discount stored as percentage
     discount_constraint = db.CheckConstraint(between(discount, 0, MAX_DISCOUNT))
@@ -168,9 +179,11 @@ class Attendance(db.Model):
         if self.waiting and not waiting_list:
             self.waiting = False
             self.enrolled_at = datetime.now(timezone.utc).replace(tzinfo=None)
+            self.course.mark_dirty()
         elif not self.waiting and waiting_list:
             self.waiting = True
             self.enrolled_at = None
+            self.course.mark_dirty()
 
     @property
     def ts_requested_str(self):
@@ -263,19 +276,22 @@ class Applicant(db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
     mail = db.Column(db.String(120), unique=True, nullable=False)
-    tag = db.Column(db.String(30), unique=False, nullable=True)  # XXX
+    tag = db.Column(db.String(30), unique=False, nullable=True, index=True)  # XXX
+
+    # applicants are looked up by mail case-insensitively
+    mail_lower_index = db.Index('ix_applicant_mail_lower', func.lower(mail))
 
     first_name = db.Column(db.String(60), nullable=False)
     last_name = db.Column(db.String(60), nullable=False)
     phone = db.Column(db.String(20))
 
     degree_id = db.Column(db.Integer, db.ForeignKey('degree.id'))
-    degree = db.relationship("Degree", backref="applicants", lazy="joined")
+    degree = db.relationship("Degree", backref="applicants")
 
     semester = db.Column(db.Integer)  # TODO constraint: > 0, but still optional
 
     origin_id = db.Column(db.Integer, db.ForeignKey('origin.id'))
-    origin = db.relationship("Origin", backref="applicants", lazy="joined")
+    origin = db.relationship("Origin", backref="applicants")
 
     discounted = db.Column(db.Boolean)
     is_student = db.Column(db.Boolean)
@@ -286,7 +302,7 @@ class Applicant(db.Model):
     hide_grade = db.Column(db.Boolean, nullable=False, default=False)
 
     # See {add,remove}_course_attendance member functions below
-    attendances = db.relationship("Attendance", backref="applicant", cascade='all, delete-orphan', lazy="joined")
+    attendances = db.relationship("Attendance", backref="applicant", cascade='all, delete-orphan')
 
     signoff_id = db.Column(db.String(120))
 
@@ -362,33 +378,20 @@ class Applicant(db.Model):
     def add_course_attendance(self, *args, **kwargs):
         attendance = Attendance(*args, **kwargs)
         self.attendances.append(attendance)
+        attendance.course.mark_dirty()
         return attendance
 
     def remove_course_attendance(self, course):
         remove = [attendance for attendance in self.attendances if attendance.course == course]
         for attendance in remove:
             self.attendances.remove(attendance)
+        if remove:
+            course.mark_dirty()
         return len(remove) > 0
 
     def best_rating(self):
         """Results best rating, prioritize sticky entries."""
-        results_priority = [
-            approval.percent
-            for approval
-            in Approval.get_for_tag(self.tag, True)
-        ]
-        if results_priority:
-            return max(results_priority)
-
-        results_normal = [
-            approval.percent
-            for approval
-            in Approval.get_for_tag(self.tag, False)
-        ]
-        if results_normal:
-            return max(results_normal)
-
-        return 0
+        return ApprovalSummary.best_ratings([self.tag])[self.tag]
 
     def rating_to_ger(self, percent):
         """
@@ -504,6 +507,12 @@ class Course(db.Model):
        :param has_waiting_list: Indicates if there is a waiting list for this course
        :param ects_points: amount of ects credit points corresponding to the effort
        :param last_signoff_at: time of the last signed off applicant from the course
+       :param revision: bumped whenever the vacancies or the waiting list of this course change
+       :param populated_revision: the revision the last populate run has processed
+       :param active_count: number of active attendances, see :py:mod:`spz.counters`
+       :param waiting_count: number of waiting attendances
+       :param unpaid_count: number of active attendances that are not fully paid
+       :param free_count: number of active attendances that are free of charge
 
        .. seealso:: the :py:data:`attendances` relationship
     """
@@ -524,9 +533,18 @@ class Course(db.Model):
     has_waiting_list = db.Column(db.Boolean, nullable=False, default=False)
     ects_points = db.Column(db.Integer, nullable=False)
     last_signoff_at = db.Column(db.DateTime(), default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+    # the course is dirty for populate as long as both differ, see `mark_dirty`
+    revision = db.Column(db.Integer, nullable=False, default=1)
+    populated_revision = db.Column(db.Integer, nullable=False, default=0)
+
+    # denormalized attendance counts, maintained by the listeners in `spz.counters`
+    active_count = db.Column(db.Integer, nullable=False, default=0)
+    waiting_count = db.Column(db.Integer, nullable=False, default=0)
+    unpaid_count = db.Column(db.Integer, nullable=False, default=0)
+    free_count = db.Column(db.Integer, nullable=False, default=0)
 
     # db model GradeSheets associated with this course, backref allows access of e. g. gradesheet.course
-    grade_sheets = db.relationship("GradeSheets", backref="course", cascade='all, delete-orphan', lazy="joined")
+    grade_sheets = db.relationship("GradeSheets", backref="course", cascade='all, delete-orphan')
 
     unique_constraint = db.UniqueConstraint(language_id, level, alternative, ger)
     limit_constraint = db.CheckConstraint(limit > 0)
@@ -559,6 +577,18 @@ class Course(db.Model):
     def __lt__(self, other):
         return (self.language, self.level.lower()) < (other.language, other.level.lower())
 
+    def mark_dirty(self):
+        """Make the next populate run look at the waiting list of this course again.
+
+           The increment happens in SQL, so concurrent requests and a running populate do not lose updates.
+        """
+        if self.id is not None:  # new courses start dirty
+            self.revision = Course.revision + 1
+
+    @hybrid_property
+    def is_dirty(self):
+        return self.revision != self.populated_revision
+
     def allows(self, applicant):
         return self.rating_lowest <= applicant.best_rating() <= self.rating_highest
 
@@ -601,11 +631,43 @@ class Course(db.Model):
         return attendances[0] if attendances else None
 
     @hybrid_method
-    def count_attendances(self, *args, **kw):
-        return len(self.filter_attendances(*args, **kw))
+    def counted_attendances(self, waiting=None, is_unpaid=None, is_free=None):
+        """Attendance count built from the counter columns, None if they do not cover this combination of filters."""
+        if waiting is None and is_unpaid is None and is_free is None:
+            return self.active_count + self.waiting_count
+        if waiting is True and is_unpaid is None and is_free is None:
+            return self.waiting_count
+        if waiting is False:
+            if is_unpaid is None and is_free is None:
+                return self.active_count
+            if is_free is None:
+                return self.unpaid_count if is_unpaid else self.active_count - self.unpaid_count
+            if is_unpaid is None:
+                return self.free_count if is_free else self.active_count - self.free_count
+        return None
+
+    def has_unflushed_attendances(self):
+        """Check if attendances of this course changed since the last flush, so the counters are not up to date.
+
+           The changed courses are tracked by the listeners in :py:mod:`spz.counters`.
+        """
+        session = object_session(self)
+        return session is not None and self.id in session.info.get('unflushed_courses', ())
+
+    @hybrid_method
+    def count_attendances(self, waiting=None, is_unpaid=None, is_free=None):
+        # the counters of new courses get their values with the first flush
+        if self.active_count is not None and not self.has_unflushed_attendances():
+            counted = self.counted_attendances(waiting, is_unpaid, is_free)
+            if counted is not None:
+                return counted
+        return len(self.filter_attendances(waiting, is_unpaid, is_free))
 
     @count_attendances.expression
     def count_attendances(cls, waiting=None, is_unpaid=None, is_free=None):
+        counted = cls.counted_attendances(waiting, is_unpaid, is_free)
+        if counted is not None:
+            return counted
         query = select([func.count(Attendance.applicant_id)]).where(Attendance.course_id == cls.id)
         if waiting is not None:
             query = query.where(Attendance.waiting == waiting)
@@ -701,6 +763,12 @@ class Course(db.Model):
         return max([att.enrolled_at for att in self.filter_attendances(waiting=False)])
 
 
+@event.listens_for(Course.limit, 'set')
+def evt_set_course_limit(target, value, oldvalue, _initiator):
+    if value != oldvalue:
+        target.mark_dirty()
+
+
 @total_ordering
 class Language(db.Model):
     """Represents a language for a :py:class:`course`.
@@ -717,7 +785,7 @@ class Language(db.Model):
     name = db.Column(db.String(120), unique=True, nullable=False)
     name_english = db.Column(db.String(120), unique=True, nullable=True)
     reply_to = db.Column(db.String(120), nullable=False)
-    courses = db.relationship('Course', backref='language', lazy='joined')
+    courses = db.relationship('Course', backref='language')
 
     # Not using db.Interval here, because it needs native db support
     # See: http://docs.sqlalchemy.org/en/rel_0_8/core/types.html#sqlalchemy.types.Interval
@@ -921,10 +989,7 @@ class Registration(db.Model):
     @staticmethod
     def cleartext_to_salted(cleartext):
         """Convert cleartext unicode data to salted binary data."""
-        if cleartext:
-            return hash_secret_weak(cleartext.lower())
-        else:
-            return hash_secret_weak('')
+        return hash_tag(cleartext)
 
     @staticmethod
     def from_cleartext(cleartext):
@@ -964,7 +1029,8 @@ class Approval(db.Model):
     __tablename__ = 'approval'
 
     id = db.Column(db.Integer, primary_key=True)
-    tag_salted = db.Column(db.LargeBinary(32), nullable=False)  # tag may be not unique, multiple tests taken
+    # tag may be not unique, multiple tests taken
+    tag_salted = db.Column(db.LargeBinary(32), nullable=False, index=True)
     percent = db.Column(db.Integer, nullable=False)
     sticky = db.Column(db.Boolean, nullable=False, default=False)
     priority = db.Column(db.Boolean, nullable=False, default=False)
@@ -986,10 +1052,7 @@ class Approval(db.Model):
     @staticmethod
     def cleartext_to_salted(cleartext):
         """Convert cleartext unicode data to salted binary data."""
-        if cleartext:
-            return hash_secret_weak(cleartext.lower())
-        else:
-            return hash_secret_weak('')
+        return hash_tag(cleartext)
 
     @staticmethod
     def get_for_tag(tag, priority=None):
@@ -1009,6 +1072,86 @@ class Approval(db.Model):
             ).all()
 
 
+class ApprovalSummary(db.Model):
+    """Best approval ratings per tag, a projection of :py:class:`Approval`.
+
+       Rows are recomputed for every tag whose approvals get flushed. Bulk statements on approvals bypass this and
+       have to call :py:func:`refresh` afterwards.
+
+       :param tag_salted: The registration number or other identification, salted and hashed
+       :param best_priority: highest percentage of the priority approvals, None if there are none
+       :param best_normal: highest percentage of the other approvals, None if there are none
+    """
+
+    __tablename__ = 'approval_summary'
+
+    tag_salted = db.Column(db.LargeBinary(32), primary_key=True)
+    best_priority = db.Column(db.Integer, nullable=True)
+    best_normal = db.Column(db.Integer, nullable=True)
+
+    def __repr__(self):
+        return '<ApprovalSummary %r %r %r>' % (self.tag_salted, self.best_priority, self.best_normal)
+
+    @staticmethod
+    def refresh(tags_salted=None, session=None):
+        """Recompute the summary from the flushed approvals, the caller is responsible for the commit.
+
+           Rows are upserted and only the rows of tags without approvals are deleted, so concurrent refreshes of
+           the same tag do not collide on the primary key.
+
+           :param tags_salted: salted tags to recompute, all if None
+           :param session: session to run in, defaults to `db.session`
+        """
+        session = session or db.session
+        table = ApprovalSummary.__table__
+        aggregated = select([
+            Approval.tag_salted,
+            func.max(Approval.percent).filter(Approval.priority == True),  # NOQA
+            func.max(Approval.percent).filter(Approval.priority == False),  # NOQA
+        ]).group_by(Approval.tag_salted)
+        orphaned = ~exists().where(Approval.tag_salted == table.c.tag_salted)
+        if tags_salted is not None:
+            tags_salted = list(tags_salted)
+            if not tags_salted:
+                return
+            aggregated = aggregated.where(Approval.tag_salted.in_(tags_salted))
+            orphaned = and_(table.c.tag_salted.in_(tags_salted), orphaned)
+
+        upsert = postgresql.insert(table).from_select(['tag_salted', 'best_priority', 'best_normal'], aggregated)
+        session.execute(upsert.on_conflict_do_update(
+            index_elements=['tag_salted'],
+            set_=dict(best_priority=upsert.excluded.best_priority, best_normal=upsert.excluded.best_normal)
+        ))
+        session.execute(table.delete().where(orphaned))
+
+    @staticmethod
+    def best_ratings(tags):
+        """Best rating for every given tag with one query, priority approvals win over the others.
+
+           :param tags: tags (as cleartext) you're looking for
+           :return: dict of tag to percent, 0 for tags without approvals
+        """
+        salted = {tag: Approval.cleartext_to_salted(tag) for tag in tags}
+        if not salted:
+            return {}
+        rows = db.session.query(
+            ApprovalSummary.tag_salted,
+            func.coalesce(ApprovalSummary.best_priority, ApprovalSummary.best_normal)
+        ).filter(ApprovalSummary.tag_salted.in_(set(salted.values())))
+        best = {bytes(tag_salted): percent for tag_salted, percent in rows}
+        return {tag: best.get(tag_salted) or 0 for tag, tag_salted in salted.items()}
+
+
+@event.listens_for(db.session, 'after_flush')
+def evt_refresh_approval_summary(session, _flush_context):
+    tags_salted = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Approval):
+            tags_salted.update(bytes(tag) for tag in inspect(obj).attrs.tag_salted.history.deleted)
+            tags_salted.add(bytes(obj.tag_salted))
+    ApprovalSummary.refresh(tags_salted, session)
+
+
 class Role(db.Model):
     SUPERUSER = 'SUPERUSER'
     COURSE_ADMIN = 'COURSE_ADMIN'
@@ -1048,6 +1191,9 @@ class User(db.Model):
     email = db.Column(db.String(120), unique=True)
     active = db.Column(db.Boolean, default=True)
     pwsalted = db.Column(db.LargeBinary(32), nullable=True)
+
+    # users log in with their mail case-insensitively
+    email_lower_index = db.Index('ix_user_email_lower', func.lower(email))
     roles = db.relationship('Role', backref='user')
 
     def __init__(self, email, active, roles=[], tag=None):
@@ -1189,7 +1335,7 @@ class LogEntry(db.Model):
     __tablename__ = 'logentry'
 
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime(), nullable=False)
+    timestamp = db.Column(db.DateTime(), nullable=False, index=True)
     msg = db.Column(db.String(140), nullable=False)
     course = db.relationship("Course")  # no backref
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'))
@@ -1211,16 +1357,58 @@ class LogEntry(db.Model):
     @staticmethod
     def get_visible_log(user, limit=None):
         """Returns all log entries relevant for the given user."""
-        entries = LogEntry.query.order_by(LogEntry.timestamp.desc()).all()
+        query = LogEntry.query.order_by(LogEntry.timestamp.desc())
+        if user.is_superuser:
+            return (query.limit(limit) if limit is not None else query).all()
+
+        entries = [x for x in query if x.course is None or x.course in user.admin_courses]
+        return entries[:limit] if limit is not None else entries
+
+
+class PopulateRun(db.Model):
+    """Record of a populate round, so that a disputed lottery can be replayed.
+
+       Records are kept for `POPULATE_RUN_TTL`, older ones are deleted by the `purge_populate_runs` task.
+
+       :param id: unique ID
+       :param timestamp: time (UTC) the round was run at
+       :param procedure: populate procedure (RND or FCFS)
+       :param seed: seed of the random number generator, NULL for deterministic procedures
+       :param snapshot: JSON encoded input of the allocation engine
+       :param outcome: JSON encoded decisions, see :py:func:`spz.allocation.summarize`
+    """
+    RND = 'RND'
+    FCFS = 'FCFS'
+
+    __tablename__ = 'populate_run'
+
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime(), nullable=False)
+    procedure = db.Column(db.String(10), nullable=False)
+    seed = db.Column(db.BigInteger, nullable=True)
+    snapshot = db.Column(db.String(), nullable=False)
+    outcome = db.Column(db.String(), nullable=False)
+
+    def __init__(self, timestamp, procedure, seed, snapshot, outcome):
+        self.timestamp = timestamp
+        self.procedure = procedure
+        self.seed = seed
+        self.snapshot = snapshot
+        self.outcome = outcome
 
-        if not user.is_superuser and limit is not None:
-            entries = [x for x in entries if x.course is None or x.course in user.admin_courses][:limit]
-        elif not user.is_superuser:
-            entries = [x for x in entries if x.course is None or x.course in user.admin_courses]
-        elif limit is not None:
-            entries = entries[:limit]
+    def __repr__(self):
+        return '<PopulateRun {} {} seed={}>'.format(self.timestamp, self.procedure, self.seed)
 
-        return entries
+    @staticmethod
+    def purge(time=None):
+        """Delete the records older than `POPULATE_RUN_TTL`, the caller is responsible for the commit.
+
+           :return: number of deleted records
+        """
+        time = time or datetime.now(timezone.utc).replace(tzinfo=None)
+        return PopulateRun.query \
+            .filter(PopulateRun.timestamp <= time - app.config['POPULATE_RUN_TTL']) \
+            .delete(synchronize_session=False)
 
 
 @total_ordering
@@ -1281,18 +1469,29 @@ class ExportFormat(db.Model):
 class OAuthToken(db.Model):
     """Token used to store data while oidc flow with kit server
 
+       Tokens expire after `OAUTH_TOKEN_TTL`, abandoned ones are deleted by the `purge_oauth_tokens` task.
+
        :param id: unique ID
        :param state: OAuth state
        :param code_verifier: OAuth code verifier
     """
     __tablename__ = 'oauth_token'
 
+    # the only attributes of the user info the signup needs
+    USER_DATA_ATTRIBUTES = [
+        'eduperson_scoped_affiliation', 'eduperson_principal_name', 'given_name', 'family_name',
+        'matriculationNumber', 'preferred_username'
+    ]
+
     id = db.Column(db.Integer, primary_key=True)
-    state = db.Column(db.String(), nullable=False)
+    state = db.Column(db.String(), nullable=False, unique=True, index=True)
     code_verifier = db.Column(db.String(), nullable=False)
     user_data = db.Column(db.String(), nullable=True)
     request_has_been_made = db.Column(db.Boolean)
     is_student = db.Column(db.Boolean)
+    created_at = db.Column(
+        db.DateTime(), nullable=False, index=True, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None)
+    )
 
     def __init__(self, state, code_verifier):
         self.state = state
@@ -1300,6 +1499,35 @@ class OAuthToken(db.Model):
         self.request_has_been_made = False
         self.is_student = False
 
+    def set_user_data(self, user_data):
+        self.user_data = json.dumps(
+            {key: value for key, value in user_data.items() if key in self.USER_DATA_ATTRIBUTES},
+            separators=(',', ':')
+        )
+
+    def get_user_data(self):
+        return json.loads(self.user_data)
+
+    @staticmethod
+    def for_state(state, time=None):
+        """Query for the unexpired token with the given state, use `.first()` on it."""
+        time = time or datetime.now(timezone.utc).replace(tzinfo=None)
+        return OAuthToken.query.filter(
+            OAuthToken.state == state,
+            OAuthToken.created_at > time - app.config['OAUTH_TOKEN_TTL']
+        )
+
+    @staticmethod
+    def purge(time=None):
+        """Delete expired tokens, the caller is responsible for the commit.
+
+           :return: number of deleted tokens
+        """
+        time = time or datetime.now(timezone.utc).replace(tzinfo=None)
+        return OAuthToken.query \
+            .filter(OAuthToken.created_at <= time - app.config['OAUTH_TOKEN_TTL']) \
+            .delete(synchronize_session=False)
+
 
 class GradeSheets(db.Model):
     """Database model for the xls/xlsx grade sheet mapping
@@ -14,10 +14,12 @@
    Step 3: In this step the protected user data is requested using the received access token from step 2
 
    Step 2 and 3 are included in the oidc_callback method
+
+   Nothing is fetched from the institution at import time, the discovery document is loaded on first use.
 """
 
 from flask import session, flash, redirect, url_for
-from spz.oidc.oid_handler import Oid_handler
+from spz.oidc.oid_handler import Oid_handler, read_stats
 
 request_handler = Oid_handler()
 
@@ -85,3 +87,12 @@ def oidc_get_resources(access_token):
     """
     request_data = request_handler.request_data(access_token)
     return request_data
+
+
+def oidc_stats():
+    """
+    Timings of the requests to the KIT server per step, for every process that reported recently
+
+    :return list of dicts with worker, leg, count, errors, mean and max in seconds
+    """
+    return read_stats()
@@ -7,12 +7,16 @@
 
 import hashlib
 import json
-import ssl
+import os
+import socket
+import threading
+import time
 from urllib.parse import urlencode
-from urllib.request import urlopen
 
 import requests
 import pkce
+from redis import RedisError
+from requests.adapters import HTTPAdapter
 
 from jwkest.jwk import KEYS
 from jwkest.jws import JWS
@@ -21,10 +25,15 @@ import string
 import random
 import base64
 
-from spz import app
+from spz import app, cache
+from spz.store import redis_client
 
 ISSUER = 'https://oidc.scc.kit.edu/auth/realms/kit'
 
+DISCOVERY_CACHE_KEY = 'oidc_discovery'
+STATS_KEY = 'spz:oidc_stats'
+STATS_MAX_AGE = 60 * 60  # seconds; processes that did not report for this long are left out
+
 
 def make_request_object(request_args, jwk):
     keys = KEYS()
@@ -40,19 +49,6 @@ def base64_urlencode(s):
     return base64.urlsafe_b64encode(s).split('='.encode('utf-8'))[0]
 
 
-def get_ssl_context(config):
-    """
-    :return a ssl context with verify and hostnames settings
-    """
-    ctx = ssl.create_default_context()
-
-    if 'verify_ssl_server' in config and not bool(config['verify_ssl_server']):
-        print('Not verifying ssl certificates')
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-    return ctx
-
-
 def decode_id_token(token: str):
     fragments = token.split(".")
     if len(fragments) != 3:
@@ -63,22 +59,175 @@ def decode_id_token(token: str):
     return json.loads(decoded)
 
 
+class Timings(object):
+    """Duration of the calls to the identity provider, per leg of the flow.
+
+       The numbers of every process are published to Redis, so the latency of the identity provider can be told
+       apart from our own, see :py:func:`read_stats`.
+    """
+
+    def __init__(self):
+        self.legs = {}
+        self.lock = threading.Lock()
+
+    def record(self, leg, duration, failed):
+        with self.lock:
+            stats = self.legs.setdefault(leg, dict(count=0, errors=0, total=0.0, max=0.0))
+            stats['count'] += 1
+            stats['errors'] += int(failed)
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+            payload = json.dumps(dict(legs=self.legs, updated=time.time()))
+        try:
+            redis_client().hset(STATS_KEY, '{}:{}'.format(socket.gethostname(), os.getpid()), payload)
+        except RedisError:
+            pass  # statistics must never break a login
+
+
+def read_stats():
+    """Timings of all processes that reported recently.
+
+       :return: list of dicts with `worker`, `leg`, `count`, `errors`, `mean` and `max` in seconds
+    """
+    now = time.time()
+    result = []
+    for worker, value in sorted(redis_client().hgetall(STATS_KEY).items()):
+        published = json.loads(value)
+        if now - published['updated'] > STATS_MAX_AGE:
+            continue
+        for leg, stats in sorted(published['legs'].items()):
+            result.append(dict(
+                worker=worker.decode('utf-8'),
+                leg=leg,
+                count=stats['count'],
+                errors=stats['errors'],
+                mean=stats['total'] / stats['count'],
+                max=stats['max']
+            ))
+    return result
+
+
+class Discovery(object):
+    """Discovery document of the issuer, fetched on first use.
+
+       The document is kept in this process, in the shared cache and on disk. A document older than
+       `OIDC_DISCOVERY_TTL` is still used while a background thread fetches a fresh one, so only the first login
+       after a cold start with empty caches waits for the issuer.
+
+       :param url: URL of the discovery document
+       :param fetch: function that downloads and parses the document at the given URL
+    """
+
+    def __init__(self, url, fetch):
+        self.url = url
+        self.fetch = fetch
+        self.document = None
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def get(self):
+        if self.is_stale():
+            self.load()
+        document = self.document
+        if document is None:
+            with self.lock:
+                if self.document is None:
+                    self.refresh()
+                document = self.document
+        elif self.is_stale():
+            self.refresh_in_background()
+        return document
+
+    def is_stale(self):
+        return time.time() - self.fetched_at > app.config['OIDC_DISCOVERY_TTL']
+
+    def load(self):
+        """Take the document from the shared cache or disk, if it is newer than ours."""
+        entry = cache.get(DISCOVERY_CACHE_KEY)
+        if entry is None:
+            try:
+                with open(app.config['OIDC_DISCOVERY_FILE']) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return
+        if entry['fetched_at'] > self.fetched_at:
+            self.document, self.fetched_at = entry['document'], entry['fetched_at']
+
+    def refresh(self):
+        document = self.fetch(self.url)
+        entry = dict(document=document, fetched_at=time.time())
+        self.document, self.fetched_at = document, entry['fetched_at']
+
+        cache.set(DISCOVERY_CACHE_KEY, entry, timeout=0)  # staleness is up to us
+        path = app.config['OIDC_DISCOVERY_FILE']
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(entry, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print('Could not store discovery document: {}'.format(e))
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                print('Refreshing discovery document failed, keeping the old one: {}'.format(e))
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
 class Oid_handler:
     def __init__(self):
         self.credentials = {}
-        self.kit_config = {}
-        self.ctx = get_ssl_context(self.kit_config)
         self.meta_data_url = ISSUER + '/.well-known/openid-configuration'
-        print('Fetching config from: %s' % self.meta_data_url)
-        meta_data = urlopen(self.meta_data_url)
-        if meta_data:
-            self.kit_config.update(json.load(meta_data))
-        else:
-            print('Unexpected response on discovery document: %s' % meta_data)
+        self.discovery = Discovery(self.meta_data_url, self.fetch_discovery)
+        self.timings = Timings()
+        self.http = None
+        self.pid = None
 
         self.credentials['client_id'] = app.config['CLIENT_ID']
         self.credentials['secret_key'] = app.config['CLIENT_SECRET']
 
+    @property
+    def kit_config(self):
+        return self.discovery.get()
+
+    def session(self):
+        """HTTP session of this process, keeps the connections to the identity provider open across logins."""
+        if self.http is None or self.pid != os.getpid():
+            self.http = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=app.config['OIDC_POOL_SIZE'], max_retries=2)
+            self.http.mount('https://', adapter)
+            self.http.mount('http://', adapter)
+            self.pid = os.getpid()
+        return self.http
+
+    def call(self, leg, method, url, **kwargs):
+        """Send a request to the identity provider and record its duration for the given leg."""
+        start = time.monotonic()
+        failed = True
+        try:
+            response = self.session().request(method, url, timeout=app.config['OIDC_TIMEOUT'], **kwargs)
+            failed = not response.ok
+            return response
+        finally:
+            self.timings.record(leg, time.monotonic() - start, failed)
+
+    def fetch_discovery(self, url):
+        print('Fetching config from: %s' % url)
+        response = self.call('discovery', 'GET', url)
+        response.raise_for_status()
+        return response.json()
+
     def generate_state(self):
         return ''.join(random.choices(string.ascii_uppercase + string.digits, k=7))
 
@@ -153,7 +302,7 @@ class Oid_handler:
         }
 
         # use requests lib for post request to exchange code for token
-        token_response = requests.post(token_url, data=data)
+        token_response = self.call('token', 'POST', token_url, data=data)
         # write some log entries for easier exception handling
         print("Fetch Token request status code: {}".format(token_response.status_code))
         # write error message to logs, if request is not successful
@@ -172,7 +321,7 @@ class Oid_handler:
             'Authorization': 'Bearer {}'.format(access_token),
         }
         request_url = self.kit_config['userinfo_endpoint']
-        response = requests.get(request_url, headers=header)
+        response = self.call('userinfo', 'GET', request_url, headers=header)
 
         # write some log entries for exception handling
         print("Access Protected resources request status code: {}".format(response.status_code))
@@ -11,7 +11,7 @@ import os
 from flask import make_response
 from flask_login import login_required
 
-from spz import app, models
+from spz import app, models, loading
 from spz.pdf_zip import PdfZipWriter, html_response
 
 
@@ -249,7 +249,7 @@ def list_presence(pdflist, course):
 
 @login_required
 def print_course_presence(course_id):
-    course = models.Course.query.get_or_404(course_id)
+    course = models.Course.query.options(*loading.COURSE).get_or_404(course_id)
     pdflist = PresenceGenerator(course)
     list_presence(pdflist, course)
 
@@ -258,7 +258,7 @@ def print_course_presence(course_id):
 
 @login_required
 def print_language_presence_zip(language_id):
-    language = models.Language.query.get_or_404(language_id)
+    language = models.Language.query.options(*loading.LANGUAGE_COURSES).get_or_404(language_id)
     zip_writer = PdfZipWriter()
     for course in language.courses:
         pdflist = PresenceGenerator(course)
@@ -269,7 +269,7 @@ def print_language_presence_zip(language_id):
 
 @login_required
 def print_language_presence(language_id):
-    language = models.Language.query.get_or_404(language_id)
+    language = models.Language.query.options(*loading.LANGUAGE_COURSES).get_or_404(language_id)
     pdflist = PresenceGenerator()
     for course in language.courses:
         list_presence(pdflist, course)
@@ -321,7 +321,7 @@ def list_course(pdflist, course):
 @login_required
 def print_course(course_id):
     pdflist = CourseGenerator()
-    course = models.Course.query.get_or_404(course_id)
+    course = models.Course.query.options(*loading.COURSE).get_or_404(course_id)
     list_course(pdflist, course)
 
     return pdflist.gen_response(course.full_name)
@@ -329,7 +329,7 @@ def print_course(course_id):
 
 @login_required
 def print_language(language_id):
-    language = models.Language.query.get_or_404(language_id)
+    language = models.Language.query.options(*loading.LANGUAGE_COURSES).get_or_404(language_id)
     pdflist = CourseGenerator('L')
     for course in language.courses:
         list_course(pdflist, course)
@@ -339,7 +339,7 @@ def print_language(language_id):
 
 @login_required
 def print_bill(applicant_id, course_id):
-    attendance = models.Attendance.query.get_or_404((applicant_id, course_id))
+    attendance = models.Attendance.query.options(*loading.ATTENDANCE).get_or_404((applicant_id, course_id))
 
     bill = BillGenerator()
     bill.add_page()
@@ -2,113 +2,119 @@
 
 """Holds popuplation logic."""
 
+import json
 import socket
 from datetime import datetime, timezone
 
 from redis import ConnectionError
 
-from sqlalchemy import orm
+from sqlalchemy import bindparam
 
-from spz import db, models, tasks
+from spz import allocation, allocation_sql, app, db, models, tasks
 
-from spz.mail import generate_status_mail
+from spz.mail import RESTOCK, STATUS
 
 import random
 
 
-def eager_load_waiting():
-    """Eager load all waiting attendances ordered by `registered`."""
-    # eager loading, see (search for 'subqueryload'):
-    # http://docs.sqlalchemy.org/en/rel_0_9/orm/loading_relationships.html
-    return models.Attendance.query \
-        .options(orm.subqueryload(models.Attendance.applicant).subqueryload(models.Applicant.attendances)) \
-        .filter_by(waiting=True) \
-        .order_by(models.Attendance.registered) \
-        .all()
+def send_mails(handled):
+    """Send mails to handled (successful or not) attendances.
 
+       The mails are rendered and sent by the worker, in chunks of `MAIL_BATCH_SIZE`.
 
-def send_mails(attendances):
-    """Send mails to handled (successful or not) attendances."""
-    try:
-        for attendance, informed_before_now in attendances:
-            # consider this a restock if we already send out a "no, sorry" mail
-            restock = informed_before_now
+       :param handled: list of `(applicant_id, course_id, informed_before_now)`
+    """
+    # consider this a restock if we already send out a "no, sorry" mail
+    entries = [
+        (applicant_id, course_id, RESTOCK if informed_before_now else STATUS)
+        for applicant_id, course_id, informed_before_now
+        in handled
+    ]
 
-            tasks.send_slow.delay(
-                generate_status_mail(attendance.applicant, attendance.course, restock=restock),
-            )
+    size = app.config['MAIL_BATCH_SIZE']
+    try:
+        for i in range(0, len(entries), size):
+            tasks.send_status_mails.delay(entries[i:i + size])
 
     except (AssertionError, socket.error, ConnectionError) as e:
         raise e
 
 
-def populate_generic(time, attendance_filter, idx_prepare, idx_select):
+def rnd_order(seed):
+    """Candidate order of the RND procedure, a random permutation that only depends on `seed`."""
+    def order(candidates):
+        # Every remaining candidate is equally likely to be tried next
+        indices = list(range(len(candidates)))
+        random.Random(seed).shuffle(indices)
+        return indices
+    return order
+
+
+def fcfs_order(seed=None):
+    """Candidate order of the FCFS procedure, i.e. by registration time."""
+    def order(candidates):
+        return range(len(candidates))
+    return order
+
+
+orders = {
+    models.PopulateRun.RND: rnd_order,
+    models.PopulateRun.FCFS: fcfs_order,
+}
+
+
+def populate_generic(time, attendance_filter, procedure, seed=None, dry_run=False, course_ids=None):
     """Generic populate implementation.
 
     :param time: current UTC time
-    :param attendance_filter: function that accepts one `Attendance` arguments and must return True if
-                              attendance should be considered for this populate procedure.
-    :param idx_prepare: function that gets a list of all possible attendances and can prepare the
-                        `idx_select` function (see below).
-    :param idx_select: function that gets a list of all remaining but possible attendances and must
-                       return the index of the attendance that should be tried.
+    :param attendance_filter: function that accepts the registration time and the `Language` of a waiting
+                              attendance and must return True if the attendance should be considered for this
+                              populate procedure.
+    :param procedure: populate procedure, selects the candidate order from :py:data:`orders`
+    :param seed: seed for the candidate order
+    :param dry_run: only compute the decisions; nothing gets written, recorded or sent
+    :param course_ids: only consider the waiting lists of these courses, all if None
+    :return: summary of the decisions including the seed, see :py:func:`spz.allocation.summarize`
 
 
     First this method selects all attendances (called candidiates) which:
-    - are not waiting
+    - are waiting
     - where the course is not in manual assignment period anymore
     - where `attendance_filter` return True
 
-    Afterwards, it calls `idx_prepare`. Finally, it loops until no candidiates remain and in every round it:
-    1. calls `idx_select` to select a candidiate.
+    Afterwards, it orders them. Finally, it loops over the ordered candidiates and for every one it:
+    1. checks if the applicant did not already get a course in this round
     2. checks if the candidiate is not signed up for a parallel course
     3. checks if the specified course is not full
     4. if all conditions hold, it signs up the candidate.
 
+    All of this runs on a compact in-memory snapshot, see :py:mod:`spz.allocation`, and the result is written
+    back with bulk statements. RND rounds that decide anything are recorded as :py:class:`PopulateRun`, so a disputed
+    lottery can be replayed with :py:func:`replay`. FCFS rounds only depend on the registration times and run every
+    few minutes, they are not recorded.
+
     Finally, it prepares emails for all candidates that:
     - successfully entered a course
     - got rejected for the first time
     """
-    # only non-manual-mode courses
-    to_assign = [
-        att
-        for att
-        in eager_load_waiting()
-        if attendance_filter(att) and not att.course.language.is_in_manual_mode(time)
-    ]
-
-    # keep track of which attendances we set to active/waiting
-    handled_attendances = []
-    accepted_applicants = []
-
-    to_assign = idx_prepare(to_assign)
+    snapshot, candidates = allocation.load(time, attendance_filter, course_ids)
+    initial = snapshot.copy()  # the engine updates the snapshot in place
+    result = allocation.allocate(snapshot, candidates, orders[procedure](seed)(candidates))
+    summary = dict(allocation.summarize(snapshot, candidates, result), seed=seed)
 
-    while to_assign:
-        attendance = to_assign.pop(idx_select(to_assign))
-
-        # Only assign one course per applicant per round
-        if attendance.applicant in accepted_applicants:
-            continue
-
-        if attendance.applicant.active_in_parallel_course(attendance.course):
-            # XXX: how can this happen? should we send a message to someone?
-            attendance.informed_about_rejection = True
-            continue
-
-        # keep default waiting status
-        if attendance.course.is_full:
-            if not attendance.informed_about_rejection:
-                handled_attendances.append((attendance, attendance.informed_about_rejection))
-                attendance.informed_about_rejection = True
-            continue
-
-        attendance.discount = attendance.applicant.current_discount()
-        attendance.set_waiting_status(False)
-        handled_attendances.append((attendance, attendance.informed_about_rejection))
-        attendance.informed_about_rejection = True
-        accepted_applicants.append(attendance.applicant)
+    if dry_run:
+        return summary
 
     try:
+        handled = allocation.store(snapshot, candidates, result)
+        if procedure == models.PopulateRun.RND and (result.accepted or result.rejected):
+            db.session.add(models.PopulateRun(
+                timestamp=time,
+                procedure=procedure,
+                seed=seed,
+                snapshot=json.dumps(dict(snapshot=initial.to_dict(), candidates=candidates.to_dict())),
+                outcome=json.dumps(summary)
+            ))
         db.session.commit()
         # XXX: send stats somewhere
     except Exception as e:
@@ -116,65 +122,154 @@ def populate_generic(time, attendance_filter, idx_prepare, idx_select):
         raise e
 
     # Send mails (async) only if the commit was successfull -- be conservative here
-    send_mails(handled_attendances)
+    send_mails(handled)
 
+    return summary
 
-def populate_rnd(time):
+
+def replay(run):
+    """Replay a recorded :py:class:`PopulateRun` without touching the database.
+
+       :return: tuple of the summary of the replay and True if it matches the recorded outcome
+    """
+    recorded = json.loads(run.snapshot)
+    snapshot = allocation.Snapshot.from_dict(recorded['snapshot'])
+    candidates = allocation.Candidates.from_dict(recorded['candidates'])
+    result = allocation.allocate(snapshot, candidates, orders[run.procedure](run.seed)(candidates))
+    summary = dict(allocation.summarize(snapshot, candidates, result), seed=run.seed)
+    return summary, json.loads(json.dumps(summary)) == json.loads(run.outcome)
+
+
+def populate_rnd(time, seed=None, dry_run=False, course_ids=None):
     """Run RND populate procedure.
 
        :param time: current UTC time
+       :param seed: seed of the lottery, a fresh one is drawn if None
+       :param dry_run: see :py:func:`populate_generic`
+       :param course_ids: see :py:func:`populate_generic`
     """
 
     # Interval filtering in Python instead of SQL because it's not portable (across SQLite, Postgres, ..)
     # implementable in standard SQL
     # See: https://groups.google.com/forum/#!msg/sqlalchemy/AneqcriykeI/j4sayzZP1qQJ
 
-    def attendance_filter(att):
-        return (att.course.language.signup_begin) < att.registered < (att.course.language.signup_rnd_window_end)
-
-    def idx_prepare(to_assign):
-        # Sort attendances by number of already accepted attendances of applicant. We will therefore prefer applicants
-        # with fewer accepted attendances instead of applicants who have more accepted attendances.
-        return sorted(to_assign, key=lambda attendance: len(attendance.applicant.active_courses()))
+    def attendance_filter(registered, language):
+        return language.signup_begin < registered < language.signup_rnd_window_end
 
-    def idx_select(to_assign):
-        # random selection
-        return random.randint(0, len(to_assign) - 1)
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(32)
 
-    populate_generic(time, attendance_filter, idx_prepare, idx_select)
+    return populate_generic(time, attendance_filter, models.PopulateRun.RND, seed, dry_run, course_ids)
 
 
-def populate_fcfs(time):
+def populate_fcfs(time, dry_run=False, course_ids=None):
     """Run FCFS populate procedure.
 
        :param time: current UTC time
+       :param dry_run: see :py:func:`populate_generic`
+       :param course_ids: see :py:func:`populate_generic`
 
     To ensure fairness, courses are shuffled before fill-up.
+
+    With `POPULATE_BACKEND = 'sql'` the round runs set-based inside the database, see :py:mod:`spz.allocation_sql`.
     """
+    if app.config['POPULATE_BACKEND'] == 'sql':
+        return populate_fcfs_sql(time, dry_run, course_ids)
 
-    def attendance_filter(att):
+    def attendance_filter(registered, language):
         return True
 
-    def idx_prepare(to_assign):
-        return to_assign
+    return populate_generic(time, attendance_filter, models.PopulateRun.FCFS, dry_run=dry_run, course_ids=course_ids)
 
-    def idx_select(to_assign):
-        return 0
 
-    populate_generic(time, attendance_filter, idx_prepare, idx_select)
+def populate_fcfs_sql(time, dry_run=False, course_ids=None):
+    """Run FCFS populate procedure with the SQL backend.
 
+       :param time: current UTC time
+       :param dry_run: run all statements but roll back instead of committing
+       :param course_ids: see :py:func:`populate_generic`
+    """
+    try:
+        summary, handled = allocation_sql.fcfs(time, course_ids)
+        if dry_run:
+            db.session.rollback()
+            return dict(summary, seed=None)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    send_mails(handled)
+
+    return dict(summary, seed=None)
+
+
+def dirty_courses(time, full=False):
+    """Courses whose waiting lists the next populate run has to process.
+
+       :param time: current UTC time
+       :param full: return all courses, not only the dirty ones
+       :return: dict of course ID to the revision the run is based on
+
+       Courses in manual assignment mode are left out, so they stay dirty until the mode ends.
+    """
+    query = db.session.query(models.Course.id, models.Course.revision) \
+        .join(models.Language) \
+        .filter(models.Language.signup_manual_end <= time, models.Language.signup_auto_end >= time)
+    if not full:
+        query = query.filter(models.Course.is_dirty)
+    return dict(query)
 
-def update_waiting_list_status():
-    """Update waiting list status of all courses."""
-    courses = models.Course.query.all()
-    for c in courses:
+
+def mark_populated(revisions, deferred):
+    """Mark courses as processed by a populate run.
+
+       :param revisions: dict of course ID to the revision the run was based on, see :py:func:`dirty_courses`
+       :param deferred: IDs of courses that still hold candidates who were skipped because they got another course
+                        in this run; these stay dirty for the next one
+
+       Courses that changed while the run was in progress have a newer revision and stay dirty as well.
+    """
+    table = models.Course.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.id == bindparam('b_id'))
+        .values(populated_revision=bindparam('b_revision')),
+        [dict(b_id=course_id, b_revision=revision) for course_id, revision in revisions.items()]
+    )
+    if deferred:
+        db.session.execute(table.update().where(table.c.id.in_(deferred)).values(revision=table.c.revision + 1))
+    db.session.commit()
+
+
+def update_waiting_list_status(course_ids=None):
+    """Update waiting list status of courses.
+
+       :param course_ids: IDs of the courses to update, all if None
+    """
+    query = models.Course.query
+    if course_ids is not None:
+        query = query.filter(models.Course.id.in_(course_ids))
+    for c in query.all():
         c.has_waiting_list = c.is_full
     db.session.commit()
 
 
-def populate_global():
-    """Run global populate procedure as discussed with management."""
+def populate_global(full=False):
+    """Run global populate procedure as discussed with management.
+
+       :param full: process the waiting lists of all courses instead of only the ones that changed since the last
+                    run, see :py:meth:`Course.mark_dirty`. This is the periodic safety net.
+    """
     time = datetime.now(timezone.utc).replace(tzinfo=None)
-    populate_rnd(time)
-    populate_fcfs(time)
-    update_waiting_list_status()
+    revisions = dirty_courses(time, full)
+    if not revisions:
+        return
+
+    course_ids = None if full else list(revisions)
+    deferred = set()
+    for summary in (populate_rnd(time, course_ids=course_ids), populate_fcfs(time, course_ids=course_ids)):
+        deferred.update(course_id for _, course_id in summary['deferred'])
+
+    mark_populated(revisions, deferred)
+    update_waiting_list_status(course_ids)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""Background import of the registration numbers.
+
+   Hashing a registration number runs argon2 and a list holds tens of thousands of them, too many for one request
+   and too slow for one process. The upload is streamed into chunks of `REGISTRATION_IMPORT_CHUNK_SIZE` numbers,
+   which the `hash_registrations` task hashes in parallel on the Celery workers. Their hashes are collected in a Redis
+   set. Once the last chunk is done, `apply_registrations` diffs that set against the table and only deletes and
+   inserts the rows that changed.
+
+   The cleartext chunks expire after `REGISTRATION_IMPORT_TTL` at the latest and are deleted as soon as they got
+   hashed. Only one import runs at a time.
+"""
+
+import uuid
+
+from spz import app, db, models, store
+from spz.taghash import normalize
+
+
+STATUS = 'spz:registrations:import'
+LOCK = 'spz:registrations:import:lock'
+SALTED = 'spz:registrations:import:{}:salted'
+CHUNK = 'spz:registrations:import:{}:chunk:{}'
+
+DELETE_BATCH_SIZE = 1000
+
+
+def read_lines(fp):
+    """Stream the non-empty, stripped lines of an uploaded file."""
+    for line in fp:
+        line = line.decode('utf-8', 'ignore').strip()
+        if line:
+            yield line
+
+
+def start(fp):
+    """Split the upload into chunks of unique, normalized registration numbers stored in Redis.
+
+       :param fp: binary file object, one registration number per line
+       :return: tuple of the import ID and the list of chunk keys to hash, None if another import is still running
+    """
+    client = store.redis_client()
+    ttl = app.config['REGISTRATION_IMPORT_TTL']
+    if not client.set(LOCK, 1, nx=True, ex=ttl):
+        return None
+
+    import_id = uuid.uuid4().hex
+    size = app.config['REGISTRATION_IMPORT_CHUNK_SIZE']
+    seen = set()
+    keys = []
+    chunk = []
+
+    def flush():
+        key = CHUNK.format(import_id, len(keys))
+        client.set(key, '\n'.join(chunk), ex=ttl)
+        keys.append(key)
+        chunk.clear()
+
+    for line in read_lines(fp):
+        tag = normalize(line)
+        if tag in seen:
+            continue
+        seen.add(tag)
+        chunk.append(tag)
+        if len(chunk) == size:
+            flush()
+    if chunk:
+        flush()
+
+    client.delete(STATUS)
+    client.hset(STATUS, mapping=dict(id=import_id, state='running', total=len(seen), hashed=0, pending=len(keys)))
+    client.expire(STATUS, ttl)
+    return import_id, keys
+
+
+def is_running(client, import_id):
+    """Whether the import is still the current one and has neither failed nor finished."""
+    return client.hmget(STATUS, 'id', 'state') == [import_id.encode(), b'running']
+
+
+def hash_chunk(import_id, key):
+    """Hash one chunk of registration numbers into the collected set.
+
+       Hashes bypass :py:data:`spz.models.hash_tag`, their cleartext should not end up in its process-wide LRU.
+
+       :return: True if this was the last chunk of the import
+    """
+    client = store.redis_client()
+    if not is_running(client, import_id):
+        client.delete(key)
+        return False
+
+    data = client.get(key)
+    if data is None:
+        raise KeyError(key)
+
+    tags = data.decode('utf-8').split('\n')
+    salted = SALTED.format(import_id)
+    client.sadd(salted, *(models.hash_secret_weak(tag) for tag in tags))
+    client.expire(salted, app.config['REGISTRATION_IMPORT_TTL'])
+    client.delete(key)
+
+    client.hincrby(STATUS, 'hashed', len(tags))
+    return client.hincrby(STATUS, 'pending', -1) <= 0
+
+
+def apply(import_id):
+    """Replace the registrations with the collected set, touching only the rows that differ.
+
+       :return: tuple of the numbers of deleted and added rows
+    """
+    client = store.redis_client()
+    if not is_running(client, import_id):
+        return 0, 0
+
+    table = models.Registration.__table__
+    try:
+        salted = client.smembers(SALTED.format(import_id))
+        existing = {bytes(row[0]) for row in db.session.query(models.Registration.salted)}
+        removed = list(existing - salted)
+        added = list(salted - existing)
+
+        for i in range(0, len(removed), DELETE_BATCH_SIZE):
+            db.session.execute(table.delete().where(table.c.salted.in_(removed[i:i + DELETE_BATCH_SIZE])))
+        if added:
+            db.session.execute(table.insert(), [dict(salted=s) for s in added])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        client.hset(STATUS, mapping=dict(state='failed', error=str(e)))
+        raise
+    finally:
+        client.delete(SALTED.format(import_id), LOCK)
+
+    client.hset(STATUS, mapping=dict(state='done', deleted=len(removed), added=len(added)))
+    return len(removed), len(added)
+
+
+def fail(import_id, error):
+    """Abort the import, e.g. after a chunk could not be hashed."""
+    client = store.redis_client()
+    if is_running(client, import_id):
+        client.hset(STATUS, mapping=dict(state='failed', error=str(error)))
+        client.delete(SALTED.format(import_id), LOCK)
+
+
+def status():
+    """State and counters of the running or last import, None if there was none lately."""
+    data = store.redis_client().hgetall(STATUS)
+    if not data:
+        return None
+    result = {key.decode(): value.decode() for key, value in data.items()}
+    for key in ('total', 'hashed', 'pending', 'deleted', 'added'):
+        if key in result:
+            result[key] = int(result[key])
+    return result
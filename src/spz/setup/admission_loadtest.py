@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Load test of the admission queue against a running instance.
+
+   Simulates applicants that hit the waiting room of a queued course at the same time and poll it until they are
+   admitted. Reports the latency of the waiting room and exits with 1 if its 95th percentile exceeds the bound::
+
+      python -m spz.setup.admission_loadtest http://localhost:3000 --course 1 --clients 500
+
+   The language of the course has to be listed in `ADMISSION_RATES` and be within `ADMISSION_WINDOW` of an opening.
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+import requests
+
+
+def applicant(url, poll, duration, latencies, admitted):
+    session = requests.Session()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        response = session.get(url, allow_redirects=False)
+        latencies.append(time.monotonic() - start)
+        if response.status_code in (302, 303) and '/waiting/' not in response.headers.get('Location', ''):
+            admitted.append(time.monotonic())
+            return
+        time.sleep(poll)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the admission queue of a running instance.')
+    parser.add_argument('base_url', help='URL of the instance, e.g. http://localhost:3000')
+    parser.add_argument('--course', type=int, required=True, help='ID of a course of a queued language')
+    parser.add_argument('--clients', type=int, default=200, help='number of simulated applicants')
+    parser.add_argument('--poll', type=float, default=5, help='seconds between two polls of one applicant')
+    parser.add_argument('--duration', type=float, default=120, help='seconds until the test stops')
+    parser.add_argument('--max-latency', type=float, default=0.5, help='bound for the 95th percentile in seconds')
+
+    args = parser.parse_args()
+    url = '{}/waiting/{}'.format(args.base_url.rstrip('/'), args.course)
+    latencies = []
+    admitted = []
+
+    begin = time.monotonic()
+    threads = [
+        threading.Thread(target=applicant, args=(url, args.poll, args.duration, latencies, admitted))
+        for _ in range(args.clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    p95 = percentile(latencies, 0.95)
+    print('{} requests, {} of {} applicants admitted'.format(len(latencies), len(admitted), args.clients))
+    print('latency p50 {:.3f}s, p95 {:.3f}s, max {:.3f}s'.format(
+        percentile(latencies, 0.5), p95, max(latencies, default=0)
+    ))
+    if admitted:
+        print('admitted within {:.1f}s'.format(max(admitted) - begin))
+    sys.exit(1 if p95 > args.max_latency else 0)
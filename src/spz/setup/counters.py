@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Check and rebuild the denormalized attendance counters of all courses.
+
+   Report courses whose counters do not match their attendances, exits with 1 if there are any::
+
+      python -m spz.setup.counters check
+
+   Recompute the counters of all courses::
+
+      python -m spz.setup.counters rebuild
+"""
+
+import argparse
+import sys
+
+from spz import app, counters, db
+
+
+def check(args):
+    mismatches = counters.check()
+    for course_id, stored, actual in mismatches:
+        print('course {}: stored {}, actual {}'.format(
+            course_id,
+            dict(zip(counters.COUNTERS, stored)),
+            dict(zip(counters.COUNTERS, actual))
+        ))
+    print('{} course(s) with wrong counters'.format(len(mismatches)))
+    if mismatches:
+        sys.exit(1)
+
+
+def rebuild(args):
+    counters.rebuild()
+    db.session.commit()
+    print('counters rebuilt')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check and rebuild the attendance counters of all courses.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('check', help='compare the counters with the attendances').set_defaults(func=check)
+    commands.add_parser('rebuild', help='recompute the counters').set_defaults(func=rebuild)
+
+    args = parser.parse_args()
+    with app.app_context():
+        args.func(args)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Audit the query plans of the hot lookups for sequential scans on large tables.
+
+   Fills the database with a generated dataset, runs `EXPLAIN` on the top queries of the endpoints and exits with 1
+   if any of them scans a large table sequentially. Everything runs in one transaction that is rolled back at the
+   end, so the generated data never becomes visible::
+
+      python -m spz.setup.explain --applicants 20000
+
+   Use an empty or disposable database anyway, the generated rows are not meant to coexist with real data.
+"""
+
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, text
+
+from spz import app, db, models
+
+
+def generate(applicants):
+    """Insert a synthetic dataset of the given size, bypassing the ORM to stay fast."""
+    course_ids = [course_id for course_id, in db.session.query(models.Course.id)]
+    if len(course_ids) < 2:
+        sys.exit('at least two courses are needed, run python -m spz.setup.init_db first')
+
+    random.seed(0)
+    now = datetime.utcnow()
+    first_id = (db.session.query(func.max(models.Applicant.id)).scalar() or 0) + 1
+    ids = range(first_id, first_id + applicants)
+
+    db.session.execute(models.Applicant.__table__.insert(), [
+        dict(id=id, mail='explain-{}@example.invalid'.format(id), tag=str(1000000 + id),
+             first_name='Mika', last_name='Müller')
+        for id in ids
+    ])
+    db.session.execute(models.Attendance.__table__.insert(), [
+        dict(applicant_id=id, course_id=course_id, waiting=random.random() < 0.05, discount=0, amountpaid=0,
+             registered=now - timedelta(seconds=random.randrange(60 * 60 * 24 * 14)))
+        for id in ids
+        for course_id in random.sample(course_ids, 2)
+    ])
+    db.session.execute(models.Approval.__table__.insert(), [
+        dict(tag_salted=os.urandom(32), percent=random.randrange(101), sticky=False, priority=False)
+        for _ in ids
+    ])
+    db.session.execute(models.Registration.__table__.insert(), [dict(salted=os.urandom(32)) for _ in ids])
+    db.session.execute(models.OAuthToken.__table__.insert(), [
+        dict(state=os.urandom(16).hex(), code_verifier=os.urandom(16).hex()) for _ in ids
+    ])
+    db.session.execute(models.LogEntry.__table__.insert(), [
+        dict(timestamp=now - timedelta(seconds=id), msg='explain') for id in ids
+    ])
+    models.ApprovalSummary.refresh()
+    db.session.execute('ANALYZE')
+
+    return first_id, course_ids[0]
+
+
+def top_queries(applicant_id, course_id):
+    """The hot lookups of the endpoints, keyed by endpoint and purpose."""
+    applicant = models.Applicant.query.get(applicant_id)
+    salted = models.Approval.query.first().tag_salted
+    state = models.OAuthToken.query.first().state
+
+    return {
+        'signup: registration': models.Registration.query.filter(models.Registration.salted == salted),
+        'signup: applicant by mail': models.Applicant.query.filter(
+            func.lower(models.Applicant.mail) == func.lower(applicant.mail)
+        ),
+        'signup: approvals of tag': models.Approval.query.filter(models.Approval.tag_salted == salted),
+        'signup: best rating': models.ApprovalSummary.query.filter(models.ApprovalSummary.tag_salted == salted),
+        'oidc: token by state': models.OAuthToken.for_state(state),
+        'login: user by mail': models.User.query.filter(func.lower(models.User.email) == 'explain@example.invalid'),
+        'applicant: attendances': models.Attendance.query.filter(models.Attendance.applicant_id == applicant_id),
+        'applicant: doppelgangers': models.Applicant.query.filter(
+            models.Applicant.tag == applicant.tag,
+            models.Applicant.mail != applicant.mail
+        ),
+        'course: attendances': models.Attendance.query.filter(models.Attendance.course_id == course_id),
+        'populate: waiting list': models.Attendance.query.filter(
+            models.Attendance.waiting == True  # NOQA
+        ).order_by(models.Attendance.registered),
+        'internal: log': models.LogEntry.query.order_by(models.LogEntry.timestamp.desc()).limit(20),
+    }
+
+
+def sequential_scans(plan):
+    """Names of all relations in a JSON plan that are scanned sequentially."""
+    scans = [plan['Relation Name']] if plan['Node Type'] == 'Seq Scan' else []
+    for child in plan.get('Plans', []):
+        scans += sequential_scans(child)
+    return scans
+
+
+def explain(query):
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    result = db.session.connection().execute('EXPLAIN (FORMAT JSON) {}'.format(compiled), compiled.params)
+    return result.scalar()[0]['Plan']
+
+
+def audit(args):
+    applicant_id, course_id = generate(args.applicants)
+
+    large = {
+        name
+        for name, in db.session.execute(
+            text("SELECT relname FROM pg_class WHERE relkind = 'r' AND reltuples >= :min_rows"),
+            dict(min_rows=args.min_rows)
+        )
+    }
+
+    failures = 0
+    for name, query in top_queries(applicant_id, course_id).items():
+        plan = explain(query)
+        scans = [relation for relation in sequential_scans(plan) if relation in large]
+        print('{:<30} {:<20} cost {:>10}  {}'.format(
+            name, plan['Node Type'], plan['Total Cost'], 'SEQ SCAN ON ' + ', '.join(scans) if scans else 'ok'
+        ))
+        failures += bool(scans)
+
+    print('{} of the queries scan large tables sequentially'.format(failures))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Audit the query plans of the hot lookups for sequential scans.')
+    parser.add_argument('--applicants', type=int, default=20000, help='size of the generated dataset')
+    parser.add_argument('--min-rows', type=int, default=5000, help='tables with at least this many rows are large')
+
+    args = parser.parse_args()
+    with app.app_context():
+        try:
+            failures = audit(args)
+        finally:
+            db.session.rollback()
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark the course list exports on a language with many attendances.
+
+   Fills the courses of one language with generated active attendances, then runs the overview export of the
+   language and the course list export of all its courses in every export format. Reports the generation time, the
+   number of queries and the peak memory of every run, and exits with 1 if one takes longer than the bound.
+   Everything runs in one transaction that is rolled back at the end::
+
+      python -m spz.setup.export_benchmark --attendances 5000
+
+   Use an empty or disposable database anyway, the generated rows are not meant to coexist with real data.
+"""
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func
+
+from spz import app, db, models
+from spz.export import export_course_list, export_overview_list
+
+
+def generate(language, attendances):
+    """Insert active attendances spread over the courses of the language, bypassing the ORM to stay fast."""
+    course_ids = [course.id for course in language.courses]
+    if not course_ids:
+        sys.exit('the language has no courses, run python -m spz.setup.init_db first')
+
+    random.seed(0)
+    now = datetime.utcnow()
+    first_id = (db.session.query(func.max(models.Applicant.id)).scalar() or 0) + 1
+    ids = range(first_id, first_id + attendances)
+
+    db.session.execute(models.Applicant.__table__.insert(), [
+        dict(id=id, mail='benchmark-{}@example.invalid'.format(id), tag=str(1000000 + id),
+             first_name=random.choice(['Mika', 'Max', 'Alex']), last_name='Müller {}'.format(id % 997))
+        for id in ids
+    ])
+    db.session.execute(models.Attendance.__table__.insert(), [
+        dict(applicant_id=id, course_id=course_ids[i % len(course_ids)], waiting=False, discount=0,
+             amountpaid=0, grade=random.randrange(101), ects_points=0,
+             registered=now - timedelta(seconds=random.randrange(60 * 60 * 24 * 14)))
+        for i, id in enumerate(ids)
+    ])
+    db.session.flush()
+
+
+def measure(name, export):
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        response = export()
+        duration = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    print('{:<40} {:>8.2f} s {:>8} queries {:>8.1f} MiB peak {:>10} bytes'.format(
+        name, duration, len(statements), peak / 2 ** 20, len(response.data)
+    ))
+    return duration
+
+
+def benchmark(args):
+    language = models.Language.query.get(args.language) if args.language else models.Language.query.first()
+    if language is None:
+        sys.exit('no language found, run python -m spz.setup.init_db first')
+    generate(language, args.attendances)
+    db.session.expire_all()
+
+    durations = []
+    for format in models.ExportFormat.query.all():
+        durations.append(measure('overview, {}'.format(format.name), lambda: export_overview_list(language, format)))
+        durations.append(measure(
+            'course list, {}'.format(format.name), lambda: export_course_list(list(language.courses), format)
+        ))
+    return max(durations, default=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the course list exports.')
+    parser.add_argument('--language', type=int, help='ID of the language to fill, the first one by default')
+    parser.add_argument('--attendances', type=int, default=5000, help='number of generated attendances')
+    parser.add_argument('--max-seconds', type=float, default=30, help='bound for the duration of one export')
+
+    args = parser.parse_args()
+    with app.app_context():
+        try:
+            slowest = benchmark(args)
+        finally:
+            db.session.rollback()
+    sys.exit(1 if slowest > args.max_seconds else 0)
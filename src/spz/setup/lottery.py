@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Simulate and replay populate rounds without changing any attendance.
+
+   Simulate the next round, optionally with a fixed seed::
+
+      python -m spz.setup.lottery simulate [--seed SEED] [--fcfs]
+
+   Replay a recorded round and check that it leads to the same decisions::
+
+      python -m spz.setup.lottery replay RUN_ID
+"""
+
+import argparse
+import sys
+from datetime import datetime, timezone
+
+from spz import app
+from spz.models import Course, PopulateRun
+from spz.populate import populate_fcfs, populate_rnd, replay
+
+
+def print_summary(summary):
+    names = {str(course.id): course.full_name for course in Course.query}
+
+    for course_id, (accepted, remaining) in sorted(summary['fill'].items(), key=lambda x: names.get(x[0], x[0])):
+        print('  {}: {} accepted, {} remaining'.format(names.get(course_id, course_id), accepted, remaining))
+
+    restock = len([mail for mail in summary['mails'] if mail[2]])
+    print('accepted: {}'.format(len(summary['accepted'])))
+    print('rejected: {}'.format(len(summary['rejected'])))
+    print('active in parallel course: {}'.format(len(summary['parallel'])))
+    print('mails: {} ({} restock)'.format(len(summary['mails']), restock))
+
+
+def simulate(args):
+    time = datetime.now(timezone.utc).replace(tzinfo=None)
+    if args.fcfs:
+        summary = populate_fcfs(time, dry_run=True)
+    else:
+        summary = populate_rnd(time, seed=args.seed, dry_run=True)
+        print('seed: {}'.format(summary['seed']))
+    print_summary(summary)
+
+
+def replay_run(args):
+    run = PopulateRun.query.get(args.run_id)
+    if run is None:
+        print('No populate run with ID {}'.format(args.run_id))
+        sys.exit(1)
+
+    summary, matches = replay(run)
+    print('{} (seed: {})'.format(run, run.seed))
+    print_summary(summary)
+    print('outcome matches record' if matches else 'OUTCOME DIFFERS FROM RECORD')
+    if not matches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate and replay populate rounds.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_simulate = commands.add_parser('simulate', help='dry run of the next round against the current data')
+    parser_simulate.add_argument('--seed', type=int, default=None, help='seed of the lottery')
+    parser_simulate.add_argument('--fcfs', action='store_true', help='simulate the FCFS instead of the RND round')
+    parser_simulate.set_defaults(func=simulate)
+
+    parser_replay = commands.add_parser('replay', help='replay a recorded round')
+    parser_replay.add_argument('run_id', type=int)
+    parser_replay.set_defaults(func=replay_run)
+
+    args = parser.parse_args()
+    with app.app_context():
+        args.func(args)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""Pooled SMTP connection of the mail workers.
+
+   Every worker process keeps one SMTP connection open across tasks, instead of a handshake per message. The
+   throughput of every process is published to Redis, so it can be shown on the task queue page.
+"""
+
+import json
+import os
+import smtplib
+import socket
+import time
+
+from flask_mail import Connection
+from redis import RedisError
+
+from spz.store import redis_client
+
+
+STATS_KEY = 'spz:smtp_stats'
+STATS_MAX_AGE = 60 * 60  # seconds; processes that did not report for this long are left out
+
+
+class ConnectionPool(object):
+    """Holds one SMTP connection per process.
+
+       Flask-Mail reconnects on its own after `MAIL_MAX_EMAILS` messages. A connection that was idle for more than
+       :py:data:`CHECK_AFTER` seconds gets checked with NOOP first. On any error the connection is dropped and the
+       error is raised, so the task can retry with a fresh one.
+
+       :param mail: the Flask-Mail extension
+    """
+
+    CHECK_AFTER = 30  # seconds
+
+    def __init__(self, mail):
+        self.mail = mail
+        self.connection = None
+        self.pid = None
+        self.last_used = 0
+
+        self.sent = 0
+        self.connects = 0
+        self.busy = 0.0  # seconds spent sending
+
+    def healthy(self):
+        if self.connection.host is None:  # MAIL_SUPPRESS_SEND
+            return True
+        try:
+            return self.connection.host.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def get(self):
+        if self.connection is not None and self.pid != os.getpid():
+            self.connection = None  # inherited from the parent process, not ours to close
+        if self.connection is not None and time.monotonic() - self.last_used > self.CHECK_AFTER and not self.healthy():
+            self.discard()
+        if self.connection is None:
+            self.connection = Connection(self.mail).__enter__()
+            self.pid = os.getpid()
+            self.connects += 1
+        return self.connection
+
+    def discard(self):
+        connection, self.connection = self.connection, None
+        if connection is not None and connection.host is not None:
+            try:
+                connection.host.quit()
+            except (smtplib.SMTPException, socket.error):
+                connection.host.close()
+
+    def send(self, msg):
+        start = time.monotonic()
+        try:
+            self.get().send(msg)
+        except Exception:
+            self.discard()
+            raise
+        self.last_used = time.monotonic()
+        self.busy += self.last_used - start
+        self.sent += 1
+
+    def publish(self):
+        """Report the throughput of this process, see :py:func:`read_stats`."""
+        stats = dict(sent=self.sent, connects=self.connects, busy=self.busy, updated=time.time())
+        try:
+            redis_client().hset(STATS_KEY, '{}:{}'.format(socket.gethostname(), os.getpid()), json.dumps(stats))
+        except RedisError:
+            pass  # statistics must never make a sent mail look failed
+
+
+def read_stats():
+    """Throughput of all mail worker processes that reported recently.
+
+       :return: list of dicts with `worker`, `sent`, `connects`, `rate` in messages per second while sending and
+                `updated` as UNIX timestamp
+    """
+    now = time.time()
+    result = []
+    for worker, value in sorted(redis_client().hgetall(STATS_KEY).items()):
+        stats = json.loads(value)
+        if now - stats['updated'] > STATS_MAX_AGE:
+            continue
+        stats['worker'] = worker.decode('utf-8')
+        stats['rate'] = stats['sent'] / stats['busy'] if stats['busy'] else 0
+        result.append(stats)
+    return result
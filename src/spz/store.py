@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Shared Redis storage for data that web and worker processes exchange outside of task payloads.
+
+   Uses the Redis instance of the Celery broker.
+"""
+
+import hashlib
+
+from redis import StrictRedis
+
+from spz import app
+
+
+BLOB_TTL = 60 * 60 * 24 * 7  # seconds; long enough for retries of queued mails
+
+_client = None
+
+
+def redis_client():
+    """Redis client of this process, connections are pooled by redis-py."""
+    global _client
+    if _client is None:
+        _client = StrictRedis.from_url(app.config['CELERY_BROKER_URL'])
+    return _client
+
+
+def put_blob(data):
+    """Store binary data once, keyed by its content hash.
+
+       :param data: bytes to store
+       :return: hex SHA-256 digest to reference the data in task payloads
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    redis_client().set('spz:blob:{}'.format(digest), data, ex=BLOB_TTL)
+    return digest
+
+
+def get_blob(digest):
+    """Load data stored with :py:func:`put_blob`.
+
+       :raises KeyError: if the data expired or never existed
+    """
+    data = redis_client().get('spz:blob:{}'.format(digest))
+    if data is None:
+        raise KeyError(digest)
+    return data
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""Memoized hashing of tags (registration numbers).
+
+   Hashing a tag runs argon2, which is slow on purpose. One signup checks the same tag against the registrations and
+   approvals several times, exports do it for every applicant. Hashes are therefore memoized for the running request
+   and in a bounded LRU of the process, whose entries expire after a while.
+"""
+
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import g, has_request_context
+
+
+def normalize(tag):
+    """Normalized tag as it is hashed, tags are case insensitive."""
+    return tag.lower() if tag else ''
+
+
+def hash_all(hash_function, tags, processes=1, chunksize=500):
+    """Hash many normalized tags at once, bypassing the memos.
+
+       The tags are hashed on a pool of processes if there are more than one chunk of them. Children of daemonic
+       processes, like Celery workers, cannot start a pool and hash serially.
+
+       :param hash_function: picklable function that hashes a normalized tag to binary data
+       :param tags: iterable of normalized tags, without duplicates
+       :param processes: size of the pool
+       :param chunksize: tags sent to a process at once
+       :return: dict of tag to hash
+    """
+    tags = list(tags)
+    if processes > 1 and len(tags) > chunksize and not multiprocessing.current_process().daemon:
+        with ProcessPoolExecutor(processes) as executor:
+            hashed = list(executor.map(hash_function, tags, chunksize=chunksize))
+    else:
+        hashed = [hash_function(tag) for tag in tags]
+    return dict(zip(tags, hashed))
+
+
+class TagHasher:
+    """Hash tags with a memo per request and a process-wide LRU.
+
+       :param hash_function: function that hashes a normalized tag to binary data
+       :param size: maximum number of hashes the LRU keeps
+       :param ttl: seconds until an entry of the LRU expires
+    """
+
+    def __init__(self, hash_function, size, ttl):
+        self.hash_function = hash_function
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # normalized tag -> (expires, hashed)
+        self.request_hits = 0
+        self.process_hits = 0
+        self.misses = 0
+
+    def __call__(self, tag):
+        key = normalize(tag)
+
+        memo = self.request_memo()
+        if key in memo:
+            self.request_hits += 1
+            return memo[key]
+
+        hashed = self.lookup(key)
+        if hashed is None:
+            self.misses += 1
+            hashed = self.hash_function(key)
+            self.store(key, hashed)
+        else:
+            self.process_hits += 1
+
+        memo[key] = hashed
+        return hashed
+
+    @staticmethod
+    def request_memo():
+        """Memo of the running request, a throwaway dict outside of requests."""
+        if not has_request_context():
+            return {}
+        if 'tag_hashes' not in g:
+            g.tag_hashes = {}
+        return g.tag_hashes
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, hashed = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return hashed
+
+    def store(self, key, hashed):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, hashed)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Hit and miss counters of this process."""
+        return dict(
+            request_hits=self.request_hits,
+            process_hits=self.process_hits,
+            misses=self.misses,
+            size=len(self.entries)
+        )
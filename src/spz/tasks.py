@@ -3,20 +3,40 @@
 """Celery tasks.
 """
 
+import time
+from datetime import datetime
+
 from celery import Celery
+from flask_mail import Message
+
+from spz import app, db, mail, models, registration_import
 
-from spz import app, mail
+from spz.mail import RESTOCK, STATUS, generate_notification_mail, generate_status_mails
+from spz.smtp import ConnectionPool
 
 from spz.iliasharvester import refresh
+from spz.ingest import drain
+from spz.maildomains import domains, known_domains
 from spz.populate import populate_global
 
 
 __all__ = [
+    'apply_registrations',
     'cel',
+    'hash_registrations',
+    'ingest_signups',
+    'notification_mails',
+    'plain_mail',
     'populate',
+    'import_registrations',
+    'purge_oauth_tokens',
+    'purge_populate_runs',
     'send_slow',
     'send_quick',
+    'send_status_mails',
+    'status_mail',
     'sync_ilias',
+    'warm_mail_domains',
 ]
 
 
@@ -39,30 +59,179 @@ def make_celery(app):
 
 cel = make_celery(app)
 
+# one SMTP connection per worker process, shared by all mail tasks
+pool = ConnectionPool(mail)
 
-@cel.task(bind=True, rate_limit='20/m')
-def send_slow(self, msg):
+SLOW_RATE_LIMIT = 20  # mails per minute on the slow queue
+QUICK_RATE_LIMIT = 30  # mails per minute on the default queue
+
+
+def send(task, msg):
     try:
-        mail.send(msg)
+        pool.send(msg)
     except Exception as e:
-        raise self.retry(exc=e)
+        raise task.retry(exc=e)
+    finally:
+        pool.publish()
+
 
+@cel.task(bind=True, rate_limit='{}/m'.format(SLOW_RATE_LIMIT), serializer='pickle')
+def send_slow(self, msg):
+    send(self, msg)
 
-@cel.task(bind=True, rate_limit='30/m')
+
+@cel.task(bind=True, rate_limit='{}/m'.format(QUICK_RATE_LIMIT), serializer='pickle')
 def send_quick(self, msg):
+    send(self, msg)
+
+
+@cel.task(bind=True, rate_limit='{}/m'.format(SLOW_RATE_LIMIT))
+def status_mail(self, applicant_id, course_id, restock=False, time=None):
+    """Render and send the status mail of one attendance.
+
+       Call it after the change of the attendance got committed, the mail reflects the state at rendering time.
+
+       :param time: ISO format time of the signup in UTC, decides between the lottery and waiting list mail; the
+                    rendering time if None
+    """
+    time = datetime.fromisoformat(time) if time else None
+    for _, msg in generate_status_mails([(applicant_id, course_id, RESTOCK if restock else STATUS)], time=time):
+        send(self, msg)
+
+
+@cel.task(bind=True)
+def notification_mails(self, sender, recipients, subject, html, cc=None, bcc=None, attachments=(), done=0):
+    """Send a notification to many recipients, `MAIL_BCC_BATCH_SIZE` of them per mail as BCC.
+
+       `cc` and `bcc` only go with the first mail. The progress is reported as `PROGRESS` state with `sent` and
+       `total` recipients. On failure, only the recipients that did not get the mail yet are retried.
+
+       :param attachments: see :py:func:`spz.mail.generate_notification_mail`
+       :param done: number of recipients that got the mail in earlier attempts
+    """
+    size = app.config['MAIL_BCC_BATCH_SIZE']
+    total = done + len(recipients)
+    sent = 0
+    try:
+        for sent in range(0, len(recipients), size):
+            self.update_state(state='PROGRESS', meta=dict(sent=done + sent, total=total))
+            first = done + sent == 0
+            pool.send(generate_notification_mail(
+                sender,
+                [sender],
+                subject,
+                html,
+                cc if first else None,
+                ((bcc or []) if first else []) + recipients[sent:sent + size],
+                attachments
+            ))
+            time.sleep(60 / SLOW_RATE_LIMIT)
+        sent = len(recipients)
+    except Exception as e:
+        raise self.retry(
+            args=(sender, recipients[sent:], subject, html, cc, bcc, attachments),
+            kwargs=dict(done=done + sent),
+            exc=e
+        )
+    finally:
+        pool.publish()
+
+    return dict(sent=total, total=total)
+
+
+@cel.task(bind=True, rate_limit='{}/m'.format(QUICK_RATE_LIMIT))
+def plain_mail(self, sender, recipients, subject, body):
+    """Send a short plain text mail."""
+    send(self, Message(sender=sender, recipients=recipients, subject=subject, body=body, charset='utf-8'))
+
+
+@cel.task(bind=True)
+def send_status_mails(self, entries):
+    """Render and send a chunk of status mails over the pooled SMTP connection.
+
+       The slow queue rate limit applies per mail. On failure, only the unsent rest of the chunk is retried.
+
+       :param entries: list of `(applicant_id, course_id, kind)` or `(applicant_id, course_id, kind, time)`, see
+                       :py:func:`spz.mail.generate_status_mails`
+    """
+    sent = 0
     try:
-        mail.send(msg)
+        for entry, msg in generate_status_mails(entries):
+            pool.send(msg)
+            sent = entries.index(entry, sent) + 1
+            time.sleep(60 / SLOW_RATE_LIMIT)
     except Exception as e:
-        raise self.retry(exc=e)
+        raise self.retry(args=(entries[sent:],), exc=e)
+    finally:
+        pool.publish()
 
 
 @cel.task
-def populate():
+def populate(full=False):
     # don't catch exception because task is stateless and will be rescheduled
-    populate_global()
+    populate_global(full)
 
 
 @cel.task
 def sync_ilias():
     # don't catch exception because task is stateless and will be rescheduled
     refresh()
+
+
+@cel.task
+def ingest_signups():
+    """Insert the signups queued by the signup views and send their confirmation mails, see :py:mod:`spz.ingest`."""
+    size = app.config['MAIL_BATCH_SIZE']
+    for inserted in drain():
+        # render the mails for the time of the signup, not the time of the insert
+        entries = [(applicant_id, course_id, STATUS, registered) for applicant_id, course_id, registered in inserted]
+        for i in range(0, len(entries), size):
+            send_status_mails.delay(entries[i:i + size])
+
+
+@cel.task
+def purge_oauth_tokens():
+    """Delete the tokens of abandoned internal signups."""
+    models.OAuthToken.purge()
+    db.session.commit()
+
+
+@cel.task
+def purge_populate_runs():
+    """Delete the old records of populate rounds."""
+    models.PopulateRun.purge()
+    db.session.commit()
+
+
+@cel.task
+def import_registrations(import_id, keys):
+    """Hash the chunks of an import in parallel, the last one applies the diff.
+
+       See :py:mod:`spz.registration_import`.
+    """
+    if not keys:
+        apply_registrations.delay(import_id)
+    for key in keys:
+        hash_registrations.delay(import_id, key)
+
+
+@cel.task
+def hash_registrations(import_id, key):
+    try:
+        last = registration_import.hash_chunk(import_id, key)
+    except Exception as e:
+        registration_import.fail(import_id, e)
+        raise
+    if last:
+        apply_registrations.delay(import_id)
+
+
+@cel.task
+def apply_registrations(import_id):
+    registration_import.apply(import_id)
+
+
+@cel.task
+def warm_mail_domains():
+    """Look up the mail domains of the known applicants, so signups find them in the cache."""
+    domains.warm(known_domains(app.config['MAIL_DOMAIN_WARM_LIMIT']))
@@ -10,28 +10,26 @@ import io
 import socket
 import re
 import csv
-import json
 from datetime import datetime, timezone
 
 from redis import ConnectionError
 
-from sqlalchemy import and_, func, not_
+from sqlalchemy import func, not_
 
 from flask import request, redirect, render_template, url_for, flash, jsonify, make_response
 from flask_login import current_user, login_required, login_user, logout_user
-from flask_mail import Message
 
-from spz import app, models, db, token, tasks
+from spz import app, models, db, token, tasks, smtp, store, loading, eligibility, admission, ingest, maildomains, \
+    registration_import, iliasharvester, approval_import
 from spz.decorators import templated
 import spz.forms as forms
 from spz.util.Filetype import mime_from_filepointer
-from spz.mail import generate_status_mail
 from spz.export import export_course_list, export_overview_list
 from spz.administration import TeacherManagement
 
 from flask_babel import gettext as _
 
-from spz.oidc import oidc_callback, oidc_url, oidc_get_resources
+from spz.oidc import oidc_callback, oidc_url, oidc_get_resources, oidc_stats
 
 from spz.pdf_zip import PdfZipWriter, html_response
 from spz.pdf import generate_participation_cert
@@ -103,25 +101,63 @@ def index():
         if err:
             return dict(form=form)
 
-        if form.get_is_internal():
-            oidc_redirect_url = app.config['SPZ_URL'] + url_for('signupinternal', course_id=course.id,
-                                                                token=one_time_token)
-            oidc_redirect_config = oidc_url(oidc_redirect_url)
+        if admission.current_queue(course.id, time) is not None and not current_user.is_authenticated:
+            return redirect(url_for('waiting_room', course_id=course.id, internal=int(form.get_is_internal()),
+                                    token=one_time_token))
 
-            oauth_token = models.OAuthToken(
-                state=oidc_redirect_config['state'],
-                code_verifier=oidc_redirect_config['code_verifier']
-            )
-            db.session.add(oauth_token)
-            db.session.commit()
+        return start_signup(course.id, form.get_is_internal(), one_time_token)
 
-            return redirect(oidc_redirect_config['url'])
+    return dict(form=form)
 
-        return redirect(url_for('signupexternal', course_id=course.id, token=one_time_token))
 
-    return dict(form=form)
+def start_signup(course_id, internal, one_time_token):
+    """Redirect to the signup form, internal applicants authenticate with the KIT first."""
+    if internal:
+        oidc_redirect_url = app.config['SPZ_URL'] + url_for('signupinternal', course_id=course_id,
+                                                            token=one_time_token)
+        oidc_redirect_config = oidc_url(oidc_redirect_url)
+
+        oauth_token = models.OAuthToken(
+            state=oidc_redirect_config['state'],
+            code_verifier=oidc_redirect_config['code_verifier']
+        )
+        db.session.add(oauth_token)
+        db.session.commit()
+
+        return redirect(oidc_redirect_config['url'])
+
+    return redirect(url_for('signupexternal', course_id=course_id, token=one_time_token))
+
+
+def waiting_room(course_id):
+    """Hand out admission tickets and hold applicants back until theirs is admitted, see `spz.admission`."""
+    internal = bool(request.args.get('internal', 0, type=int))
+    one_time_token = request.args.get('token', None)
+    time = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    queue = admission.current_queue(course_id, time)
+    if queue is None:
+        return start_signup(course_id, internal, one_time_token)
+
+    number = queue.ticket()
+    issued = number is None
+    if issued:
+        number = queue.issue()
+
+    if queue.admits(number, time):
+        response = start_signup(course_id, internal, one_time_token)
+    else:
+        wait = queue.wait(number, time)
+        response = make_response(render_template(
+            'waiting.html',
+            position=queue.position(number, time),
+            wait=int(wait),
+            refresh=int(min(max(wait, 5), 30))
+        ))
+    return queue.set_ticket(response, number) if issued else response
 
 
+@admission.guarded
 @templated('signupinternal.html')
 def signupinternal(course_id):
     course = models.Course.query.get_or_404(course_id)
@@ -151,7 +187,10 @@ def signupinternal(course_id):
         return redirect(url_for('index'))
 
     o_auth_state = request.args['state']
-    o_auth_token = models.OAuthToken.query.filter(models.OAuthToken.state == o_auth_state).one()
+    o_auth_token = models.OAuthToken.for_state(o_auth_state, time).first()
+    if o_auth_token is None:
+        flash(_('Die Anmeldung beim KIT ist abgelaufen. Bitte versuchen Sie es erneut.'), 'negative')
+        return redirect(url_for('index'))
 
     if not o_auth_token.request_has_been_made:
         o_auth_access_token = oidc_callback(
@@ -163,7 +202,7 @@ def signupinternal(course_id):
         o_auth_token.request_has_been_made = True
         o_auth_user_data = oidc_get_resources(o_auth_access_token['access_token'])
 
-        o_auth_token.user_data = json.dumps(o_auth_user_data)
+        o_auth_token.set_user_data(o_auth_user_data)
         db.session.commit()
 
         # Check that o_auth_user_data contains all data we need
@@ -219,8 +258,11 @@ def signupinternal(course_id):
 
     if form.validate_on_submit():
         o_auth_state = form.get_state()
-        o_auth_token = models.OAuthToken.query.filter(models.OAuthToken.state == o_auth_state).one()
-        o_auth_user_data = json.loads(o_auth_token.user_data)
+        o_auth_token = models.OAuthToken.for_state(o_auth_state, time).first()
+        if o_auth_token is None:
+            flash(_('Die Anmeldung beim KIT ist abgelaufen. Bitte versuchen Sie es erneut.'), 'negative')
+            return redirect(url_for('index'))
+        o_auth_user_data = o_auth_token.get_user_data()
         applicant = form.get_applicant()
         course = form.get_course()
         user_has_special_rights = current_user.is_authenticated and current_user.can_edit_course(course)
@@ -253,6 +295,8 @@ def signupinternal(course_id):
             _('Bei der Anmeldung für KIT-Angehörige ist ein Fehler aufgetreten. Bitte nutzen Sie die Anmeldung für Externe.')
         )
 
+        verdict = eligibility.check(applicant, course, time)
+
         # signup at all times only with token or privileged users
         err = check_precondition_with_auth(
             course.language.is_open_for_signup(time) or preterm,
@@ -271,36 +315,36 @@ def signupinternal(course_id):
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            not course.has_rating_restrictions() or applicant.has_submitted_tag(),
+            verdict.tag_submitted,
             _('Bei Kursen mit Zugangsbeschränkungen kann die Matrikelnummer nicht nachgereicht werden. '
               'Bitte geben Sie eine Matrikelnummer an.'),
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            course.allows(applicant),
+            verdict.allowed,
             _('Sie haben nicht die vorausgesetzten Sprachtest-Ergebnisse um diesen Kurs zu wählen! '
               '(Hinweis: Der Datenabgleich mit Ilias erfolgt automatisch alle 15 Minuten.)'),
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            not applicant.in_course(course) and not applicant.active_in_parallel_course(course),
+            verdict.not_attending,
             _('Sie sind bereits für diesen Kurs oder einem Parallelkurs angemeldet!'),
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            not applicant.over_limit(),
+            verdict.below_limit,
             _('Sie haben das Limit an Bewerbungen bereits erreicht!'),
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            len(applicant.doppelgangers) == 0,
+            verdict.no_doppelgangers,
             _('Sie haben sich bereits mit einer anderen E-Mailadresse für einen Kurs angemeldet. '
               'Benutzen Sie dieselbe Adresse wie bei Ihrer ersten Anmeldung erneut. '
               'Bei Fragen oder Problemen kontaktieren Sie bitte Ihren Fachleiter.'),
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            not course.is_overbooked,  # no transaction guarantees here, but overbooking is some sort of soft limit
+            verdict.not_overbooked,  # no transaction guarantees here, but overbooking is some sort of soft limit
             _('Der Kurs ist hoffnungslos überbelegt. Darum werden keine Registrierungen mehr entgegengenommen!'),
             user_has_special_rights
         )
@@ -308,6 +352,15 @@ def signupinternal(course_id):
             db.session.rollback()
             return redirect(url_for('index'))
 
+        # In the random window, the worker inserts the signup later on, see `spz.ingest`
+        if ingest.applies(course, time, preterm):
+            receipt = ingest.submit(
+                applicant, course, form.get_graduation(), time, state=o_auth_state, override=user_has_special_rights
+            )
+            if receipt is not None:
+                db.session.rollback()
+                return render_template('receipt.html', applicant=applicant, course=course, receipt=receipt)
+
         # Run the final insert isolated in a transaction, with rollback semantics
         # As of 2015, we simply put everyone into the waiting list by default and then randomly insert, see #39
         try:
@@ -330,7 +383,7 @@ def signupinternal(course_id):
 
         # Preterm signups are in by default and management wants us to send mail immediately
         try:
-            tasks.send_slow.delay(generate_status_mail(applicant, course, time))
+            tasks.status_mail.delay(applicant.id, course.id, time=time.isoformat())
         except (AssertionError, socket.error, ConnectionError) as e:
             flash(_('Eine Bestätigungsmail konnte nicht verschickt werden: %(error)s', error=e), 'negative')
 
@@ -340,6 +393,7 @@ def signupinternal(course_id):
     return dict(course=course, form=form, is_student=is_student)
 
 
+@admission.guarded
 @templated('signupexternal.html')
 def signupexternal(course_id):
     course = models.Course.query.get_or_404(course_id)
@@ -368,6 +422,8 @@ def signupexternal(course_id):
         user_has_special_rights = current_user.is_authenticated and current_user.can_edit_course(course)
         preterm = applicant.mail and token_payload
 
+        verdict = eligibility.check(applicant, course, time)
+
         # signup at all times only with token or privileged users
         err = check_precondition_with_auth(
             course.language.is_open_for_signup(time) or preterm,
@@ -386,35 +442,35 @@ def signupexternal(course_id):
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            not course.has_rating_restrictions() or applicant.has_submitted_tag(),
+            verdict.tag_submitted,
             _('Bitte geben Sie eine Sprachenzentrum ID an.'),
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            course.allows(applicant),
+            verdict.allowed,
             _('Sie haben nicht die vorausgesetzten Sprachtest-Ergebnisse um diesen Kurs zu wählen! '
               '(Hinweis: Der Datenabgleich mit Ilias erfolgt automatisch alle 15 Minuten.)'),
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            not applicant.in_course(course) and not applicant.active_in_parallel_course(course),
+            verdict.not_attending,
             _('Sie sind bereits für diesen Kurs oder einem Parallelkurs angemeldet!'),
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            not applicant.over_limit(),
+            verdict.below_limit,
             _('Sie haben das Limit an Bewerbungen bereits erreicht!'),
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            len(applicant.doppelgangers) == 0,
+            verdict.no_doppelgangers,
             _('Sie haben sich bereits mit einer anderen E-Mailadresse für einen Kurs angemeldet. '
               'Benutzen Sie dieselbe Adresse wie bei Ihrer ersten Anmeldung erneut. '
               'Bei Fragen oder Problemen kontaktieren Sie bitte Ihren Fachleiter.'),
             user_has_special_rights
         )
         err |= check_precondition_with_auth(
-            not course.is_overbooked,  # no transaction guarantees here, but overbooking is some sort of soft limit
+            verdict.not_overbooked,  # no transaction guarantees here, but overbooking is some sort of soft limit
             _('Der Kurs ist hoffnungslos überbelegt. Darum werden keine Registrierungen mehr entgegengenommen!'),
             user_has_special_rights
         )
@@ -422,6 +478,13 @@ def signupexternal(course_id):
             db.session.rollback()
             return dict(form=form, course=course)
 
+        # In the random window, the worker inserts the signup later on, see `spz.ingest`
+        if ingest.applies(course, time, preterm):
+            receipt = ingest.submit(applicant, course, None, time, override=user_has_special_rights)
+            if receipt is not None:
+                db.session.rollback()
+                return render_template('receipt.html', applicant=applicant, course=course, receipt=receipt)
+
         # Run the final insert isolated in a transaction, with rollback semantics
         # As of 2015, we simply put everyone into the waiting list by default and then randomly insert, see #39
         try:
@@ -443,7 +506,7 @@ def signupexternal(course_id):
 
         # Preterm signups are in by default and management wants us to send mail immediately
         try:
-            tasks.send_slow.delay(generate_status_mail(applicant, course, time))
+            tasks.status_mail.delay(applicant.id, course.id, time=time.isoformat())
         except (AssertionError, socket.error, ConnectionError) as e:
             flash(_('Eine Bestätigungsmail konnte nicht verschickt werden: %(error)s', error=e), 'negative')
 
@@ -521,7 +584,11 @@ def registrations():
     if current_user.is_teacher:
         return redirect(url_for('teacher'))
     form = forms.TagForm()
-    return dict(form=form)
+    try:
+        status = registration_import.status()
+    except ConnectionError:
+        status = None
+    return dict(form=form, import_status=status)
 
 
 @login_required
@@ -535,34 +602,15 @@ def registrations_import():
         if fp:
             mime = mime_from_filepointer(fp)
             if mime == 'text/plain':
-                # strip all known endings ('\r', '\n', '\r\n') and remove empty lines
-                # and duplicates
-                stripped_lines = (
-                    line.decode('utf-8', 'ignore').rstrip('\r').rstrip('\n').rstrip('\r').strip()
-                    for line in fp.readlines()
-                )
-                filtered_lines = (
-                    line
-                    for line in stripped_lines
-                    if line
-                )
-                unique_registrations = {
-                    models.Registration.from_cleartext(line)
-                    for line in filtered_lines
-                }
-
                 try:
-                    num_deleted = models.Registration.query.delete()
-                    db.session.add_all(unique_registrations)
-                    db.session.commit()
-                    flash(
-                        _('Import OK: %(deleted)s Einträge gelöscht, %(added)s Einträge hinzugefügt',
-                          deleted=num_deleted,
-                          added=len(unique_registrations)),
-                        'success')
-                except Exception as e:
-                    db.session.rollback()
-                    flash(_('Konnte Einträge nicht speichern, bitte neu einlesen: %(error)s', error=e), 'negative')
+                    started = registration_import.start(fp)
+                    if started is None:
+                        flash(_('Es läuft bereits ein Import, bitte warten bis er abgeschlossen ist'), 'warning')
+                    else:
+                        tasks.import_registrations.delay(*started)
+                        flash(_('Import gestartet, der Fortschritt wird unten angezeigt'), 'success')
+                except ConnectionError as e:
+                    flash(_('Konnte Import nicht starten, bitte neu einlesen: %(error)s', error=e), 'negative')
 
                 return redirect(url_for('registrations'))
 
@@ -604,22 +652,15 @@ def approvals_import():
             if mime == 'text/plain':
                 try:
                     priority = bool(request.form.getlist("priority"))
-                    approvals = extract_approvals(fp, priority)
-
-                    num_deleted = 0
-                    if request.form.getlist("delete_old"):
-                        # only remove sticky entries because
-                        num_deleted = models.Approval.query.filter(and_(
-                            models.Approval.sticky == True,  # NOQA
-                            models.Approval.priority == priority
-                        )).delete()
-                    # add approvals
-                    db.session.add_all(approvals)
+                    tags, percents = approval_import.parse(fp, bool(request.form.getlist("ilias_export")))
+                    num_deleted, num_added = approval_import.insert(
+                        tags, percents, priority, bool(request.form.getlist("delete_old"))
+                    )
                     db.session.commit()
                     flash(
                         _('Import OK: %(deleted)s Einträge gelöscht, %(added)s Einträge hinzugefügt',
                           deleted=num_deleted,
-                          added=len(approvals)),
+                          added=num_added),
                         'success')
                 except Exception as e:  # csv, index or db could go wrong here..
                     db.session.rollback()
@@ -633,63 +674,6 @@ def approvals_import():
     return redirect(url_for('approvals'))
 
 
-def extract_approvals(fp, priority):
-    """Extracts approvals of a file
-
-       :param fp: filepointe to the file
-       :param priority: if the approval entries are priority entries
-    """
-    # strip all known endings ('\r', '\n', '\r\n') and remove empty lines
-    # and duplicates and header lines
-    stripped_lines = (
-        line.decode('utf-8', 'ignore').rstrip('\r').rstrip('\n').rstrip('\r').strip()
-        for line in fp.readlines()
-    )
-    filtered_lines = (
-        line
-        for line in stripped_lines
-        if line and not line.startswith('"Name";"Benutzername";"Matrikelnummer"') and
-           not line.startswith('"Name";"Login";"Matriculation number"')
-    )
-    filecontent = csv.reader(filtered_lines, delimiter=';')  # XXX: hardcoded?
-
-    # set columns indices depending on file type (ILIAS or selfmade)
-    ilias_export = bool(request.form.getlist("ilias_export"))
-    # create list of sticky Approvals, so that background jobs don't remove them
-    approvals = []
-    for line in filecontent:
-        # set rating and tag depending on file type (ILIAS or selfmade)
-        if ilias_export:
-            # test if all params are existent, if not skip entry
-            if line[1] == '' or line[3] == '' or line[4] == '':
-                continue
-            # calc params
-            rating = max(
-                0,
-                min(
-                    int(100 * int(line[3]) / int(line[4])),
-                    100
-                )
-            )
-            # set tag depending if an immatriculation number is existing. If not set tag to account name
-            if not line[2] == '':
-                tag = line[2]
-            else:
-                tag = line[1]
-        else:
-            rating = int(line[1])
-            tag = line[0]
-        approvals.append(
-            models.Approval(
-                tag=tag,
-                percent=rating,
-                sticky=True,
-                priority=priority
-            )
-        )
-    return approvals
-
-
 @login_required
 @templated('internal/approvals.html')
 def approvals_check():
@@ -705,15 +689,16 @@ def approvals_check():
 @templated('internal/approvals.html')
 def approvals_export():
     if request.method == 'POST':
-        english_courses = models.Language.query.filter(models.Language.name == 'Englisch').first().courses
-
-        tags_seen = set()  # append tags to this set to avoid duplicates
-        export_data = []
-        for course in english_courses:
-            for applicant in course.course_list:
-                if applicant.tag and applicant.tag not in tags_seen:
-                    tags_seen.add(applicant.tag)
-                    export_data.append((applicant.tag, applicant.best_rating()))
+        english_courses = models.Language.query.options(*loading.LANGUAGE_COURSES) \
+            .filter(models.Language.name == 'Englisch').first().courses
+
+        tags = {
+            applicant.tag
+            for course in english_courses
+            for applicant in course.course_list
+            if applicant.tag
+        }
+        export_data = list(models.ApprovalSummary.best_ratings(tags).items())
         # sort by tag (remains untested)
         export_data.sort(key=lambda x: x[0])
         # create a buffer
@@ -782,50 +767,30 @@ def notifications():
     form = forms.NotificationForm()
 
     if form.validate_on_submit():
-        # get attachement data once
-        at_mime = ''
-        at_data = None
-        at_name = ''
-        if form.get_attachments():
-            # detect MIME data since browser tend to send messy data,
-            # e.g. https://bugzilla.mozilla.org/show_bug.cgi?id=373621
-            at_mime = []
-            at_data = []
-            at_name = []
-            for att in form.get_attachments():
-                if att:
-                    at_mime.append(mime_from_filepointer(att))
-                    at_data.append(att.read())
-                    at_name.append(att.filename)
-
         try:
-            has_sent_cc = False
-            recipients = form.get_recipients()
-            for recipient in recipients:
-                cc_cached = None
-                bcc_cached = None
-                if not has_sent_cc:
-                    cc_cached = form.get_cc()
-                    bcc_cached = form.get_bcc()
-                    has_sent_cc = True
-                msg = Message(
-                    sender=form.get_sender(),
-                    recipients=[recipient],
-                    subject=form.get_subject(),
-                    html=form.get_body(),
-                    cc=cc_cached,
-                    bcc=bcc_cached,
-                    charset='utf-8'
-                )
-                if form.get_attachments():
-                    for (mime, data, name) in zip(at_mime, at_data, at_name):
-                        msg.attach(name, mime, data)
-                tasks.send_slow.delay(msg)
+            # store attachment data once, the mails only reference it
+            attachments = []
+            if form.get_attachments():
+                for att in form.get_attachments():
+                    if att:
+                        # detect MIME data since browser tend to send messy data,
+                        # e.g. https://bugzilla.mozilla.org/show_bug.cgi?id=373621
+                        attachments.append((att.filename, mime_from_filepointer(att), store.put_blob(att.read())))
+
+            result = tasks.notification_mails.delay(
+                form.get_sender(),
+                form.get_recipients(),
+                form.get_subject(),
+                form.get_body(),
+                form.get_cc(),
+                form.get_bcc(),
+                attachments
+            )
 
-            flash(_('Mail erfolgreich verschickt'), 'success')
-            return redirect(url_for('internal'))
+            flash(_('Mailversand gestartet'), 'success')
+            return redirect(url_for('notifications_progress', task_id=result.id))
 
-        except (AssertionError, socket.error) as e:
+        except (AssertionError, socket.error, ConnectionError) as e:
             flash(_('Mail wurde nicht verschickt: %(error)s', error=e), 'negative')
 
     return dict(form=form)
@@ -856,6 +821,25 @@ def export(type, id):
     return dict(form=form, user=current_user)
 
 
+@login_required
+@templated('internal/notifications_progress.html')
+def notifications_progress(task_id):
+    if current_user.is_teacher:
+        return redirect(url_for('teacher'))
+    result = tasks.notification_mails.AsyncResult(task_id)
+
+    progress = dict(sent=0, total=None)
+    try:
+        if isinstance(result.info, dict):
+            progress.update(result.info)
+        state = result.state
+    except ConnectionError as e:
+        flash(_('Fortschritt nicht verfügbar: %(error)s', error=e), 'warning')
+        state = None
+
+    return dict(state=state, progress=progress)
+
+
 @login_required
 @templated('internal/lists.html')
 def lists():
@@ -866,7 +850,7 @@ def lists():
         .join(models.Course, models.Language.courses) \
         .group_by(models.Language) \
         .order_by(models.Language.name) \
-        .from_self()  # b/c of eager loading, see: http://thread.gmane.org/gmane.comp.python.sqlalchemy.user/36757
+        .options(*loading.LANGUAGE)
 
 
     return dict(lang_misc=lang_misc)
@@ -915,7 +899,7 @@ def add_course():
 def language(id):
     if current_user.is_teacher:
         return redirect(url_for('teacher'))
-    return dict(language=models.Language.query.get_or_404(id))
+    return dict(language=models.Language.query.options(*loading.LANGUAGE).get_or_404(id))
 
 
 @login_required
@@ -923,7 +907,7 @@ def language(id):
 def course(id):
     if current_user.is_teacher:
         return redirect(url_for('teacher'))
-    course = models.Course.query.get_or_404(id)
+    course = models.Course.query.options(*loading.COURSE).get_or_404(id)
     form = forms.CourseForm()
     form_delete = forms.DeleteCourseForm()
 
@@ -1012,7 +996,7 @@ def course(id):
 @login_required
 @templated('internal/applicant.html')
 def applicant(id):
-    applicant = models.Applicant.query.get_or_404(id)
+    applicant = models.Applicant.query.options(*loading.APPLICANT).get_or_404(id)
     form = forms.ApplicantForm()
 
     if form.validate_on_submit():
@@ -1105,13 +1089,14 @@ def search_applicant():
                 else:
                     query = query & subquery
         if query is not None:
-            applicants = models.Applicant.query.filter(query)
+            applicants = models.Applicant.query.filter(query).options(*loading.APPLICANTS)
 
     return dict(form=form, applicants=applicants)
 
 
 def add_attendance(applicant, course, notify):
-    if applicant.in_course(course) or applicant.active_in_parallel_course(course):
+    verdict = eligibility.check(applicant, course)
+    if not verdict.not_attending:
         raise ValueError(
             _('Der Teilnehmer ist bereits im Kurs oder nimmt aktiv an einem Parallelkurs teil!'),
             'warning')
@@ -1124,7 +1109,7 @@ def add_attendance(applicant, course, notify):
     )
     db.session.commit()
 
-    if not course.allows(applicant):
+    if not verdict.allowed:
         flash(
             _('Der Teilnehmer hat eigentlich nicht die entsprechenden Sprachtest-Ergebnisse. '
               'Teilnehmer wurde trotzdem eingetragen.'),
@@ -1133,7 +1118,7 @@ def add_attendance(applicant, course, notify):
 
     if notify:
         try:
-            tasks.send_slow.delay(generate_status_mail(applicant, course, restock=True))
+            tasks.status_mail.delay(applicant.id, course.id, True)
             flash(_('Bestätigungsmail wurde versendet'), 'success')
         except (AssertionError, socket.error, ConnectionError) as e:
             flash(_('Bestätigungsmail konnte nicht versendet werden: %(error)s', error=e), 'negative')
@@ -1149,8 +1134,9 @@ def remove_attendance(applicant, course, notify):
                 active_courses[0].discount = models.Attendance.MAX_DISCOUNT
 
     if notify and success:
+        db.session.commit()  # the worker renders the mail from the committed state
         try:
-            tasks.send_slow.delay(generate_status_mail(applicant, course))
+            tasks.status_mail.delay(applicant.id, course.id)
             flash(_('Bestätigungsmail wurde versendet'), 'success')
             course.last_signoff_at = datetime.now(timezone.utc).replace(tzinfo=None)
         except (AssertionError, socket.error, ConnectionError) as e:
@@ -1162,7 +1148,7 @@ def remove_attendance(applicant, course, notify):
 @login_required
 @templated('internal/applicants/applicant_attendances.html')
 def applicant_attendances(id):
-    return dict(applicant=models.Applicant.query.get_or_404(id))
+    return dict(applicant=models.Applicant.query.options(*loading.APPLICANT).get_or_404(id))
 
 
 @login_required
@@ -1213,7 +1199,7 @@ def outstanding():
 @login_required
 @templated('internal/status.html')
 def status(applicant_id, course_id):
-    attendance = models.Attendance.query.get_or_404((applicant_id, course_id))
+    attendance = models.Attendance.query.options(*loading.ATTENDANCE).get_or_404((applicant_id, course_id))
     form = forms.StatusForm()
 
     if form.validate_on_submit():
@@ -1234,9 +1220,12 @@ def status(applicant_id, course_id):
 
         if form.notify_change.data:
             try:
-                course = attendance.course
-                applicant = attendance.applicant
-                tasks.send_quick.delay(generate_status_mail(applicant, course))
+                # skip the slow queue, management is waiting for this one
+                tasks.status_mail.apply_async(
+                    (attendance.applicant_id, attendance.course_id),
+                    queue='default',
+                    routing_key='default'
+                )
                 flash(_('Mail erfolgreich verschickt'), 'success')
             except (AssertionError, socket.error, ConnectionError) as e:
                 flash(_('Mail konnte nicht verschickt werden: %(error)s', error=e), 'negative')
@@ -1293,7 +1282,27 @@ def task_queue():
         task = {'id': request['id'], 'started': request['time_start'], 'payload': payload, 'priority': job['priority']}
         work.append(task)
 
-    return dict(tasks=work)
+    workers = []
+    try:
+        workers = smtp.read_stats()
+    except ConnectionError as e:
+        flash(_('Mailstatistik nicht verfügbar: %(error)s', error=e), 'warning')
+
+    logins = []
+    try:
+        logins = oidc_stats()
+    except ConnectionError as e:
+        flash(_('Loginstatistik nicht verfügbar: %(error)s', error=e), 'warning')
+
+    ilias_sync = None
+    try:
+        ilias_sync = iliasharvester.read_report()
+    except ConnectionError as e:
+        flash(_('ILIAS-Statistik nicht verfügbar: %(error)s', error=e), 'warning')
+
+    return dict(
+        tasks=work, workers=workers, logins=logins, mail_domains=maildomains.domains.stats(), ilias_sync=ilias_sync
+    )
 
 
 @login_required
@@ -1309,14 +1318,11 @@ def preterm():
         token = form.get_token()
 
         try:
-            tasks.send_quick.delay(
-                Message(
-                    sender=app.config['PRIMARY_MAIL'],
-                    recipients=[form.mail.data],
-                    subject=_('[Sprachenzentrum] URL für prioritäre Anmeldung'),
-                    body='{0}'.format(url_for('index', token=token, _external=True)),
-                    charset='utf-8'
-                )
+            tasks.plain_mail.delay(
+                app.config['PRIMARY_MAIL'],
+                [form.mail.data],
+                _('[Sprachenzentrum] URL für prioritäre Anmeldung'),
+                '{0}'.format(url_for('index', token=token, _external=True))
             )
 
             flash(_('Eine Mail mit der Token URL wurde an %(receiver)s verschickt', receiver=form.mail.data), 'success')
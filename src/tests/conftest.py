@@ -3,14 +3,49 @@
 """Provides pytest fixtures.
 """
 
+from types import SimpleNamespace
+
+import dns.resolver
 from pytest import fixture
 from spz import app, db
-from spz.models import User, Origin, Degree, Graduation, Course
+from spz.models import User, Origin, Degree, Graduation, Course, Role
 from spz.setup.init_db import recreate_tables, insert_resources
+from tests.fake_ilias import PASSWORD, USERNAME, FakeIlias, make_rows
+
+
+class StubResolver(object):
+    """Answers DNS queries locally: every domain has an MX record, except the ones under `.invalid`."""
+
+    lifetime = None
+
+    def query(self, qname, rdtype):
+        if qname.rstrip('.').endswith('.invalid'):
+            raise dns.resolver.NXDOMAIN()
+        return [SimpleNamespace(preference=10, exchange='mx.{}'.format(qname))]
+
+
+@fixture(autouse=True, scope='session')
+def stub_resolver():
+    dns.resolver.default_resolver, default_resolver = StubResolver(), dns.resolver.default_resolver
+    yield dns.resolver.default_resolver
+    dns.resolver.default_resolver = default_resolver
+
+
+@fixture
+def fake_ilias():
+    ilias = FakeIlias(make_rows(100)).start()
+    config = {key: app.config[key] for key in ('ILIAS_URL', 'ILIAS_USERNAME', 'ILIAS_PASSWORD')}
+    app.config.update(ILIAS_URL=ilias.url, ILIAS_USERNAME=USERNAME, ILIAS_PASSWORD=PASSWORD)
+    yield ilias
+    app.config.update(config)
+    ilias.stop()
 
 
 def create_user(mail, superuser=False, languages=[]):
-    user = User(mail, active=True, superuser=superuser, languages=languages)
+    roles = [Role(course=course, role=Role.COURSE_ADMIN) for language in languages for course in language.courses]
+    if superuser:
+        roles.append(Role(role=Role.SUPERUSER))
+    user = User(mail, active=True, roles=roles)
     password = user.reset_password()
     db.session.add(user)
     db.session.commit()
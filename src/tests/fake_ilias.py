@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""Local stand-in for the Ilias test evaluation, serves the pages the harvester walks through.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+HEADER = 'Name;Benutzername;Matrikelnummer;Testergebnis in Punkten;Maximal erreichbare Punktezahl;Testergebnis als Note'
+USERNAME = 'soap_spz'
+PASSWORD = 'secret'
+SESSION = 'PHPSESSID=session'
+RTOKEN = 'rtoken123'
+ACTIVE_ID = '7'
+
+EVALUATION = '''<html><body>
+<form id="ilToolbar" action="ilias.php?ref_id=123&amp;cmd=post&amp;rtoken={}&amp;active_id={}"></form>
+</body></html>'''.format(RTOKEN, ACTIVE_ID)
+
+
+def make_rows(number):
+    """Rows of the export as `(matriculation number, points, maximum points)`."""
+    return [(str(1000000 + i), i % 81, 80) for i in range(number)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def setup(self):
+        super().setup()
+        self.server.ilias.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.route()
+
+    def do_POST(self):
+        self.route()
+
+    def reply(self, body, status=200, headers=()):
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length', 0))
+        data = dict(parse_qsl(self.rfile.read(length).decode('utf-8')))
+        logged_in = SESSION in self.headers.get('Cookie', '')
+
+        ilias = self.server.ilias
+        step = (self.command, url.path, params.get('baseClass'), params.get('fallbackCmd') or params.get('cmd'))
+        ilias.requests.append(step)
+
+        if url.path == '/login.php':
+            return self.reply('login', headers=[('Set-Cookie', 'PHPSESSID=anonymous; path=/')])
+        if url.path == '/logout.php':
+            return self.reply('bye', headers=[('Set-Cookie', 'PHPSESSID=deleted; path=/')])
+        if params.get('baseClass') == 'ilStartUpGUI':
+            if (data.get('username'), data.get('password')) != (USERNAME, PASSWORD):
+                return self.reply('wrong password')
+            return self.reply('', 302, [('Location', '/ilias.php?baseClass=ilDashboardGUI'), ('Set-Cookie', SESSION)])
+        if not logged_in:
+            return self.reply('login required', 403)
+        return self.route_session(params)
+
+    def route_session(self, params):
+        if params.get('baseClass') == 'ilDashboardGUI':
+            return self.reply('Willkommen, Sprachenzentrum')
+        if params.get('cmd') == 'outEvaluation':
+            return self.reply(EVALUATION)
+        if params.get('rtoken') != RTOKEN:
+            return self.reply('invalid rtoken', 403)
+        if params.get('fallbackCmd') == 'outEvaluation':
+            return self.reply('prepared')
+        if params.get('fallbackCmd') == 'exportEvaluation' and params.get('active_id') == ACTIVE_ID:
+            return self.reply(self.server.ilias.export())
+        return self.reply('not found', 404)
+
+
+class FakeIlias(object):
+    """Serve the Ilias pages on a local port in a background thread.
+
+       :param rows: rows of the export, see :py:func:`make_rows`
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.connections = 0
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.ilias = self
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def export(self):
+        # Ilias repeats the header before every row
+        lines = [HEADER]
+        for number, points, maximum in self.rows:
+            lines.append('"Muster, Max";max@kit.edu;{};{};{};2'.format(number, points, maximum))
+            lines.append(HEADER)
+        return '\r\n'.join(lines).encode('utf-8')
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
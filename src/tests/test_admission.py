@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the admission queue at signup opening.
+"""
+
+from datetime import datetime, timedelta
+
+from spz import app
+from spz.admission import Queue
+
+
+def test_queue_admits_burst_then_rate():
+    opening = datetime(2020, 10, 1, 8)
+    queue = Queue(language_id=1, rate=2, burst=10, opening=opening)
+
+    assert queue.admits(10, opening)
+    assert not queue.admits(11, opening)
+    assert not queue.admits(None, opening)
+    assert queue.position(30, opening) == 20
+    assert queue.wait(30, opening) == 10
+
+    later = opening + timedelta(seconds=5)
+    assert queue.admits(20, later)
+    assert queue.position(30, later) == 10
+    assert queue.position(5, later) == 0
+
+
+def test_ticket_roundtrip():
+    queue = Queue(language_id=1, rate=2, burst=10, opening=datetime(2020, 10, 1, 8))
+    other = Queue(language_id=1, rate=2, burst=10, opening=datetime(2020, 10, 3, 8))
+
+    with app.test_request_context():
+        response = queue.set_ticket(app.response_class(), 42)
+    cookie = response.headers['Set-Cookie'].split(';')[0]
+
+    with app.test_request_context(headers={'Cookie': cookie}):
+        assert queue.ticket() == 42
+        assert other.ticket() is None
+    with app.test_request_context():
+        assert queue.ticket() is None
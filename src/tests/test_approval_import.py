@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the bulk import of approvals.
+"""
+
+import io
+
+from spz import approval_import, db
+from spz.models import Approval, ApprovalSummary
+
+
+ILIAS_EXPORT = '''"Name";"Benutzername";"Matrikelnummer";"Testergebnis in Punkten";"Maximal erreichbare Punktezahl"
+"Mueller, Mika";"ab1234";"1234567";"40";"80"
+"Staff, Sam";"UXYZ";"";"90";"80"
+"Empty, Eve";"";"";"";"80"
+
+"Name";"Login";"Matriculation number";"Score";"Maximum"
+"Mueller, Mika";"ab1234";"1234567";"80";"80"
+'''.encode('utf-8')
+
+
+def test_parse():
+    tags, percents = approval_import.parse(io.BytesIO(ILIAS_EXPORT), ilias_export=True)
+    assert tags == ['1234567', 'uxyz', '1234567']
+    assert list(percents) == [50, 100, 100]
+
+    tags, percents = approval_import.parse(io.BytesIO(b'AB12;70\r\n\r\ncd34;20\r\n'), ilias_export=False)
+    assert tags == ['ab12', 'cd34']
+    assert list(percents) == [70, 20]
+
+
+def test_insert(client):
+    db.session.add(Approval(tag='old', percent=10, sticky=True, priority=False))
+    db.session.add(Approval(tag='synced', percent=20, sticky=False, priority=False))
+    db.session.commit()
+
+    tags, percents = approval_import.parse(io.BytesIO(ILIAS_EXPORT), ilias_export=True)
+    assert approval_import.insert(tags, percents, priority=False, delete_old=True) == (1, 3)
+    db.session.commit()
+
+    assert not Approval.get_for_tag('old')
+    assert len(Approval.get_for_tag('synced')) == 1
+    assert sorted(approval.percent for approval in Approval.get_for_tag('1234567')) == [50, 100]
+    assert ApprovalSummary.best_ratings(['1234567', 'uxyz', 'old']) == {'1234567': 100, 'uxyz': 100, 'old': 0}
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the denormalized attendance counters of courses.
+"""
+
+from spz import counters, db
+from spz.models import Attendance, Graduation
+from tests.sample_data import make_applicant
+
+
+def counts(course):
+    db.session.refresh(course)
+    return (course.active_count, course.waiting_count, course.unpaid_count, course.free_count)
+
+
+def test_counters_follow_attendances(courses):
+    course = courses[0]
+    graduation = Graduation.query.first()
+
+    paying = make_applicant(id=0)
+    paying.add_course_attendance(course=course, graduation=graduation, waiting=True, discount=0)
+    free = make_applicant(id=1)
+    free.add_course_attendance(course=course, graduation=graduation, waiting=False,
+                               discount=Attendance.MAX_DISCOUNT)
+    db.session.add_all([paying, free])
+    db.session.commit()
+    assert counts(course) == (1, 1, 0, 1)
+
+    paying.attendances[0].set_waiting_status(False)
+    db.session.commit()
+    assert counts(course) == (2, 0, 1, 1)
+    assert course.count_attendances(waiting=False, is_free=False) == 1
+
+    paying.attendances[0].amountpaid = course.price
+    db.session.commit()
+    assert counts(course) == (2, 0, 0, 1)
+
+    free.remove_course_attendance(course)
+    db.session.commit()
+    assert counts(course) == (1, 0, 0, 0)
+
+    assert counters.check() == []
+
+
+def test_rebuild(courses):
+    course = courses[0]
+    applicant = make_applicant(id=0)
+    applicant.add_course_attendance(course=course, graduation=None, waiting=False, discount=0)
+    db.session.add(applicant)
+    db.session.commit()
+
+    course.active_count = 42
+    db.session.commit()
+    assert [course_id for course_id, _, _ in counters.check()] == [course.id]
+
+    counters.rebuild()
+    db.session.commit()
+    assert counts(course) == (1, 0, 1, 0)
+    assert counters.check() == []
+
+
+def test_unflushed_attendances(courses):
+    course, other = courses[0], courses[1]
+    applicant = make_applicant(id=0)
+    db.session.add(applicant)
+    db.session.commit()
+    assert not course.has_unflushed_attendances()
+
+    with db.session.no_autoflush:
+        attendance = applicant.add_course_attendance(course=course, graduation=None, waiting=True, discount=0)
+        assert course.has_unflushed_attendances()
+        assert not other.has_unflushed_attendances()
+        assert course.count_attendances(waiting=True) == 1
+
+    db.session.flush()
+    assert not course.has_unflushed_attendances()
+    assert course.count_attendances(waiting=True) == 1
+
+    with db.session.no_autoflush:
+        attendance.set_waiting_status(False)
+        assert course.has_unflushed_attendances()
+        assert course.count_attendances(waiting=False) == 1
+
+    db.session.commit()
+    assert course.count_attendances(waiting=False) == 1
+    assert not course.has_unflushed_attendances()
+
+    with db.session.no_autoflush:
+        applicant.remove_course_attendance(course)
+        assert course.has_unflushed_attendances()
+
+    db.session.commit()
+    assert course.count_attendances() == 0
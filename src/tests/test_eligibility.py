@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the signup eligibility rules.
+"""
+
+from datetime import datetime
+
+from spz import app, db, eligibility
+from spz.models import Approval, Graduation
+from tests.sample_data import make_applicant
+
+
+def test_new_applicant(courses):
+    verdict = eligibility.check(make_applicant(id=0), courses[0])
+    assert verdict.passed, verdict
+
+
+def test_rules(courses):
+    course, other_course = courses[0], courses[1]
+    graduation = Graduation.query.first()
+
+    applicant = make_applicant(id=0)
+    applicant.add_course_attendance(course=course, graduation=graduation, waiting=True, discount=0)
+    db.session.add(applicant)
+    db.session.commit()
+
+    verdict = eligibility.check(applicant, course)
+    assert verdict.violations == ['not_attending']
+
+    app.config['MAX_ATTENDANCES'], max_attendances = 1, app.config['MAX_ATTENDANCES']
+    try:
+        assert 'below_limit' in eligibility.check(applicant, other_course, time=datetime(2000, 1, 1)).violations
+    finally:
+        app.config['MAX_ATTENDANCES'] = max_attendances
+
+    doppelganger = make_applicant(id=1)
+    doppelganger.tag = applicant.tag
+    assert eligibility.check(doppelganger, other_course).violations == ['no_doppelgangers']
+
+    other_course.rating_lowest = 50
+    db.session.add(Approval(tag=applicant.tag, percent=40, sticky=False, priority=False))
+    db.session.commit()
+    assert 'allowed' in eligibility.check(applicant, other_course).violations
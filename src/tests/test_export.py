@@ -8,7 +8,7 @@ from openpyxl import load_workbook
 from zipfile import ZipFile
 
 from spz import db
-from spz.export import export_course_list
+from spz.export import active_attendances, export_course_list
 from spz.models import ExportFormat, Graduation, Attendance
 from tests.sample_data import make_applicant
 
@@ -67,3 +67,31 @@ def test_single_excel(courses):
         file.write(resp.data)
         wb = load_workbook(file.name)
     assert(wb.worksheets[0].max_row - 1 >= count)  # max_row is 1 based
+
+
+def name_key(applicant):
+    return applicant.last_name.lower(), applicant.first_name.lower(), applicant.id
+
+
+def test_active_attendances(courses):
+    fill(courses[:2])
+    first, second = courses[0], courses[1]
+    waiting = make_applicant(id=1000)
+    waiting.add_course_attendance(course=second, graduation=None, waiting=True, discount=0)
+    graded = second.attendances[0]
+    graded.grade = 80
+    # code point order differs from the usual collations: 'mustermann' < 'mz' < 'müller'
+    for id, last_name in enumerate(['Müller', 'Mz', 'Mustermann'], 1001):
+        applicant = make_applicant(id=id)
+        applicant.last_name = last_name
+        applicant.add_course_attendance(course=first, graduation=None, waiting=False, discount=0)
+        db.session.add(applicant)
+    db.session.commit()
+
+    exported = [(course, list(attendances)) for course, attendances in active_attendances([second, courses[2], first])]
+    assert [course for course, _ in exported] == [second, courses[2], first]
+    for course, attendances in exported:
+        assert [attendance.applicant for attendance in attendances] == sorted(course.course_list, key=name_key)
+
+    passed = [(course, list(attendances)) for course, attendances in active_attendances([first, second], passed=True)]
+    assert passed == [(first, []), (second, [graded])]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the sync of the approvals with Ilias.
+"""
+
+import hashlib
+
+from spz.iliasharvester import diff, download_data, fingerprint, fingerprinted, parse_rows
+from tests.fake_ilias import make_rows
+
+
+EXPORT = [
+    'Name;Benutzername;Matrikelnummer;Testergebnis in Punkten;Maximal erreichbare Punktezahl;Testergebnis als Note'
+    .encode('utf-8'),
+    b'Mueller, Mika;ab1234@kit.edu;1234567;40;80;4',
+    b'header;repeated;before;every;line;again',
+    b'Staff, Sam;uxyz;;80;80;1',
+    b'header;repeated;before;every;line;again',
+    b'Empty, Eve;;;;80;',
+]
+
+
+def test_parse_rows():
+    assert parse_rows(EXPORT) == [('1234567', 50), ('uxyz', 100)]
+    assert fingerprint(EXPORT) == fingerprint(list(EXPORT))
+    assert fingerprint(EXPORT) != fingerprint(EXPORT[:-1])
+
+
+def test_diff():
+    existing = [
+        (1, b'kept', 50),
+        (2, b'retaken', 30),
+        (3, b'retaken', 60),
+        (4, b'improved', 20),
+        (5, b'gone', 70),
+    ]
+    rows = [
+        (b'kept', 50),
+        (b'retaken', 60),
+        (b'retaken', 30),
+        (b'retaken', 90),
+        (b'improved', 40),
+        (b'new', 10),
+    ]
+
+    added, changed, removed = diff(existing, rows)
+    assert sorted(added) == [(b'new', 10), (b'retaken', 90)]
+    assert changed == [(4, 40)]
+    assert removed == [5]
+
+    assert diff(existing, [(tag, percent) for _, tag, percent in existing]) == ([], [], [])
+
+
+def test_download(fake_ilias):
+    rows, timings = download_data(parse_rows)
+
+    assert rows == [(number, min(100, int(100 * points / maximum))) for number, points, maximum in fake_ilias.rows]
+    assert set(timings) == {'login', 'evaluation', 'prepare', 'export', 'logout'}
+    assert fake_ilias.connections == 1  # keep-alive
+    assert fake_ilias.requests[-1][1] == '/logout.php'  # after the export got consumed
+
+
+def test_download_large_export(fake_ilias):
+    fake_ilias.rows = make_rows(20000)
+    digest = hashlib.sha256()
+    rows, _ = download_data(lambda lines: parse_rows(fingerprinted(lines, digest)))
+
+    assert rows == [(number, min(100, int(100 * points / maximum))) for number, points, maximum in fake_ilias.rows]
+    assert digest.hexdigest() == fingerprint(fake_ilias.export().split(b'\r\n'))
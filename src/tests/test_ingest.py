@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the write-behind ingestion of signups.
+"""
+
+import json
+from datetime import datetime
+
+from spz import counters, db, ingest, store
+from spz.models import Applicant, Attendance, Graduation
+from tests.sample_data import make_applicant
+
+
+def test_insert(courses):
+    course, other_course = courses[0], courses[1]
+    graduation = Graduation.query.first()
+    time = datetime(2020, 10, 1, 8)
+
+    known = make_applicant(id=0)
+    db.session.add(known)
+    db.session.commit()
+    revision = course.revision
+
+    # like the signup views, the applicants join the session through their origin but are never flushed
+    with db.session.no_autoflush:
+        entries = [
+            ingest.make_entry(make_applicant(id=1), course, graduation, time),
+            ingest.make_entry(make_applicant(id=1), other_course, graduation, time),
+            ingest.make_entry(make_applicant(id=1), course, graduation, time),  # submitted twice
+            ingest.make_entry(known, course, None, time),
+        ]
+    db.session.rollback()
+
+    inserted, rejected = ingest.insert(entries)
+    db.session.commit()
+
+    new = Applicant.query.filter(Applicant.mail == entries[0]['mail']).one()
+    registered = time.isoformat()
+    assert sorted(inserted) == sorted([
+        (new.id, course.id, registered), (new.id, other_course.id, registered), (known.id, course.id, registered)
+    ])
+    assert rejected == []
+    assert all(attendance.waiting and attendance.registered == time for attendance in Attendance.query)
+    assert counters.check() == []
+    db.session.refresh(course)
+    assert course.waiting_count == 2
+    assert course.revision == revision + 1
+
+    assert ingest.insert(entries) == ([], [])
+    db.session.commit()
+    assert Applicant.query.count() == 2
+    assert counters.check() == []
+
+
+def test_insert_rechecks_rules(courses):
+    time = datetime(2020, 10, 1, 8)
+
+    known = make_applicant(id=0)
+    db.session.add(known)
+    db.session.commit()
+
+    with db.session.no_autoflush:
+        doppelganger = make_applicant(id=1)
+        doppelganger.tag = known.tag
+        entries = [
+            ingest.make_entry(make_applicant(id=2), course, None, time)
+            for course in courses[:3]  # one more than MAX_ATTENDANCES
+        ] + [
+            ingest.make_entry(doppelganger, courses[0], None, time),
+        ]
+        privileged = ingest.make_entry(make_applicant(id=3), courses[0], None, time, override=True)
+        privileged['tag'] = known.tag
+        entries.append(privileged)
+    db.session.rollback()
+
+    inserted, rejected = ingest.insert(entries)
+    db.session.commit()
+
+    assert len(inserted) == 3
+    assert [(entry['mail'], rule) for entry, rule in rejected] == [
+        (entries[2]['mail'], 'below_limit'),
+        (doppelganger.mail, 'no_doppelgangers'),
+    ]
+    assert Attendance.query.count() == 3
+    assert counters.check() == []
+
+
+def test_drain_parks_failing_entries(courses):
+    client = store.redis_client()
+    client.delete(ingest.STREAM, ingest.DEAD_LETTERS, ingest.LOCK)
+    time = datetime(2020, 10, 1, 8)
+
+    with db.session.no_autoflush:
+        good = ingest.make_entry(make_applicant(id=1), courses[0], None, time)
+        broken = ingest.make_entry(make_applicant(id=2), courses[0], None, time)
+    db.session.rollback()
+    broken['graduation_id'] = -1  # violates the foreign key, fails the batch
+    for entry in (broken, good):
+        client.xadd(ingest.STREAM, dict(entry=json.dumps(entry)))
+
+    try:
+        inserted = [row for batch in ingest.drain() for row in batch]
+
+        assert [attendance.applicant.mail for attendance in Attendance.query] == [good['mail']]
+        assert len(inserted) == 1
+        parked = client.xrange(ingest.DEAD_LETTERS)
+        assert [json.loads(fields[b'entry'])['mail'] for _, fields in parked] == [broken['mail']]
+        assert client.xlen(ingest.STREAM) == 0
+        assert list(ingest.drain()) == []
+        assert counters.check() == []
+    finally:
+        client.delete(ingest.STREAM, ingest.DEAD_LETTERS, ingest.LOCK)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""Tests that the views load their data with a constant number of queries, see :py:mod:`spz.loading`.
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from spz import db
+from spz.models import Course, Graduation
+from tests import login
+from tests.sample_data import make_applicant
+
+
+MAX_QUERIES = 20
+
+
+@contextmanager
+def counted():
+    stats = dict(queries=0, rows=0)
+
+    def count(_conn, cursor, statement, _parameters, _context, _executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            stats['queries'] += 1
+            stats['rows'] += max(cursor.rowcount, 0)
+
+    event.listen(db.engine, 'after_cursor_execute', count)
+    try:
+        yield stats
+    finally:
+        event.remove(db.engine, 'after_cursor_execute', count)
+
+
+def enroll(course_id, first_id, number):
+    course = Course.query.get(course_id)
+    graduation = Graduation.query.first()
+    for id in range(first_id, first_id + number):
+        applicant = make_applicant(id=id)
+        applicant.add_course_attendance(course=course, graduation=graduation, waiting=False, discount=0)
+        db.session.add(applicant)
+    db.session.commit()
+
+
+def fetch(client, url):
+    # requests share the session of the test's app context, start with an empty one like a real request does
+    db.session.remove()
+    with counted() as stats:
+        response = client.get(url)
+    assert response.status_code == 200
+    assert stats['queries'] <= MAX_QUERIES
+    return stats
+
+
+def test_queries_per_endpoint(client, superuser):
+    course, other_course = Course.query.order_by(Course.id).limit(2).all()
+    course_id, language_id = course.id, course.language_id
+    enroll(course_id, 0, 2)
+    enroll(other_course.id, 2, 2)
+    applicant_id = Course.query.get(course_id).attendances[0].applicant_id
+    login(client, superuser)
+
+    urls = [
+        '/internal/lists',
+        '/internal/language/{}'.format(language_id),
+        '/internal/course/{}'.format(course_id),
+        '/internal/applicant/{}'.format(applicant_id),
+        '/internal/print_course/{}'.format(course_id),
+        '/internal/print_language/{}'.format(language_id),
+    ]
+    for url in urls:
+        fetch(client, url)  # warm up caches
+    small = {url: fetch(client, url) for url in urls}
+
+    added = 25
+    enroll(course_id, 100, added)
+    large = {url: fetch(client, url) for url in urls}
+
+    for url in urls:
+        assert large[url]['queries'] == small[url]['queries'], url
+
+    # overviews and other applicants are served from the course counters, attendances are not fetched
+    for url in urls[:2] + urls[3:4]:
+        assert large[url]['rows'] == small[url]['rows'], url
+    # course lists fetch every new attendance with its applicant in a single row
+    for url in urls[2:3] + urls[4:]:
+        assert large[url]['rows'] - small[url]['rows'] <= added, url
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Tests rendering and sending the status and notification mails.
+"""
+
+from datetime import timedelta
+
+from pytest import raises
+
+from spz import app, db, tasks
+from spz.mail import RESTOCK, STATUS, generate_status_mails
+from tests.sample_data import make_applicant
+
+
+class Retry(Exception):
+    pass
+
+
+class StubPool(object):
+    """Fails on the `fail_at`-th message, like a dropped SMTP connection."""
+
+    def __init__(self, fail_at=None):
+        self.sent = []
+        self.fail_at = fail_at
+
+    def send(self, msg):
+        if len(self.sent) + 1 == self.fail_at:
+            raise ConnectionResetError()
+        self.sent.append(msg)
+
+    def publish(self):
+        pass
+
+
+def stub_task(monkeypatch, task, fail_at):
+    pool = StubPool(fail_at)
+    retries = []
+
+    def retry(args=None, kwargs=None, exc=None):
+        retries.append((args, kwargs or {}))
+        return Retry()
+
+    monkeypatch.setattr(tasks, 'pool', pool)
+    monkeypatch.setattr(tasks.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(task, 'retry', retry)
+    monkeypatch.setattr(task, 'update_state', lambda **kwargs: None)
+    return pool, retries
+
+
+def test_status_mail_templates(courses):
+    course, other_course = courses[0], courses[1]
+    language = course.language
+    rnd_time = language.signup_rnd_begin + timedelta(minutes=1)
+    fcfs_time = language.signup_fcfs_begin + timedelta(minutes=1)
+
+    applicant = make_applicant(id=0)
+    applicant.add_course_attendance(course=course, graduation=None, waiting=True, discount=0)
+    applicant.add_course_attendance(course=other_course, graduation=None, waiting=False, discount=0)
+    db.session.add(applicant)
+    db.session.commit()
+
+    entries = [
+        (applicant.id, course.id, STATUS, rnd_time.isoformat()),
+        (applicant.id, course.id, STATUS, fcfs_time.isoformat()),
+        (applicant.id, other_course.id, STATUS),
+        (applicant.id, other_course.id, RESTOCK),
+        (applicant.id, courses[2].id, STATUS),  # not in the course (anymore)
+        (applicant.id + 1, course.id, STATUS),  # deleted applicant
+    ]
+    mails = generate_status_mails(entries, time=fcfs_time)
+
+    assert [entry for entry, _ in mails] == entries[:5]
+    assert [msg.subject.rsplit(' - ', 1)[1] for _, msg in mails] == [
+        'Verlosungspool', 'Warteliste', 'Erfolgreiche Anmeldung', 'Platz durch Nachrückverfahren', 'Platzverlust'
+    ]
+    assert all(msg.recipients == [applicant.mail] for _, msg in mails)
+
+
+def test_status_mails_retry_rest(monkeypatch):
+    pool, retries = stub_task(monkeypatch, tasks.send_status_mails, fail_at=3)
+    monkeypatch.setattr(tasks, 'generate_status_mails', lambda entries: [(entry, entry) for entry in entries])
+    entries = [(applicant_id, 1, STATUS) for applicant_id in range(5)]
+
+    with raises(Retry):
+        tasks.send_status_mails(entries)
+
+    assert pool.sent == entries[:2]
+    assert retries == [((entries[2:],), {})]
+
+
+def test_status_mails_skip_left_out_entries(monkeypatch):
+    pool, retries = stub_task(monkeypatch, tasks.send_status_mails, fail_at=2)
+    # the second entry is left out, e.g. its applicant got deleted
+    monkeypatch.setattr(tasks, 'generate_status_mails', lambda entries: [(entry, entry) for entry in entries[::2]])
+    entries = [(applicant_id, 1, STATUS) for applicant_id in range(5)]
+
+    with raises(Retry):
+        tasks.send_status_mails(entries)
+
+    assert pool.sent == entries[:1]
+    assert retries == [((entries[1:],), {})]
+
+
+def test_notification_mails_retry_rest(monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_BCC_BATCH_SIZE', 2)
+    pool, retries = stub_task(monkeypatch, tasks.notification_mails, fail_at=2)
+    recipients = ['{}@beispiel.de'.format(i) for i in range(5)]
+    sender = app.config['PRIMARY_MAIL']
+
+    with raises(Retry):
+        tasks.notification_mails(sender, recipients, 'Betreff', '<p>Text</p>', ['cc@beispiel.de'], ['bcc@beispiel.de'])
+
+    assert len(pool.sent) == 1
+    assert pool.sent[0].cc == ['cc@beispiel.de']
+    assert pool.sent[0].bcc == ['bcc@beispiel.de'] + recipients[:2]
+    args, kwargs = retries[0]
+    assert args[1] == recipients[2:]
+    assert kwargs == dict(done=2)
+
+    # the retry sends the rest only, without cc and bcc
+    pool.fail_at = None
+    pool.sent = []
+    assert tasks.notification_mails(*args, **kwargs) == dict(sent=5, total=5)
+    assert [msg.bcc for msg in pool.sent] == [recipients[2:4], recipients[4:]]
+    assert all(not msg.cc for msg in pool.sent)
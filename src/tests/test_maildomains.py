@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the shared cache of mail domain deliverability.
+"""
+
+from pytest import raises
+
+from spz.forms.validators import EmailPlusValidator, ValidationError
+from spz.maildomains import DomainCache, check_deliverability
+
+
+class StubRedis(object):
+    """Just the string and hash commands the cache uses, without expiry."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = str(value).encode()
+
+    def hincrby(self, key, field, amount=1):
+        counts = self.data.setdefault(key, {})
+        counts[field.encode()] = counts.get(field.encode(), 0) + amount
+
+    def hgetall(self, key):
+        return self.data.get(key, {})
+
+
+def test_domain_cache():
+    checked = []
+
+    def check(ascii_domain, domain):
+        checked.append(ascii_domain)
+        return {'kit.edu': True, 'typo.invalid': False}.get(ascii_domain)  # None: DNS timed out
+
+    domains = DomainCache(check, StubRedis())
+    assert domains.is_deliverable('KIT.edu')
+    assert domains.is_deliverable('kit.edu')
+    assert not domains.is_deliverable('typo.invalid')
+    assert not domains.is_deliverable('typo.invalid')
+    assert domains.is_deliverable('slow.example')
+    assert domains.is_deliverable('slow.example')
+    assert checked == ['kit.edu', 'typo.invalid', 'slow.example', 'slow.example']
+    assert domains.stats() == dict(hits=2, misses=4)
+
+    assert domains.warm(['kit.edu', 'typo.invalid']) == 1
+    assert domains.stats() == dict(hits=2, misses=4)
+
+
+def test_stub_resolver():
+    assert check_deliverability('beispiel.de', 'beispiel.de') is True
+    assert check_deliverability('typo.invalid', 'typo.invalid') is False
+
+
+def test_email_plus_validator():
+    validator = EmailPlusValidator()
+
+    class Field(object):
+        data = 'mika.mueller@beispiel.de'
+
+    validator(None, Field)
+    Field.data = 'mika.mueller@typo.invalid'
+    with raises(ValidationError):
+        validator(None, Field)
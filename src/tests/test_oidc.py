@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the cached OIDC discovery document.
+"""
+
+import time
+
+from spz import app
+from spz.oidc.oid_handler import Discovery
+
+
+def test_discovery(tmp_path):
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return dict(authorization_endpoint='https://idp/auth', version=len(fetched))
+
+    discovery_file = app.config['OIDC_DISCOVERY_FILE']
+    app.config['OIDC_DISCOVERY_FILE'] = str(tmp_path / 'discovery.json')
+    try:
+        discovery = Discovery('https://idp/.well-known/openid-configuration', fetch)
+        assert fetched == []  # nothing happens before first use
+        assert discovery.get()['version'] == 1
+        assert discovery.get()['version'] == 1
+        assert len(fetched) == 1
+
+        # another process starts from the document on disk
+        assert Discovery('https://idp/.well-known/openid-configuration', fetch).get()['version'] == 1
+        assert len(fetched) == 1
+
+        # a stale document is still served while a fresh one is fetched in the background
+        app.config['OIDC_DISCOVERY_TTL'], ttl = 0, app.config['OIDC_DISCOVERY_TTL']
+        try:
+            discovery.fetched_at = 0
+            assert discovery.get()['version'] == 1
+            for _ in range(50):
+                if not discovery.refreshing:
+                    break
+                time.sleep(0.01)
+            assert len(fetched) == 2
+        finally:
+            app.config['OIDC_DISCOVERY_TTL'] = ttl
+    finally:
+        app.config['OIDC_DISCOVERY_FILE'] = discovery_file
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the in-memory allocation engine and compares it to the SQL backend.
+"""
+
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from pytest import mark
+
+from spz import app, counters, db, populate
+from spz.allocation import Snapshot, Candidates, allocate, summarize
+from spz.models import Attendance, PopulateRun
+from spz.populate import replay, rnd_order
+from tests.sample_data import make_applicant
+
+
+FakeCourse = namedtuple('FakeCourse', ['id', 'language_id', 'level', 'collision'])
+
+
+def make_snapshot(courses, remaining, applicants, active=None):
+    active = active or {}
+    return Snapshot(
+        course_ids=[course.id for course in courses],
+        remaining=remaining,
+        parallel=Snapshot.build_parallel(courses),
+        applicant_ids=list(range(applicants)),
+        active=[active.get(a, 0) for a in range(applicants)],
+        active_count=[bin(active.get(a, 0)).count('1') for a in range(applicants)],
+        is_student=[True] * applicants,
+        discounted=[False] * applicants
+    )
+
+
+def test_parallel_bitsets():
+    courses = [
+        FakeCourse(1, 1, 'A1', []),
+        FakeCourse(2, 1, 'A1', []),
+        FakeCourse(3, 1, 'A2', ['A1']),
+        FakeCourse(4, 1, 'B1', []),
+        FakeCourse(5, 2, 'A1', []),
+    ]
+    parallel = Snapshot.build_parallel(courses)
+    assert parallel[0] == 0b00110  # same level and collision, never the course itself
+    assert parallel[2] == 0b00011
+    assert parallel[3] == 0
+    assert parallel[4] == 0  # other language
+
+
+def test_one_course_per_round():
+    courses = [FakeCourse(1, 1, 'A1', []), FakeCourse(2, 1, 'B1', [])]
+    snapshot = make_snapshot(courses, remaining=[5, 5], applicants=1)
+    candidates = Candidates([0, 0], [0, 1], [False, False])
+
+    result = allocate(snapshot, candidates, range(len(candidates)))
+
+    assert result.accepted == [(0, 100)]
+    assert result.handled == [0]
+    assert snapshot.remaining == [4, 5]
+
+
+def test_full_course_and_rejection_mails():
+    courses = [FakeCourse(1, 1, 'A1', [])]
+    snapshot = make_snapshot(courses, remaining=[1], applicants=3)
+    candidates = Candidates([0, 1, 2], [0, 0, 0], [False, False, True])
+
+    result = allocate(snapshot, candidates, range(len(candidates)))
+
+    assert [idx for idx, _ in result.accepted] == [0]
+    assert result.rejected == [1]  # already informed candidates do not get another mail
+    assert result.handled == [0, 1]
+    assert snapshot.remaining == [0]
+
+
+def test_active_in_parallel_course():
+    courses = [FakeCourse(1, 1, 'A1', []), FakeCourse(2, 1, 'A1', [])]
+    snapshot = make_snapshot(courses, remaining=[5, 5], applicants=1, active={0: 0b10})
+    candidates = Candidates([0], [0], [False])
+
+    result = allocate(snapshot, candidates, range(len(candidates)))
+
+    assert result.accepted == []
+    assert result.parallel == [0]
+    assert result.handled == []
+
+
+def test_discount():
+    courses = [FakeCourse(1, 1, 'A1', []), FakeCourse(2, 1, 'B1', [])]
+    snapshot = make_snapshot(courses, remaining=[5, 5], applicants=2, active={1: 0b10})
+    candidates = Candidates([0, 1], [0, 0], [False, False])
+
+    result = allocate(snapshot, candidates, range(len(candidates)))
+
+    # one free course for students only
+    assert result.accepted == [(0, 100), (1, 0)]
+
+
+def test_seeded_lottery_replay():
+    courses = [FakeCourse(1, 1, 'A1', []), FakeCourse(2, 1, 'B1', [])]
+    snapshot = make_snapshot(courses, remaining=[2, 1], applicants=6)
+    candidates = Candidates(list(range(6)), [0, 1, 0, 1, 0, 1], [False] * 6)
+
+    assert rnd_order(42)(candidates) == rnd_order(42)(candidates)
+
+    initial = snapshot.copy()
+    result = allocate(snapshot, candidates, rnd_order(42)(candidates))
+    summary = dict(summarize(snapshot, candidates, result), seed=42)
+
+    run = PopulateRun(
+        timestamp=None,
+        procedure=PopulateRun.RND,
+        seed=42,
+        snapshot=json.dumps(dict(snapshot=initial.to_dict(), candidates=candidates.to_dict())),
+        outcome=json.dumps(summary)
+    )
+    replayed, matches = replay(run)
+
+    assert matches
+    assert len(replayed['accepted']) == 3
+    assert len(replayed['rejected']) == 3
+
+
+def test_purge_runs(courses):
+    time = datetime(2020, 10, 1, 8)
+    for timestamp in (time - app.config['POPULATE_RUN_TTL'], time):
+        db.session.add(PopulateRun(
+            timestamp=timestamp, procedure=PopulateRun.RND, seed=42, snapshot='{}', outcome='{}'
+        ))
+    db.session.commit()
+
+    assert PopulateRun.purge(time) == 1
+    db.session.commit()
+    assert [run.timestamp for run in PopulateRun.query] == [time]
+
+
+def test_deferred_candidates():
+    courses = [FakeCourse(1, 1, 'A1', []), FakeCourse(2, 1, 'B1', [])]
+    snapshot = make_snapshot(courses, remaining=[5, 5], applicants=1)
+    candidates = Candidates([0, 0], [0, 1], [False, False])
+
+    result = allocate(snapshot, candidates, range(len(candidates)))
+    summary = summarize(snapshot, candidates, result)
+
+    # the second course has to be looked at again by the next incremental run
+    assert result.deferred == [1]
+    assert summary['deferred'] == [[0, 2]]
+
+
+def make_waiting_lists(courses, time):
+    """The situations of the tests above as attendances in the database.
+
+       :return: tuple of the expected outcome, see :py:func:`outcome`, and the expected active attendances after it
+    """
+    language = courses[0].language
+    language.signup_manual_end = time - timedelta(hours=1)
+    language.signup_auto_end = time + timedelta(hours=1)
+    full, first, second, wanted, attended = courses[:5]
+    for course, level, limit in zip(courses[:5], ['A1', 'A2', 'B1', 'C1', 'C1'], [1, 5, 5, 5, 5]):
+        course.language = language
+        course.level = level
+        course.collision = []
+        course.limit = limit
+
+    waiting = [
+        (0, full, False),  # gets the only seat
+        (1, full, False),  # rejected
+        (2, full, True),  # rejected before, no other mail
+        (3, first, False),  # one course per round
+        (3, second, False),  # deferred
+        (4, wanted, False),  # active in a parallel course
+        (5, first, False),  # active in another course, no free course anymore
+    ]
+    # new attendances join the session through their course, before they belong to an applicant
+    with db.session.no_autoflush:
+        applicants = [make_applicant(id=i) for i in range(6)]
+        for applicant in applicants:
+            applicant.is_student = True
+        applicants[3].is_student = False
+
+        for minutes, (applicant, course, informed) in enumerate(waiting):
+            attendance = applicants[applicant].add_course_attendance(
+                course=course, graduation=None, waiting=True, discount=0, informed_about_rejection=informed
+            )
+            attendance.registered = time - timedelta(minutes=60 - minutes)
+        for applicant in applicants[4:]:
+            applicant.add_course_attendance(course=attended, graduation=None, waiting=False, discount=0)
+    db.session.add_all(applicants)
+    db.session.commit()
+
+    ids = [applicant.id for applicant in applicants]
+    active = {(ids[0], full.id), (ids[3], first.id), (ids[5], first.id), (ids[4], attended.id), (ids[5], attended.id)}
+    return dict(
+        accepted=sorted([(ids[0], full.id, 100.0), (ids[3], first.id, 0.0), (ids[5], first.id, 0.0)]),
+        rejected=[(ids[1], full.id)],
+        parallel=[(ids[4], wanted.id)],
+        deferred=[(ids[3], second.id)],
+        mails=sorted([(ids[0], full.id, False), (ids[1], full.id, False), (ids[3], first.id, False),
+                      (ids[5], first.id, False)])
+    ), active
+
+
+def outcome(summary):
+    """The decisions of a summary, independent of their order."""
+    return dict(
+        accepted=sorted((applicant_id, course_id, float(discount)) for applicant_id, course_id, discount
+                        in summary['accepted']),
+        rejected=sorted(map(tuple, summary['rejected'])),
+        parallel=sorted(map(tuple, summary['parallel'])),
+        deferred=sorted(map(tuple, summary['deferred'])),
+        mails=sorted(map(tuple, summary['mails']))
+    )
+
+
+@mark.parametrize('populate_fcfs', [populate.populate_fcfs, populate.populate_fcfs_sql], ids=['memory', 'sql'])
+def test_backends_agree(courses, monkeypatch, populate_fcfs):
+    sent = []
+    monkeypatch.setattr(populate, 'send_mails', sent.extend)
+    time = datetime(2020, 10, 1, 8)
+    expected, active = make_waiting_lists(courses, time)
+
+    summary = populate_fcfs(time)
+
+    assert outcome(summary) == expected
+    assert sorted((applicant_id, course_id, bool(informed)) for applicant_id, course_id, informed in sent) == \
+        expected['mails']
+    assert {
+        (attendance.applicant_id, attendance.course_id)
+        for attendance in Attendance.query.filter(Attendance.waiting == False)  # NOQA
+    } == active
+    assert counters.check() == []
+
+
+@mark.parametrize('populate_fcfs', [populate.populate_fcfs, populate.populate_fcfs_sql], ids=['memory', 'sql'])
+def test_backends_dry_run(courses, monkeypatch, populate_fcfs):
+    monkeypatch.setattr(populate, 'send_mails', lambda handled: None)
+    time = datetime(2020, 10, 1, 8)
+    expected, _ = make_waiting_lists(courses, time)
+
+    assert outcome(populate_fcfs(time, dry_run=True)) == expected
+    assert Attendance.query.filter(Attendance.waiting == True).count() == 7  # NOQA
+    assert counters.check() == []
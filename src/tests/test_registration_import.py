@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the background import of the registration numbers.
+"""
+
+import io
+
+from spz import db, models, registration_import, store
+
+
+class StubRedis(object):
+    """Just the hash and set commands the import uses."""
+
+    def __init__(self):
+        self.data = {}
+
+    def hset(self, key, mapping):
+        self.data.setdefault(key, {}).update({k.encode(): str(v).encode() for k, v in mapping.items()})
+
+    def hmget(self, key, *fields):
+        return [self.data.get(key, {}).get(field.encode()) for field in fields]
+
+    def hgetall(self, key):
+        return self.data.get(key, {})
+
+    def smembers(self, key):
+        return self.data.get(key, set())
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+def test_read_lines():
+    fp = io.BytesIO(b'123\r\n\r\n 456 \n\n789')
+    assert list(registration_import.read_lines(fp)) == ['123', '456', '789']
+
+
+def test_apply_diff(monkeypatch):
+    client = StubRedis()
+    monkeypatch.setattr(store, 'redis_client', lambda: client)
+
+    db.session.add_all(models.Registration.from_cleartext(tag) for tag in ('kept', 'removed'))
+    db.session.commit()
+
+    client.hset(registration_import.STATUS, mapping=dict(id='abc', state='running'))
+    client.data[registration_import.SALTED.format('abc')] = {
+        models.hash_secret_weak(tag) for tag in ('kept', 'added')
+    }
+
+    assert registration_import.apply('abc') == (1, 1)
+    assert models.Registration.exists('kept')
+    assert models.Registration.exists('added')
+    assert not models.Registration.exists('removed')
+    assert registration_import.status()['state'] == 'done'
+
+    # a finished import is not applied twice
+    assert registration_import.apply('abc') == (0, 0)
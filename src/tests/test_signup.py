@@ -4,8 +4,8 @@
 """
 
 from tests import get_text
-from spz.models import Applicant, Approval
-from spz import db, token
+from spz.models import Applicant, Approval, ApprovalSummary, OAuthToken
+from spz import app, db, token
 
 from datetime import datetime, timedelta, timezone
 
@@ -165,3 +165,42 @@ def test_signup_restricted_course(client, applicant_data, course):
     print(response_text)
     assert "Ihre Registrierung war erfolgreich" in response_text
     assert in_course(applicant_data, course)
+
+
+def test_approval_summary(client):
+    db.session.add_all([
+        Approval(tag='1234567', percent=60, sticky=False, priority=False),
+        Approval(tag='1234567', percent=90, sticky=False, priority=False),
+        Approval(tag='7654321', percent=70, sticky=False, priority=False),
+    ])
+    db.session.commit()
+    assert ApprovalSummary.best_ratings(['1234567', '7654321', '0']) == {'1234567': 90, '7654321': 70, '0': 0}
+
+    priority = Approval(tag='1234567', percent=40, sticky=True, priority=True)
+    db.session.add(priority)
+    db.session.commit()
+    assert ApprovalSummary.best_ratings(['1234567']) == {'1234567': 40}
+
+    db.session.delete(priority)
+    db.session.commit()
+    assert ApprovalSummary.best_ratings(['1234567']) == {'1234567': 90}
+
+    Approval.query.filter(Approval.sticky == False).delete()  # NOQA
+    ApprovalSummary.refresh()
+    db.session.commit()
+    assert ApprovalSummary.best_ratings(['1234567', '7654321']) == {'1234567': 0, '7654321': 0}
+
+
+def test_oauth_token_expiry(client):
+    oauth_token = OAuthToken(state='ABCDEFG', code_verifier='verifier')
+    oauth_token.set_user_data(dict(given_name='Mika', family_name='Müller', picture='https://idp/mika.png'))
+    db.session.add(oauth_token)
+    db.session.commit()
+    assert OAuthToken.for_state('ABCDEFG').first().get_user_data() == dict(given_name='Mika', family_name='Müller')
+
+    later = oauth_token.created_at + app.config['OAUTH_TOKEN_TTL'] + timedelta(seconds=1)
+    assert OAuthToken.for_state('ABCDEFG', later).first() is None
+    assert OAuthToken.purge(oauth_token.created_at) == 0
+    assert OAuthToken.purge(later) == 1
+    db.session.commit()
+    assert OAuthToken.query.count() == 0
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""Tests the memoized tag hashing.
+"""
+
+from spz import app
+from spz.taghash import TagHasher, hash_all
+
+
+def make_hasher(size=10, ttl=60):
+    calls = []
+
+    def hash_function(tag):
+        calls.append(tag)
+        return tag.encode('utf8')
+
+    return TagHasher(hash_function, size, ttl), calls
+
+
+def test_hash_once_per_request():
+    hasher, calls = make_hasher()
+    with app.test_request_context():
+        assert hasher('AB123') == b'ab123'
+        assert hasher('ab123') == b'ab123'
+        assert hasher(None) == b''
+    assert calls == ['ab123', '']
+    assert hasher.stats() == dict(request_hits=1, process_hits=0, misses=2, size=2)
+
+    with app.test_request_context():
+        hasher('ab123')
+    assert calls == ['ab123', '']
+    assert hasher.stats()['process_hits'] == 1
+
+
+def test_bounded_and_expiring():
+    hasher, calls = make_hasher(size=2)
+    for tag in ['1', '2', '3', '1']:
+        hasher(tag)
+    assert calls == ['1', '2', '3', '1']
+    assert hasher.stats()['size'] == 2
+
+    hasher, calls = make_hasher(ttl=-1)
+    hasher('1')
+    hasher('1')
+    assert calls == ['1', '1']
+
+
+def encode(tag):
+    return tag.encode('utf8')
+
+
+def test_hash_all():
+    tags = ['ab{}'.format(i) for i in range(5)]
+    expected = {tag: tag.encode('utf8') for tag in tags}
+    assert hash_all(encode, tags) == expected
+    assert hash_all(encode, tags, processes=2, chunksize=2) == expected
@@ -3,7 +3,11 @@
 """Tests the application views.
 """
 
+from flask import g
+
+from spz import app, db, fragments
 from tests import login, logout, get_text
+from tests.sample_data import make_applicant
 
 
 def test_startpage(client):
@@ -35,3 +39,24 @@ def test_login(client, user, superuser):
     response_text = get_text(response)
     logout(client)
     assert 'Du kommst hier net rein!' in response_text
+
+
+def test_fragment_versions(courses):
+    course = courses[0]
+
+    def versions():
+        with app.test_request_context():
+            # `g` belongs to the app context of the fixture, which every request here shares
+            g.pop('course_versions', None)
+            return fragments.course_versions()
+
+    before = versions()
+    applicant = make_applicant(id=0)
+    applicant.add_course_attendance(course=course, graduation=None, waiting=True, discount=0)
+    db.session.add(applicant)
+    db.session.commit()
+    after = versions()
+
+    assert after[course.language_id] != before[course.language_id]
+    assert {key: value for key, value in after.items() if key != course.language_id} == \
+        {key: value for key, value in before.items() if key != course.language_id}